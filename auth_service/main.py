@@ -1,12 +1,17 @@
 import os
+import asyncio
 from datetime import datetime, timedelta
 from typing import Optional
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
 
 from fastapi import FastAPI, HTTPException, Depends, status
 from fastapi.security import OAuth2PasswordRequestForm
 from pydantic import BaseModel
-from sqlalchemy import create_engine, Column, Integer, String
-from sqlalchemy.orm import sessionmaker, Session, declarative_base
+from sqlalchemy import Column, Integer, String, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import declarative_base
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
 from passlib.context import CryptContext
 from jose import jwt
 
@@ -14,12 +19,16 @@ SECRET_KEY = "eyJhbGciOiJIUzI1NiIsInR5cCI6IkpXVCJ9.eyJzdWIiOiJhZG1pbiIsImV4cCI6M
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 60 * 24  # 1 сутки
 
-SQLALCHEMY_DATABASE_URL = "sqlite:///./users.db"
-engine = create_engine(SQLALCHEMY_DATABASE_URL, connect_args={
-                       "check_same_thread": False})
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# Асинхронный драйвер: запросы к БД не блокируют event loop
+SQLALCHEMY_DATABASE_URL = os.getenv("AUTH_DATABASE_URL", "sqlite+aiosqlite:///./users.db")
+engine = create_async_engine(SQLALCHEMY_DATABASE_URL, pool_pre_ping=True)
+SessionLocal = async_sessionmaker(engine, expire_on_commit=False)
 Base = declarative_base()
 
+# bcrypt — это ~100-300 мс CPU на вызов; выполняем в ограниченном пуле потоков
+AUTH_HASH_WORKERS = int(os.getenv("AUTH_HASH_WORKERS", str(min(4, os.cpu_count() or 1))))
+hash_pool = ThreadPoolExecutor(max_workers=AUTH_HASH_WORKERS, thread_name_prefix="bcrypt")
+
 
 class User(Base):
     __tablename__ = "users"
@@ -28,18 +37,16 @@ class User(Base):
     hashed_password = Column(String)
 
 
-Base.metadata.create_all(bind=engine)
-
 # Хелперы безопасности
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
 
-def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
+async def verify_password(plain_password, hashed_password):
+    return await asyncio.get_running_loop().run_in_executor(hash_pool, pwd_context.verify, plain_password, hashed_password)
 
 
-def get_password_hash(password):
-    return pwd_context.hash(password)
+async def get_password_hash(password):
+    return await asyncio.get_running_loop().run_in_executor(hash_pool, pwd_context.hash, password)
 
 
 def create_access_token(data: dict):
@@ -61,37 +68,49 @@ class Token(BaseModel):
     token_type: str
 
 
-app = FastAPI(title="Auth Service")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    yield
+    await engine.dispose()
+    hash_pool.shutdown(wait=False)
 
 
-def get_db():
-    db = SessionLocal()
-    try:
+app = FastAPI(title="Auth Service", lifespan=lifespan)
+
+
+async def get_db():
+    async with SessionLocal() as db:
         yield db
-    finally:
-        db.close()
 
 
 @app.post("/register", response_model=Token)
-def register(user: UserCreate, db: Session = Depends(get_db)):
-    db_user = db.query(User).filter(User.username == user.username).first()
+async def register(user: UserCreate, db: AsyncSession = Depends(get_db)):
+    db_user = (await db.execute(select(User).where(User.username == user.username))).scalar_one_or_none()
     if db_user:
         raise HTTPException(
             status_code=400, detail="Username already registered")
 
-    hashed_pwd = get_password_hash(user.password)
+    hashed_pwd = await get_password_hash(user.password)
     new_user = User(username=user.username, hashed_password=hashed_pwd)
     db.add(new_user)
-    db.commit()
+    try:
+        await db.commit()
+    except IntegrityError:
+        # Параллельная регистрация того же имени, пока считался хэш
+        await db.rollback()
+        raise HTTPException(
+            status_code=400, detail="Username already registered")
 
     access_token = create_access_token(data={"sub": new_user.username})
     return {"access_token": access_token, "token_type": "bearer"}
 
 
 @app.post("/token", response_model=Token)
-def login(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
-    user = db.query(User).filter(User.username == form_data.username).first()
-    if not user or not verify_password(form_data.password, user.hashed_password):
+async def login(form_data: OAuth2PasswordRequestForm = Depends(), db: AsyncSession = Depends(get_db)):
+    user = (await db.execute(select(User).where(User.username == form_data.username))).scalar_one_or_none()
+    if not user or not await verify_password(form_data.password, user.hashed_password):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect username or password",
@@ -1,10 +1,33 @@
-import asyncio
+"""Консольный клиент. По умолчанию — интерактивная игра.
+
+--replay DIR прогоняет записанные транскрипты (*.json) через Orchestrator.generate_response
+без сети (фейковая LLM или записанные ответы) и пишет отчет по каждому ходу: размер промпта,
+попадания памяти, решения директора, тайминги стадий и рост хранилища.
+
+    python console_app.py
+    python console_app.py --replay data/transcripts --concurrency 4
+    python console_app.py --replay data/transcripts --llm recorded --compare bench_results/<прошлый>_replay.json
+
+Формат транскрипта:
+    {"character_id": "char_001", "profile_id": "english_first_person",
+     "persona": {"name": "...", "description": "...", "relationship": "..."},
+     "scenario_id": null,
+     "turns": ["реплика", {"user": "реплика", "ai": "записанный ответ"}, ...]}
+"""
+import os
 import json
+import time
+import uuid
+import shutil
+import asyncio
+import argparse
+import tempfile
 from pathlib import Path
-from core.orchestrator import Orchestrator
+from typing import Dict, Any, List, Optional
 
 BASE_DIR = Path(__file__).resolve().parent
 DATA_DIR = BASE_DIR / "data"
+RESULTS_DIR = BASE_DIR / "bench_results"
 
 def load_json(name):
     try:
@@ -33,6 +56,7 @@ def select(items, key, p):
         except: pass
 
 async def main():
+    from core.orchestrator import Orchestrator
     orch = Orchestrator()
     print("\n--- NEW GAME ---")
     
@@ -79,5 +103,194 @@ async def main():
         hist.append({"role": "ai", "content": res['response']})
         if res['scenario_state']: scn_state = res['scenario_state']
 
+# ============================
+# REPLAY
+# ============================
+def load_transcripts(path: Path) -> List[Dict]:
+    files = sorted(path.glob("*.json")) if path.is_dir() else [path]
+    out = []
+    for f in files:
+        data = json.loads(f.read_text(encoding="utf-8"))
+        data["name"] = f.stem
+        data["turns"] = [t if isinstance(t, dict) else {"user": t} for t in data.get("turns", [])]
+        out.append(data)
+    return out
+
+
+def session_footprint(rag, sess_id: str) -> Dict[str, int]:
+    files = [rag._head_path(sess_id), rag._history_path(sess_id), rag._candidates_path(sess_id)]
+    try: vectors = len(rag.history_collection.get(where={"session_id": sess_id}, include=[])["ids"])
+    except Exception: vectors = -1
+    return {"bytes": sum(f.stat().st_size for f in files if f.exists()), "vectors": vectors}
+
+
+def turn_report(record: Dict[str, Any], before: Dict, after: Dict, scn_before: Optional[Dict], scn_after: Optional[Dict]) -> Dict:
+    spans = record.get("spans", [])
+    stages: Dict[str, float] = {}
+    for s in spans:
+        stages[s["stage"]] = round(stages.get(s["stage"], 0.0) + s["ms"], 2)
+    director = next((s for s in spans if s["stage"] in ("orchestrator.director", "orchestrator.director_fallback")), None)
+    progress = director.get("progress") if director else record.get("inline_verdict")
+    return {
+        "ms": record.get("ms"),
+        "prompt": {k: record.get(k) for k in ("system_chars", "prompt_chars", "messages", "context_tokens",
+                                             "input_tokens", "output_tokens")},
+        "context": {k: record.get(k) for k in ("summary", "memories", "history")},
+        "retrieval_hits": next((s.get("hits") for s in spans if s["stage"] == "orchestrator.memory_search"), None),
+        "director": None if progress is None and not scn_before else {
+            "mode": record.get("director_mode", "separate"),
+            "progress": progress,
+            "fallback": any(s["stage"] == "orchestrator.director_fallback" for s in spans),
+            "step": [(scn_before or {}).get("current_step"), (scn_after or {}).get("current_step")],
+        },
+        "stages_ms": stages,
+        "storage": {"bytes": after["bytes"], "vectors": after["vectors"],
+                    "delta_bytes": after["bytes"] - before["bytes"], "delta_vectors": after["vectors"] - before["vectors"]},
+    }
+
+
+async def replay_transcript(orch, tr: Dict, args, reports: List[Dict]):
+    from core.tracing import capture_traces
+    from core.fake_llm import RECORDED_REPLY
+
+    sess_id = f"replay_{tr['name']}_{uuid.uuid4().hex[:6]}"
+    persona = tr.get("persona") or {"name": "Replay", "description": "", "relationship": ""}
+    scn_state = {"scenario_id": tr["scenario_id"], "current_step": 0, "fail_count": 0} if tr.get("scenario_id") else None
+    orch.rag.save_session_state(sess_id, {
+        "summary": "", "buffer": [], "full_history": [], "msg_count": 0,
+        "meta": {"character_id": tr["character_id"], "profile_id": tr["profile_id"],
+                 "user_persona": persona, "scenario_state": scn_state},
+    })
+    hist: List[Dict] = []
+    for n, turn in enumerate(tr["turns"]):
+        before = session_footprint(orch.rag, sess_id)
+        if args.llm == "recorded":
+            RECORDED_REPLY.set((turn["user"], turn.get("ai") or ""))
+        with capture_traces() as records:
+            res = await orch.generate_response(turn["user"], sess_id, tr["character_id"], tr["profile_id"],
+                                               persona, scn_state, hist, api_key="replay-key")
+        root = next((r for r in records if r["trace"] == "generate_response"), {})
+        rep = turn_report(root, before, session_footprint(orch.rag, sess_id), scn_state, res.get("scenario_state"))
+        reports.append({"transcript": tr["name"], "session": sess_id, "turn": n, "error": bool(res.get("error")), **rep})
+        if args.verbose:
+            print(f"  {tr['name']}#{n}: {rep['ms']} ms, prompt {rep['prompt']['context_tokens']} tok, "
+                  f"hits {rep['retrieval_hits']}, +{rep['storage']['delta_bytes']} B")
+        hist += [{"role": "user", "content": turn["user"]}, {"role": "ai", "content": res["response"]}]
+        if res.get("scenario_state"): scn_state = res["scenario_state"]
+
+
+async def replay(args) -> Dict[str, Any]:
+    from scripts.load_test import summarize, percentile, dir_size, git_commit
+    from core.orchestrator import Orchestrator
+
+    transcripts = load_transcripts(args.replay)
+    orch = Orchestrator()
+    storage = [Path(os.environ[k]) for k in ("SESSIONS_DIR", "CHROMA_DB_DIR", "VECTOR_STORE_DIR")]
+    disk0 = sum(dir_size(p) for p in storage)
+    reports: List[Dict] = []
+    sem = asyncio.Semaphore(args.concurrency)
+
+    async def worker(tr):
+        async with sem:
+            await replay_transcript(orch, tr, args, reports)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker(tr) for tr in transcripts))
+    elapsed = time.perf_counter() - started
+    # Дождаться фоновой свертки памяти, чтобы она попала в рост хранилища
+    if orch._bg_tasks:
+        await asyncio.gather(*orch._bg_tasks, return_exceptions=True)
+
+    tokens = [r["prompt"]["context_tokens"] for r in reports if r["prompt"]["context_tokens"] is not None]
+    stages: Dict[str, List[float]] = {}
+    for r in reports:
+        for stage, ms in r["stages_ms"].items():
+            stages.setdefault(stage, []).append(ms / 1000)
+    return {
+        "commit": git_commit(),
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "params": {k: (str(v) if isinstance(v, Path) else v) for k, v in vars(args).items()},
+        "transcripts": len(transcripts),
+        "turns": len(reports),
+        "errors": sum(r["error"] for r in reports),
+        "elapsed_s": round(elapsed, 2),
+        "turn": summarize([r["ms"] / 1000 for r in reports if r["ms"] is not None]),
+        "stages": {k: summarize(v) for k, v in sorted(stages.items())},
+        "prompt_tokens": {"p50": percentile(tokens, 50), "p95": percentile(tokens, 95), "max": max(tokens, default=0)},
+        "llm_calls": orch.llm.stats()["requests"],
+        "disk_bytes": {"start": disk0, "end": sum(dir_size(p) for p in storage)},
+        "per_turn": sorted(reports, key=lambda r: (r["transcript"], r["turn"])),
+    }
+
+
+def print_replay(res: Dict[str, Any], base: Optional[Dict[str, Any]] = None):
+    print(f"\n🎬 commit {res['commit']}  {res['transcripts']} transcripts / {res['turns']} turns  "
+          f"{res['elapsed_s']}s  errors: {res['errors']}  LLM calls: {res['llm_calls']}")
+    print(f"\n{'STAGE':<34}{'n':>6}{'p50':>10}{'p95':>10}" + ("   Δp95" if base else ""))
+    for name, s in [("turn", res["turn"]), *res["stages"].items()]:
+        line = f"{name:<34}{s['count']:>6}{s['p50_ms']:>10}{s['p95_ms']:>10}"
+        old = (base or {}).get("turn") if name == "turn" else (base or {}).get("stages", {}).get(name)
+        if old and old["p95_ms"]:
+            line += f"   {(s['p95_ms'] - old['p95_ms']) / old['p95_ms'] * 100:+.1f}%"
+        print(line)
+    pt = res["prompt_tokens"]
+    print(f"\nPrompt tokens: p50 {pt['p50']}  p95 {pt['p95']}  max {pt['max']}")
+    disk = res["disk_bytes"]
+    print(f"Disk: +{(disk['end'] - disk['start']) / 1024:.1f} KB")
+
+
+def run_replay(args):
+    # Изоляция: фейковая LLM без задержек, данные во временной папке
+    workdir = Path(tempfile.mkdtemp(prefix="rag_replay_"))
+    os.environ.update({
+        "LLM_PROVIDER": "fake",
+        "FAKE_LLM_LATENCY_MS": str(args.latency_ms),
+        "FAKE_LLM_TOKENS_PER_SEC": str(args.tokens_per_sec),
+        "SESSIONS_DIR": str(workdir / "sessions"),
+        "CHROMA_DB_DIR": str(workdir / "chroma_db"),
+        "VECTOR_STORE_DIR": str(workdir / "vector_store"),
+        "RESULT_CACHE_PATH": str(workdir / "llm_results.sqlite"),
+        "LLM_RATE_PER_MIN": os.getenv("LLM_RATE_PER_MIN", "100000"),
+        "LLM_BURST": os.getenv("LLM_BURST", "1000"),
+        "LLM_MAX_CONCURRENCY": os.getenv("LLM_MAX_CONCURRENCY", "64"),
+    })
+    if args.director_mode:
+        os.environ["DIRECTOR_MODE"] = args.director_mode
+
+    try:
+        res = asyncio.run(replay(args))
+    finally:
+        if not args.keep: shutil.rmtree(workdir, ignore_errors=True)
+        else: print(f"📁 {workdir}")
+    base = json.loads(args.compare.read_text(encoding="utf-8")) if args.compare else None
+    print_replay(res, base)
+
+    out = args.out
+    if out is None and not args.no_save:
+        RESULTS_DIR.mkdir(exist_ok=True)
+        out = RESULTS_DIR / f"{time.strftime('%Y%m%d-%H%M%S')}_{res['commit']}_replay.json"
+    if out:
+        out.write_text(json.dumps(res, ensure_ascii=False, indent=2), encoding="utf-8")
+        print(f"💾 {out}")
+
+
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--replay", type=Path, help="папка (или файл) с транскриптами *.json")
+    ap.add_argument("--concurrency", type=int, default=4)
+    ap.add_argument("--llm", choices=["fake", "recorded"], default="fake",
+                    help="recorded — ответы из поля ai транскрипта (где его нет — фейковые)")
+    ap.add_argument("--latency-ms", type=float, default=0, help="задержка фейковой LLM")
+    ap.add_argument("--tokens-per-sec", type=float, default=1e6, help="скорость фейковой LLM (по умолчанию почти мгновенно)")
+    ap.add_argument("--director-mode", choices=["separate", "inline"])
+    ap.add_argument("--compare", type=Path, help="отчет прошлого реплея для сравнения")
+    ap.add_argument("--out", type=Path, help="куда сохранить отчет (по умолчанию bench_results/)")
+    ap.add_argument("--no-save", action="store_true")
+    ap.add_argument("--keep", action="store_true", help="не удалять временную папку с данными")
+    ap.add_argument("-v", "--verbose", action="store_true", help="печатать каждый ход")
+    args = ap.parse_args()
+
+    if args.replay:
+        run_replay(args)
+    else:
+        asyncio.run(main())
\ No newline at end of file
@@ -0,0 +1,88 @@
+import os
+from typing import List, Dict, Any, Optional, Callable
+
+from langchain_core.messages import SystemMessage, HumanMessage, AIMessage, BaseMessage
+
+from core.tokenizer import count_tokens, message_tokens, MESSAGE_OVERHEAD
+
+# Части контекста в порядке приоритета. system и текущая реплика пользователя обязательны.
+#   summary  — саммари сюжета в системном промпте
+#   recent   — последние CONTEXT_MIN_RECENT сообщений
+#   memories — найденные в векторной памяти фрагменты
+#   history  — остальная история, от новых к старым, пока влезает
+DEFAULT_PRIORITY = ("summary", "recent", "memories", "history")
+MEMORY_HEADER = "### MEMORY ###"
+
+
+class ContextAssembler:
+    def __init__(self, budget: Optional[int] = None, priority: Optional[List[str]] = None, min_recent: Optional[int] = None):
+        self.budget = budget or int(os.getenv("CONTEXT_TOKEN_BUDGET", "8000"))
+        env_prio = os.getenv("CONTEXT_PRIORITY")
+        self.priority = list(priority or (env_prio.split(",") if env_prio else DEFAULT_PRIORITY))
+        self.min_recent = min_recent if min_recent is not None else int(os.getenv("CONTEXT_MIN_RECENT", "2"))
+
+    def assemble(
+        self, build_system: Callable[[str], str], summary: str, memories: List[str],
+        history: List[Dict], text: Optional[str]
+    ) -> Dict[str, Any]:
+        """Собирает сообщения для LLM в пределах бюджета токенов.
+
+        build_system(summary) возвращает системный промпт (с саммари или без).
+        history — сообщения в хронологическом порядке; берутся с конца, поэтому
+        стоимость сборки зависит только от того, сколько влезло, а не от длины чата.
+        Больше len(history) не берется, даже если бюджет позволяет: окно истории
+        ограничивает вызывающий (на пути чата — HISTORY_WINDOW).
+        """
+        base_sys = build_system("")
+        used = count_tokens(base_sys) + MESSAGE_OVERHEAD
+        if text:
+            used += count_tokens(text) + MESSAGE_OVERHEAD
+
+        use_summary = False
+        picked_mems: List[str] = []
+        n_hist = 0  # сколько последних сообщений истории берем
+
+        def take_history(limit: Optional[int]) -> None:
+            nonlocal used, n_hist
+            while n_hist < len(history) and (limit is None or n_hist < limit):
+                cost = message_tokens(history[-1 - n_hist])
+                if used + cost > self.budget: break
+                used += cost
+                n_hist += 1
+
+        for part in self.priority:
+            part = part.strip()
+            if part == "summary" and summary:
+                cost = count_tokens(summary) + MESSAGE_OVERHEAD
+                if used + cost <= self.budget:
+                    use_summary, used = True, used + cost
+            elif part == "recent":
+                take_history(self.min_recent)
+            elif part == "memories":
+                for mem in memories:
+                    # "Memory N: " + перевод строки; заголовок блока — с первым фрагментом
+                    cost = count_tokens(mem) + 4
+                    if not picked_mems: cost += count_tokens(MEMORY_HEADER) + MESSAGE_OVERHEAD
+                    if used + cost > self.budget: break
+                    used += cost
+                    picked_mems.append(mem)
+            elif part == "history":
+                take_history(None)
+
+        sys_txt = build_system(summary) if use_summary else base_sys
+        msgs: List[BaseMessage] = [SystemMessage(content=sys_txt)]
+        if picked_mems:
+            lines = [f"Memory {i+1}: {m.replace(chr(10), ' ')}" for i, m in enumerate(picked_mems)]
+            msgs.append(SystemMessage(content=f"{MEMORY_HEADER}\n" + "\n".join(lines)))
+        for m in history[len(history) - n_hist:]:
+            cls = HumanMessage if m["role"] == "user" else AIMessage
+            msgs.append(cls(content=m["content"]))
+        if text:
+            msgs.append(HumanMessage(content=text))
+
+        return {
+            "messages": msgs,
+            "system": sys_txt,
+            "tokens": used,
+            "included": {"summary": use_summary, "memories": len(picked_mems), "history": n_hist},
+        }
@@ -1,25 +1,37 @@
 from typing import Optional
-from langchain_google_genai import ChatGoogleGenerativeAI
 from langchain_core.messages import HumanMessage
 
+from core.llm_scheduler import LLMScheduler, PRIORITY_AUX
+from core.result_cache import ResultCache
+
+DIRECTOR_MODEL = "gemini-2.5-flash"
+# Меняется при любой правке шаблона промпта — старые вердикты в кэше перестают совпадать
+DIRECTOR_PROMPT_VERSION = "director-v1"
+
 class Director:
-    def __init__(self, default_api_key: str):
+    def __init__(self, default_api_key: str, scheduler: Optional[LLMScheduler] = None, cache: Optional[ResultCache] = None):
         self.default_api_key = default_api_key
+        self.llm = scheduler or LLMScheduler()
+        self.cache = cache
 
     async def check_progress(self, history_text: str, goal: str, api_key: Optional[str] = None) -> bool:
         if not goal: return False
         
+        # Вердикт при temperature=0 детерминирован: повтор того же хода (регенерация, форк) берем из кэша
+        cache_key = ResultCache.make_key(DIRECTOR_MODEL, DIRECTOR_PROMPT_VERSION, goal, history_text)
+        if self.cache and (hit := self.cache.get("director", cache_key)) is not None:
+            return hit == "YES"
+
         # Если ключ пришел от юзера - используем его, иначе дефолтный из .env
         key_to_use = api_key if api_key else self.default_api_key
         
-        # Создаем "одноразовый" экземпляр модели с нужным ключом
-        llm = ChatGoogleGenerativeAI(model="gemini-2.5-flash", temperature=0.0, google_api_key=key_to_use)
-        
         prompt = (
             f"Goal: \"{goal}\"\nChat:\n{history_text}\n"
             "Did they make significant progress towards the goal? YES or NO."
         )
         try:
-            res = await llm.ainvoke([HumanMessage(content=prompt)])
-            return "YES" in str(res.content).strip().upper()
-        except: return False
\ No newline at end of file
+            res = await self.llm.invoke(DIRECTOR_MODEL, 0.0, [HumanMessage(content=prompt)], key_to_use, priority=PRIORITY_AUX)
+        except: return False
+        verdict = "YES" in str(res.content).strip().upper()
+        if self.cache: self.cache.put("director", cache_key, "YES" if verdict else "NO")
+        return verdict
@@ -0,0 +1,68 @@
+import os
+import random
+import asyncio
+import hashlib
+import contextvars
+from typing import List, Optional, Tuple
+
+from langchain_core.messages import AIMessage, BaseMessage
+
+WORDS = ("the", "shadow", "whispers", "slowly", "lantern", "door", "rain", "you", "smiles",
+         "quietly", "old", "road", "glances", "back", "storm", "silver", "hand", "waits")
+
+
+# Реплей транскриптов: (реплика пользователя, записанный ответ). Основной вызов, который
+# заканчивается этой репликой, получает записанный ответ вместо сгенерированного.
+RECORDED_REPLY: contextvars.ContextVar[Optional[Tuple[str, str]]] = contextvars.ContextVar("recorded_reply", default=None)
+
+
+class FakeChatModel:
+    """Детерминированная заглушка LLM для нагрузочных тестов (без сети).
+
+    Задержка = FAKE_LLM_LATENCY_MS + ответные токены / FAKE_LLM_TOKENS_PER_SEC.
+    """
+
+    def __init__(
+        self, model: str = "fake", temperature: float = 0.0,
+        latency_ms: Optional[float] = None, tokens_per_sec: Optional[float] = None,
+        reply_tokens: Optional[int] = None, error_rate: Optional[float] = None
+    ):
+        self.model = model
+        self.temperature = temperature
+        self.latency = (latency_ms if latency_ms is not None else float(os.getenv("FAKE_LLM_LATENCY_MS", "200"))) / 1000
+        self.tokens_per_sec = tokens_per_sec or float(os.getenv("FAKE_LLM_TOKENS_PER_SEC", "80"))
+        self.reply_tokens = reply_tokens or int(os.getenv("FAKE_LLM_REPLY_TOKENS", "120"))
+        self.error_rate = error_rate if error_rate is not None else float(os.getenv("FAKE_LLM_ERROR_RATE", "0"))
+
+    def _reply(self, prompt: str, seed: int, inline_director: bool = False) -> str:
+        # Директор ждет YES/NO
+        if "YES or NO" in prompt:
+            return "YES" if seed % 3 == 0 else "NO"
+        rnd = random.Random(seed)
+        n = 5 if "title" in prompt.lower() and "ONLY" in prompt else self.reply_tokens
+        text = " ".join(rnd.choice(WORDS) for _ in range(n)).capitalize() + "."
+        # Однопроходный режим директора: вердикт блоком в конце ответа
+        if inline_director:
+            text += f'\n<director>{{"progress": {"true" if seed % 3 == 0 else "false"}, "stagnation_note": ""}}</director>'
+        return text
+
+    async def ainvoke(self, messages: List[BaseMessage], **kwargs) -> AIMessage:
+        prompt = "\n".join(str(m.content) for m in messages)
+        seed = int(hashlib.sha256(f"{self.model}|{prompt}".encode()).hexdigest()[:12], 16)
+
+        last = str(messages[-1].content) if messages else ""
+        text = self._reply(last, seed, "[DIRECTOR PROTOCOL]" in prompt)
+        recorded = RECORDED_REPLY.get()
+        if recorded and last == recorded[0] and recorded[1]:
+            # Вердикт директора (если он есть) оставляем сгенерированным
+            text = recorded[1] + text[text.find("\n<director>"):] if "\n<director>" in text else recorded[1]
+        out_tokens = len(text.split())
+        await asyncio.sleep(self.latency + out_tokens / self.tokens_per_sec)
+
+        if self.error_rate and random.random() < self.error_rate:
+            raise RuntimeError("429 RESOURCE_EXHAUSTED (fake)")
+
+        in_tokens = len(prompt.split())
+        return AIMessage(content=text, usage_metadata={
+            "input_tokens": in_tokens, "output_tokens": out_tokens, "total_tokens": in_tokens + out_tokens
+        })
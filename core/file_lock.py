@@ -0,0 +1,123 @@
+import os
+import threading
+from typing import Optional
+from pathlib import Path
+from contextlib import contextmanager
+from collections import defaultdict
+
+# fcntl есть только на POSIX; без него блокировки работают лишь внутри процесса
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+class FileLocks:
+    """Именованные межпроцессные блокировки (flock на файл-замок в lock_dir).
+
+    Реентерабельны в пределах потока: вложенные вызовы методов, захватывающих ту же
+    блокировку, не зависают. Разные потоки одного процесса открывают файл отдельно,
+    поэтому flock разводит и их. Файл-замок ненужной больше блокировки удаляется через
+    discard; ожидавшие ее в этот момент перезахватывают замок на новом файле.
+    """
+
+    def __init__(self, lock_dir: Path):
+        self.lock_dir = Path(lock_dir)
+        self.lock_dir.mkdir(parents=True, exist_ok=True)
+        self._local = threading.local()
+        self._thread_locks = defaultdict(threading.RLock)
+
+    def _path(self, name: str) -> Path:
+        safe = "".join(c if c.isalnum() or c in "-_." else "_" for c in name)
+        return self.lock_dir / f"{safe}.lock"
+
+    def _acquire(self, name: str, blocking: bool = True) -> Optional[int]:
+        """Открытый и захваченный файл-замок; None — занят (только при blocking=False).
+
+        Пока ждали flock, файл могли удалить (discard): замок на удаленном файле уже никого
+        не разводит, поэтому проверяем, что путь ведет на тот же файл, и иначе берем заново.
+        """
+        path = self._path(name)
+        while True:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+                if os.stat(path).st_ino == os.fstat(fd).st_ino: return fd
+            except BlockingIOError:
+                os.close(fd)
+                return None
+            except FileNotFoundError:
+                pass
+            except BaseException:
+                os.close(fd)
+                raise
+            os.close(fd)
+
+    def discard(self, name: str):
+        """Удалить файл-замок, когда этот поток отпустит блокировку (вызывается под ней).
+
+        Файл удаляется до снятия flock, поэтому в критическую секцию никто не войдет раньше.
+        """
+        if fcntl is not None and name in (getattr(self._local, "held", None) or {}):
+            self._local.discard = getattr(self._local, "discard", set()) | {name}
+
+    @contextmanager
+    def hold(self, name: str):
+        held = getattr(self._local, "held", None)
+        if held is None:
+            held = self._local.held = {}
+        if name in held:
+            held[name] += 1
+            try: yield
+            finally: held[name] -= 1
+            return
+
+        if fcntl is None:
+            with self._thread_locks[name]:
+                held[name] = 1
+                try: yield
+                finally: del held[name]
+            return
+
+        fd = self._acquire(name)
+        try:
+            held[name] = 1
+            try: yield
+            finally:
+                del held[name]
+                discard = getattr(self._local, "discard", set())
+                if name in discard:
+                    discard.remove(name)
+                    self._path(name).unlink(missing_ok=True)
+                fcntl.flock(fd, fcntl.LOCK_UN)
+        finally:
+            os.close(fd)
+
+    @contextmanager
+    def try_hold(self, name: str):
+        """Неблокирующий захват: отдает True, если блокировка получена, иначе сразу False."""
+        if fcntl is None:
+            lock = self._thread_locks[name]
+            got = lock.acquire(blocking=False)
+            try: yield got
+            finally:
+                if got: lock.release()
+            return
+
+        fd = self._acquire(name, blocking=False)
+        if fd is None:
+            yield False
+            return
+        try:
+            try: yield True
+            finally: fcntl.flock(fd, fcntl.LOCK_UN)
+        finally:
+            os.close(fd)
+
+
+def atomic_write_text(path: Path, text: str):
+    """Запись через временный файл и os.replace: читатель видит либо старое, либо новое содержимое."""
+    tmp = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp, path)
@@ -0,0 +1,64 @@
+import os
+import re
+import json
+from typing import Dict, Optional, Tuple
+
+# Режим директора: separate — отдельный вызов flash до ответа (по умолчанию),
+# inline — вердикт возвращает сам основной вызов. Переопределяется полем
+# director_mode в сценарии или профиле правил.
+DIRECTOR_MODES = ("separate", "inline")
+DEFAULT_DIRECTOR_MODE = os.getenv("DIRECTOR_MODE", "separate").lower()
+
+PROTOCOL = (
+    "[DIRECTOR PROTOCOL]\n"
+    "Current plot goal: \"{goal}\"\n"
+    "Write your in-character reply as usual. Then, on the very last line, append exactly one block:\n"
+    "<director>{{\"progress\": true|false, \"stagnation_note\": \"...\"}}</director>\n"
+    "progress — did the latest exchange (your previous reply and the user's new message) make "
+    "significant progress towards the goal. stagnation_note — optional, one sentence on how to move "
+    "the plot forward if it is stuck; empty string otherwise. Never mention this block in the story.\n"
+)
+
+_BLOCK = re.compile(r"<director>(.*?)(?:</director>|$)", re.S | re.I)
+
+
+def resolve_mode(profile: Optional[Dict], scenario: Optional[Dict]) -> str:
+    """Сценарий важнее профиля правил, профиль — важнее DIRECTOR_MODE."""
+    for src in (scenario, profile):
+        mode = str((src or {}).get("director_mode", "")).lower()
+        if mode in DIRECTOR_MODES:
+            return mode
+    return DEFAULT_DIRECTOR_MODE if DEFAULT_DIRECTOR_MODE in DIRECTOR_MODES else "separate"
+
+
+def protocol_block(goal: str) -> str:
+    return PROTOCOL.format(goal=goal.replace('"', "'"))
+
+
+def parse_reply(raw: str) -> Tuple[str, Optional[Dict]]:
+    """Отделяет текст ответа от блока директора.
+
+    Возвращает (текст, вердикт) — вердикт None, если блока нет или его не удалось разобрать;
+    в этом случае вызывающий откатывается на отдельный вызов директора.
+    """
+    matches = list(_BLOCK.finditer(raw))
+    if not matches:
+        return raw.strip(), None
+    text = _BLOCK.sub("", raw).strip()
+    body = matches[-1].group(1).strip().strip("`")
+    if body.lower().startswith("json"): body = body[4:]
+
+    verdict: Optional[Dict] = None
+    try:
+        data = json.loads(body)
+        progress = data.get("progress")
+        if isinstance(progress, str):
+            progress = progress.strip().lower() in ("true", "yes", "1")
+        if isinstance(progress, bool):
+            verdict = {"progress": progress, "stagnation_note": str(data.get("stagnation_note") or "").strip()}
+    except (ValueError, AttributeError):
+        # Модель могла написать YES/NO или true/false без JSON
+        m = re.search(r"progress\W+(true|false|yes|no)\b", body, re.I) or re.fullmatch(r"\s*(true|false|yes|no)\s*", body, re.I)
+        if m:
+            verdict = {"progress": m.group(1).lower() in ("true", "yes"), "stagnation_note": ""}
+    return text, verdict
@@ -0,0 +1,231 @@
+import os
+import time
+import heapq
+import random
+import asyncio
+import hashlib
+import itertools
+from typing import List, Dict, Any, Optional, Callable
+
+from langchain_core.messages import BaseMessage
+
+from core.tracing import span, gauge_lines, STAGE_SECONDS, PROMPT_TOKENS, PROMPT_CHARS, LLM_TOKENS
+
+# Приоритетные полосы: чем меньше число, тем раньше обслуживается запрос
+PRIORITY_MAIN = 0        # основной ответ персонажа
+PRIORITY_AUX = 1         # директор, генерация заголовка
+PRIORITY_BACKGROUND = 2  # саммари и прочая фоновая работа
+
+PRIORITY_NAMES = {PRIORITY_MAIN: "main", PRIORITY_AUX: "aux", PRIORITY_BACKGROUND: "background"}
+
+# Признаки временных ошибок (rate limit / перегрузка), которые имеет смысл повторить
+RETRYABLE_MARKERS = ("429", "resource_exhausted", "resourceexhausted", "rate limit", "ratelimit",
+                     "quota", "503", "unavailable", "overloaded", "deadline", "timeout")
+
+
+def make_chat_model_factory() -> Callable[[str, float, str], Any]:
+    """Фабрика LLM-клиентов: Gemini по умолчанию, LLM_PROVIDER=fake — локальная заглушка."""
+    if os.getenv("LLM_PROVIDER", "gemini").lower() == "fake":
+        from core.fake_llm import FakeChatModel
+        return lambda model, temperature, api_key: FakeChatModel(model=model, temperature=temperature)
+
+    from langchain_google_genai import ChatGoogleGenerativeAI
+    # Ретраи делает планировщик, поэтому встроенные ретраи клиента отключаем
+    return lambda model, temperature, api_key: ChatGoogleGenerativeAI(
+        model=model, temperature=temperature, google_api_key=api_key, max_retries=1)
+
+
+def is_retryable(error: Exception) -> bool:
+    txt = f"{type(error).__name__} {error}".lower()
+    return any(m in txt for m in RETRYABLE_MARKERS)
+
+
+class _KeyLane:
+    """Token bucket + очередь ожидания для одного API-ключа."""
+
+    def __init__(self, burst: float):
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.active = 0
+        self.waiters: List = []  # heap: (priority, seq, future)
+        self.wake_handle: Optional[asyncio.TimerHandle] = None
+
+
+class LLMScheduler:
+    def __init__(
+        self, rate_per_min: Optional[float] = None, burst: Optional[int] = None,
+        max_concurrency: Optional[int] = None, max_retries: Optional[int] = None,
+        backoff_base: float = 1.0, backoff_max: float = 20.0,
+        model_factory: Optional[Callable[[str, float, str], Any]] = None
+    ):
+        # Лимиты — на процесс: воркеры gunicorn ведут свои token bucket'ы независимо
+        self.rate = (rate_per_min or float(os.getenv("LLM_RATE_PER_MIN", "60"))) / 60.0
+        self.burst = float(burst or int(os.getenv("LLM_BURST", "10")))
+        self.max_concurrency = max_concurrency or int(os.getenv("LLM_MAX_CONCURRENCY", "4"))
+        self.max_retries = max_retries if max_retries is not None else int(os.getenv("LLM_MAX_RETRIES", "3"))
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.model_factory = model_factory or make_chat_model_factory()
+
+        self._lanes: Dict[str, _KeyLane] = {}
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self._seq = itertools.count()
+
+        # Метрики
+        self.counters = {"requests": 0, "deduplicated": 0, "retries": 0, "failures": 0}
+        self.waits = {name: {"count": 0, "total": 0.0, "max": 0.0} for name in PRIORITY_NAMES.values()}
+
+    # ============================
+    # PUBLIC API
+    # ============================
+    async def invoke(self, model: str, temperature: float, messages: List[BaseMessage],
+                     api_key: str, priority: int = PRIORITY_MAIN):
+        """Выполняет запрос к LLM через очередь ключа. Одинаковые запросы в полете склеиваются."""
+        self.counters["requests"] += 1
+        key_id = hashlib.sha256((api_key or "").encode()).hexdigest()[:16]
+        req_key = self._request_key(model, temperature, key_id, messages)
+
+        shared = self._inflight.get(req_key)
+        if shared is not None:
+            self.counters["deduplicated"] += 1
+            return await asyncio.shield(shared)
+
+        task = asyncio.ensure_future(self._run(model, temperature, messages, api_key, key_id, priority))
+        self._inflight[req_key] = task
+        task.add_done_callback(lambda _: self._inflight.pop(req_key, None))
+        # shield: отмена одного из ожидающих не должна отменять общий запрос
+        return await asyncio.shield(task)
+
+    def stats(self) -> Dict[str, Any]:
+        depth = {name: 0 for name in PRIORITY_NAMES.values()}
+        active = 0
+        for lane in self._lanes.values():
+            active += lane.active
+            for prio, _, fut in lane.waiters:
+                if not fut.done():
+                    depth[PRIORITY_NAMES.get(prio, str(prio))] += 1
+        return {
+            **self.counters,
+            "keys": len(self._lanes),
+            "active": active,
+            "inflight": len(self._inflight),
+            "queue_depth": depth,
+            "wait_seconds": {k: dict(v) for k, v in self.waits.items()},
+        }
+
+    def prometheus_lines(self) -> List[str]:
+        st = self.stats()
+        lines = gauge_lines("llm_queue_depth", "Requests waiting for an LLM slot by priority lane",
+                            {(("lane", k),): v for k, v in st["queue_depth"].items()})
+        lines += gauge_lines("llm_active_requests", "LLM requests currently running", {(): st["active"]})
+        lines += gauge_lines("llm_scheduler_events", "Scheduler counters since start",
+                             {(("event", k),): st[k] for k in self.counters})
+        return lines
+
+    # ============================
+    # INTERNALS
+    # ============================
+    @staticmethod
+    def _request_key(model: str, temperature: float, key_id: str, messages: List[BaseMessage]) -> str:
+        h = hashlib.sha256(f"{model}|{temperature}|{key_id}".encode())
+        for m in messages:
+            h.update(b"\x00" + m.type.encode() + b"\x01" + str(m.content).encode())
+        return h.hexdigest()
+
+    async def _run(self, model: str, temperature: float, messages: List[BaseMessage],
+                   api_key: str, key_id: str, priority: int):
+        lane = self._lanes.setdefault(key_id, _KeyLane(self.burst))
+        attempt = 0
+        while True:
+            await self._acquire(lane, priority)
+            try:
+                llm = self.model_factory(model, temperature, api_key)
+                with span(f"llm:{model}", attempt=attempt):
+                    resp = await llm.ainvoke(messages)
+                self._record_usage(model, messages, resp)
+                return resp
+            except Exception as e:
+                if attempt >= self.max_retries or not is_retryable(e):
+                    self.counters["failures"] += 1
+                    raise
+                err = e
+            finally:
+                self._release(lane)
+
+            attempt += 1
+            self.counters["retries"] += 1
+            delay = min(self.backoff_max, self.backoff_base * (2 ** (attempt - 1)))
+            delay *= random.uniform(0.5, 1.0)
+            print(f"🔁 LLM retry {attempt}/{self.max_retries} in {delay:.1f}s ({model}): {err}")
+            await asyncio.sleep(delay)
+
+    @staticmethod
+    def _record_usage(model: str, messages: List[BaseMessage], resp: Any):
+        PROMPT_CHARS.observe(sum(len(str(m.content)) for m in messages), model=model)
+        usage = getattr(resp, "usage_metadata", None) or {}
+        if usage.get("input_tokens"):
+            PROMPT_TOKENS.observe(usage["input_tokens"], model=model)
+            LLM_TOKENS.inc(usage["input_tokens"], model=model, kind="input")
+        if usage.get("output_tokens"):
+            LLM_TOKENS.inc(usage["output_tokens"], model=model, kind="output")
+
+    def _take_token(self, lane: _KeyLane) -> bool:
+        now = time.monotonic()
+        lane.tokens = min(self.burst, lane.tokens + (now - lane.updated) * self.rate)
+        lane.updated = now
+        if lane.tokens >= 1.0:
+            lane.tokens -= 1.0
+            return True
+        return False
+
+    async def _acquire(self, lane: _KeyLane, priority: int):
+        started = time.monotonic()
+        if not lane.waiters and lane.active < self.max_concurrency and self._take_token(lane):
+            lane.active += 1
+        else:
+            fut = asyncio.get_running_loop().create_future()
+            heapq.heappush(lane.waiters, (priority, next(self._seq), fut))
+            self._dispatch(lane)
+            try:
+                await fut
+            except asyncio.CancelledError:
+                # Слот уже выдан, но задача отменена — возвращаем его
+                if fut.done() and not fut.cancelled():
+                    self._release(lane)
+                raise
+
+        lane_name = PRIORITY_NAMES.get(priority, "background")
+        w = self.waits[lane_name]
+        waited = time.monotonic() - started
+        STAGE_SECONDS.observe(waited, stage=f"llm_queue:{lane_name}")
+        w["count"] += 1
+        w["total"] += waited
+        w["max"] = max(w["max"], waited)
+
+    def _release(self, lane: _KeyLane):
+        lane.active -= 1
+        self._dispatch(lane)
+
+    def _dispatch(self, lane: _KeyLane):
+        while lane.waiters and lane.active < self.max_concurrency:
+            fut = lane.waiters[0][2]
+            if fut.done():  # ожидающий отменен
+                heapq.heappop(lane.waiters)
+                continue
+            if not self._take_token(lane):
+                self._schedule_wake(lane)
+                return
+            heapq.heappop(lane.waiters)
+            lane.active += 1
+            fut.set_result(None)
+
+    def _schedule_wake(self, lane: _KeyLane):
+        if lane.wake_handle and not lane.wake_handle.cancelled():
+            lane.wake_handle.cancel()
+        delay = max(0.0, (1.0 - lane.tokens) / self.rate)
+
+        def wake():
+            lane.wake_handle = None
+            self._dispatch(lane)
+
+        lane.wake_handle = asyncio.get_running_loop().call_later(delay, wake)
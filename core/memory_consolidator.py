@@ -0,0 +1,97 @@
+import os
+import asyncio
+from typing import List, Dict, Optional
+
+from langchain_core.messages import HumanMessage
+
+from core.rag_engine import RAGEngine, consolidated_until, turns_revision
+from core.llm_scheduler import LLMScheduler, PRIORITY_BACKGROUND
+from core.tracing import traced
+
+# Сколько ходов (или эпизодов уровня L) сворачиваются в один эпизод уровня L+1
+MEMORY_EPISODE_FANOUT = int(os.getenv("MEMORY_EPISODE_FANOUT", "8"))
+# Последние ходы остаются сырыми векторами; эпизоды уровня L сворачиваются дальше,
+# только когда старше KEEP_RECENT * FANOUT**L ходов. Число векторов растет ~логарифмически.
+MEMORY_KEEP_RECENT_TURNS = int(os.getenv("MEMORY_KEEP_RECENT_TURNS", "40"))
+
+
+class MemoryConsolidator:
+    def __init__(self, rag: RAGEngine, default_api_key: str, scheduler: Optional[LLMScheduler] = None,
+                 fanout: Optional[int] = None, keep_recent: Optional[int] = None):
+        self.rag = rag
+        self.default_api_key = default_api_key
+        self.llm = scheduler or LLMScheduler()
+        self.fanout = max(2, fanout or MEMORY_EPISODE_FANOUT)
+        self.keep_recent = MEMORY_KEEP_RECENT_TURNS if keep_recent is None else keep_recent
+
+    def plan(self, head: Dict) -> Optional[Dict]:
+        """Следующая группа для свертки: сначала сырые ходы, потом эпизоды по уровням."""
+        current = head.get("turns", 0)
+        episodes = sorted(head.get("episodes", []), key=lambda e: e["start"])
+
+        start = consolidated_until(episodes)
+        if current - self.keep_recent - start >= self.fanout:
+            return {"level": 1, "start": start, "end": start + self.fanout - 1, "children": []}
+
+        level = 1
+        while True:
+            horizon = current - self.keep_recent * self.fanout ** level
+            if horizon <= 0: return None
+            run: List[Dict] = []
+            for e in episodes:
+                if e["level"] != level or e["end"] >= horizon:
+                    run = []
+                    continue
+                run.append(e)
+                if len(run) == self.fanout:
+                    return {"level": level + 1, "start": run[0]["start"], "end": run[-1]["end"], "children": run}
+            level += 1
+
+    @traced("memory.consolidate")
+    async def consolidate(self, session_id: str, api_key: Optional[str] = None, max_steps: int = 4) -> int:
+        """Сворачивает до max_steps групп старой памяти в эпизоды. Возвращает число новых эпизодов."""
+        done = 0
+        while done < max_steps:
+            job = self.plan(await asyncio.to_thread(self.rag.get_session_head, session_id))
+            if not job or not await self._consolidate_one(session_id, job, api_key): break
+            done += 1
+        return done
+
+    async def _consolidate_one(self, session_id: str, job: Dict, api_key: Optional[str]) -> bool:
+        start, end, children = job["start"], job["end"], job["children"]
+        raw_ids: List[str] = []
+        revision = None
+        if children:
+            docs = await asyncio.to_thread(self.rag.get_vector_documents, [e["id"] for e in children])
+            lines = [docs[e["id"]] for e in children if e["id"] in docs]
+        else:
+            msgs = await asyncio.to_thread(self.rag.get_turns, session_id, start, end)
+            lines = [f"{'User' if m['role'] == 'user' else 'AI'}: {m['content']}" for m in msgs]
+            raw_ids = [m["vector_id"] for m in msgs if m.get("vector_id")]
+            revision = turns_revision(msgs)
+        if not lines: return False
+
+        summary = await self._summarize(lines, api_key)
+        if not summary: return False
+
+        # Вызовы RAGEngine ждут блокировку сессии — не в event loop
+        ep_id = await asyncio.to_thread(self.rag.store_episode, session_id, summary, start, end, job["level"])
+        if not ep_id: return False
+        episode = {"id": ep_id, "start": start, "end": end, "level": job["level"]}
+        return await asyncio.to_thread(self.rag.commit_episode, session_id, episode, [e["id"] for e in children],
+                                       raw_ids, revision)
+
+    async def _summarize(self, lines: List[str], api_key: Optional[str]) -> Optional[str]:
+        key_to_use = api_key if api_key else self.default_api_key
+        prompt = (
+            "Condense this part of a roleplay into a memory entry.\n"
+            f"EVENTS:\n{chr(10).join(lines)}\n"
+            "Keep names, places, decisions, promises and facts that may matter later. "
+            "Output a concise narrative (max 150 words)."
+        )
+        try:
+            res = await self.llm.invoke("gemini-2.5-flash", 0.2, [HumanMessage(content=prompt)], key_to_use, priority=PRIORITY_BACKGROUND)
+            return str(res.content).strip() or None
+        except Exception as e:
+            print(f"⚠️ Memory consolidation failed: {e}")
+            return None
@@ -1,29 +1,54 @@
 import os
-from typing import List, Dict, Any, Optional, Union
+import asyncio
+from typing import List, Dict, Any, Optional, Union, Sequence
 from dotenv import load_dotenv
-from langchain_google_genai import ChatGoogleGenerativeAI
-from langchain_core.messages import SystemMessage, HumanMessage, AIMessage, BaseMessage
+from langchain_core.messages import HumanMessage
 
 from core.rag_engine import RAGEngine
 from core.director import Director
 from core.summary_engine import SummaryEngine
+from core.memory_consolidator import MemoryConsolidator
+from core.result_cache import ResultCache
+from core.inline_director import resolve_mode, protocol_block, parse_reply
 from core.prompt_builder import PromptBuilder
+from core.context_assembler import ContextAssembler
+from core.llm_scheduler import LLMScheduler, PRIORITY_MAIN, PRIORITY_AUX
+from core.tracing import span, traced, annotate
 
 load_dotenv()
 
+# Сколько фрагментов памяти запрашивать; в промпт попадут те, что влезут в бюджет
+MEMORY_K = int(os.getenv("CONTEXT_MEMORY_K", "4"))
+# Раз в сколько ходов проверять лимиты векторной памяти сессии (0 — никогда)
+MEMORY_PRUNE_EVERY = int(os.getenv("MEMORY_PRUNE_EVERY", "25"))
+# Раз в сколько ходов сворачивать старую память в эпизоды (0 — никогда)
+MEMORY_CONSOLIDATE_EVERY = int(os.getenv("MEMORY_CONSOLIDATE_EVERY", "10"))
+
 class Orchestrator:
+    # Методы RAGEngine, работающие с файлами сессий, ждут межпроцессную блокировку (flock) и
+    # векторизуют текст — из async-кода они вызываются через asyncio.to_thread, чтобы
+    # не останавливать event loop воркера.
     def __init__(self):
         print("🎹 Orch Init...")
 
         self.default_key = os.getenv("GEMINI_API_KEY")
         self.rag = RAGEngine()
         self.builder = PromptBuilder()
-        self.director = Director(self.default_key or "")
-        self.summarizer = SummaryEngine(self.default_key or "")
-
+        self.assembler = ContextAssembler()
+        # Все вызовы LLM (ответ, директор, заголовок, саммари) идут через общий планировщик
+        self.llm = LLMScheduler()
+        # Вердикты директора и саммари для одинаковых входов не пересчитываются
+        self.result_cache = ResultCache()
+        self.director = Director(self.default_key or "", self.llm, self.result_cache)
+        self.summarizer = SummaryEngine(self.default_key or "", self.llm, self.result_cache)
+        self.consolidator = MemoryConsolidator(self.rag, self.default_key or "", self.llm)
+        # Фоновые задачи держим по ссылке, иначе их может собрать GC
+        self._bg_tasks = set()
+
+    @traced("generate_response", root=True)
     async def generate_response(
         self, text: str, sess_id: str, char_id: str, prof_id: str, 
-        user_p: Dict, scn_state: Optional[Dict] = None, chat_hist: Optional[List] = None, 
+        user_p: Dict, scn_state: Optional[Dict] = None, chat_hist: Optional[Sequence[Dict]] = None, 
         api_key: Optional[str] = None
     ) -> Dict:
         
@@ -32,8 +57,7 @@ class Orchestrator:
         if not key_to_use:
             return {"response": "[SYSTEM ERROR: Gemini API Key is missing. Please enter it in settings.]", "scenario_state": scn_state}
 
-        # Создаем инстанс LLM под конкретный запрос
-        main_llm = ChatGoogleGenerativeAI(model="gemini-2.5-pro", temperature=1.15, google_api_key=key_to_use)
+        annotate(session=sess_id)
 
         # 1. Data Fetch
         char = self.rag.get_character_data_raw(char_id)
@@ -42,6 +66,7 @@ class Orchestrator:
         # 2. Director
         scn_data = None
         guide = ""
+        goal = None
         new_scn = scn_state.copy() if scn_state else None
 
         if new_scn and new_scn.get('scenario_id'):
@@ -52,42 +77,66 @@ class Orchestrator:
                 if idx < len(pts):
                     goal = pts[idx].get('goal')
                     scn_data['current_plot_point'] = goal
-                    
-                    last_ai = chat_hist[-1]['content'] if chat_hist and chat_hist[-1]['role'] == 'ai' else ""
-                    if await self.director.check_progress(f"AI: {last_ai}\nUser: {text}", goal, api_key=key_to_use):
-                        new_scn['current_step'] += 1
-                        new_scn['fail_count'] = 0
-                    else:
-                        new_scn['fail_count'] = new_scn.get('fail_count', 0) + 1
-                        if new_scn['fail_count'] >= 3:
-                            guide = f"Plot stagnating. Force advancement towards: '{goal}'."
+
+        mode = resolve_mode(self.rag.get_rule_profile_raw(prof_id), scn_data) if goal else "separate"
+        last_ai = chat_hist[-1]['content'] if chat_hist and chat_hist[-1]['role'] == 'ai' else ""
+        exchange = f"AI: {last_ai}\nUser: {text}"
+        if goal and mode == "separate":
+            with span("orchestrator.director") as sp:
+                progressed = await self.director.check_progress(exchange, goal, api_key=key_to_use)
+                sp["progress"] = progressed
+            guide = self._advance_scenario(new_scn, progressed, goal)
+        elif goal:
+            # inline: вердикт по этому ходу придет вместе с ответом, застревание считаем по прошлым ходам
+            annotate(director_mode=mode)
+            if new_scn.get('fail_count', 0) >= 3:
+                guide = new_scn.get('stagnation_note') or f"Plot stagnating. Force advancement towards: '{goal}'."
 
         # 3. Context
-        sess = self.rag.get_session_state(sess_id)
-        mems = self.rag.get_relevant_history(sess_id, text)
-        sys_txt = self.builder.build(char, user_p, rules, scn_data or {}, sess.get("summary") or "", guide)
-
-        # 4. Messages
-        msgs: List[BaseMessage] = [SystemMessage(content=sys_txt)]
-        if mems: msgs.append(SystemMessage(content=f"### MEMORY ###\n{mems}"))
-        if chat_hist:
-            for m in chat_hist[-6:]:
-                if m["role"] == "user":
-                    msgs.append(HumanMessage(content=m["content"]))
-                else:
-                    msgs.append(AIMessage(content=m["content"]))
-        msgs.append(HumanMessage(content=text))
+        with span("orchestrator.session_load"):
+            sess = await asyncio.to_thread(self.rag.get_session_head, sess_id)
+        with span("orchestrator.memory_search") as sp:
+            turn = sess.get("turns", 0)
+            mems = await asyncio.to_thread(self.rag.get_relevant_memories, sess_id, text, k=MEMORY_K, current_turn=turn)
+            sp["hits"] = len(mems)
+        with span("orchestrator.prompt_build"):
+            # 4. Messages: системный промпт, саммари, память и история в пределах бюджета токенов.
+            # Из HistoryView берем только загруженный хвост — сборка не должна догружать весь файл
+            protocol = protocol_block(goal) if mode == "inline" else ""
+            ctx = self.assembler.assemble(
+                lambda summary: self.builder.build(char, user_p, rules, scn_data or {}, summary, guide) + protocol,
+                sess.get("summary") or "", mems, list(getattr(chat_hist, "tail", chat_hist) or []), text
+            )
+            sys_txt, msgs = ctx["system"], ctx["messages"]
+        annotate(system_chars=len(sys_txt), prompt_chars=sum(len(str(m.content)) for m in msgs),
+                 messages=len(msgs), context_tokens=ctx["tokens"], **ctx["included"])
 
         # 5. Generate
         try:
-            resp = await main_llm.ainvoke(msgs)
+            with span("orchestrator.llm_main"):
+                resp = await self.llm.invoke("gemini-2.5-pro", 1.15, msgs, key_to_use, priority=PRIORITY_MAIN)
             ai_text = str(resp.content)
+            annotate(**(getattr(resp, "usage_metadata", None) or {}))
         except Exception as e:
-            ai_text = f"[Error: {e}]"
+            # Ошибку не сохраняем в историю и не двигаем сценарий
+            return {"response": f"[Error: {e}]", "scenario_state": scn_state, "prompt": sys_txt, "error": True}
+
+        if mode == "inline":
+            ai_text, verdict = parse_reply(ai_text)
+            if verdict is None:
+                # Блок не разобрался — спрашиваем отдельного директора о том же ходе
+                with span("orchestrator.director_fallback") as sp:
+                    verdict = {"progress": await self.director.check_progress(exchange, goal, api_key=key_to_use)}
+                    sp["progress"] = verdict["progress"]
+            annotate(inline_verdict=verdict["progress"])
+            self._advance_scenario(new_scn, verdict["progress"], goal)
+            if not verdict["progress"] and verdict.get("stagnation_note"):
+                new_scn['stagnation_note'] = verdict["stagnation_note"]
 
         # 6. Store
-        vid = self.rag.store_interaction(sess_id, text, ai_text)
-        upd_state = self.rag.append_to_buffer(sess_id, text, ai_text, vid or "")
+        with span("orchestrator.store"):
+            vid = await asyncio.to_thread(self.rag.store_interaction, sess_id, text, ai_text, turn=turn)
+            upd_state = await asyncio.to_thread(self.rag.append_to_buffer, sess_id, text, ai_text, vid or "", scenario_state=new_scn)
         
         # Generate title from first message
         if upd_state["msg_count"] == 1 and not sess.get("title"):
@@ -95,56 +144,91 @@ class Orchestrator:
             if scn_data:
                 title_prompt += f"\nScenario: {scn_data.get('title', '')}"
             try:
-                title_llm = ChatGoogleGenerativeAI(model="gemini-2.0-flash-lite", temperature=0.7, google_api_key=key_to_use)
-                title_resp = await title_llm.ainvoke([HumanMessage(content=title_prompt)])
+                with span("orchestrator.title"):
+                    title_resp = await self.llm.invoke("gemini-2.0-flash-lite", 0.7, [HumanMessage(content=title_prompt)], key_to_use, priority=PRIORITY_AUX)
                 title = str(title_resp.content).strip().strip('"').strip("'").strip('*').strip()
-                upd_state["title"] = title
-                self.rag.save_session_state(sess_id, upd_state)
+                upd_state = await asyncio.to_thread(self.rag.update_session_head, sess_id, title=title)
             except:
                 pass
         
-        if len(upd_state["buffer"]) >= 6:
-            new_sum = await self.summarizer.update(sess.get("summary") or "", upd_state["buffer"], api_key=key_to_use)
-            self.rag.update_session_summary(sess_id, new_sum)
-
-        return {"response": ai_text, "scenario_state": new_scn, "prompt": sys_txt}
+        # Периодически подрезаем память сессии по лимиту/TTL
+        if MEMORY_PRUNE_EVERY and (turn + 1) % MEMORY_PRUNE_EVERY == 0:
+            with span("orchestrator.memory_prune"):
+                await asyncio.to_thread(self.rag.prune_session_vectors, sess_id)
 
+        if len(upd_state["buffer"]) >= 6:
+            with span("orchestrator.summary"):
+                new_sum = await self.summarizer.update(sess.get("summary") or "", upd_state["buffer"], api_key=key_to_use)
+                await asyncio.to_thread(self.rag.update_session_summary, sess_id, new_sum)
+
+        # Свертка старой памяти в эпизоды — в фоне, ответ ее не ждет
+        if MEMORY_CONSOLIDATE_EVERY and (turn + 1) % MEMORY_CONSOLIDATE_EVERY == 0:
+            task = asyncio.create_task(self.consolidator.consolidate(sess_id, api_key=key_to_use))
+            self._bg_tasks.add(task)
+            task.add_done_callback(self._bg_tasks.discard)
+
+        return {"response": ai_text, "scenario_state": new_scn, "prompt": sys_txt, "title": upd_state.get("title")}
+
+    @staticmethod
+    def _advance_scenario(scn: Dict, progressed: bool, goal: str) -> str:
+        """Двигает сценарий по вердикту директора. Возвращает указание для промпта при застревании."""
+        if progressed:
+            scn['current_step'] = scn.get('current_step', 0) + 1
+            scn['fail_count'] = 0
+            scn.pop('stagnation_note', None)
+            return ""
+        scn['fail_count'] = scn.get('fail_count', 0) + 1
+        if scn['fail_count'] >= 3:
+            return f"Plot stagnating. Force advancement towards: '{goal}'."
+        return ""
+
+    @traced("regenerate_last_message", root=True)
     async def regenerate_last_message(self, sess_id: str, char_id: str, prof_id: str, user_p: Dict, scn_state: Optional[Dict], api_key: Optional[str] = None):
-        """Регенерация последнего ответа ИИ."""
+        """Регенерация последнего ответа ИИ. Возвращает ответ и итоговые варианты сообщения (index, count, selected)."""
         key_to_use = api_key if api_key else self.default_key
         if not key_to_use:
             return None
 
-        main_llm = ChatGoogleGenerativeAI(model="gemini-2.5-pro", temperature=1.15, google_api_key=key_to_use)
-
-        sess = self.rag.get_session_state(sess_id)
-        hist = sess["full_history"]
+        annotate(session=sess_id)
+        with span("orchestrator.session_load"):
+            sess = await asyncio.to_thread(self.rag.get_session_window, sess_id)
+        hist = sess["history"]
         if not hist or hist[-1]["role"] != "ai": return None
         
         # Получаем контекст БЕЗ последнего сообщения
         # User message, которое триггернуло ответ
         last_user_idx = len(hist) - 2
         last_user_txt = hist[last_user_idx]["content"]
+        # История до этой реплики — только из загруженного хвоста, без чтения всего файла
+        context_hist = hist.tail[:max(0, len(hist.tail) - 2)]
         
         char = self.rag.get_character_data_raw(char_id)
         rules = self.rag.get_rules_raw(prof_id)
         scn_data = self.rag.get_scenario_data_raw(scn_state['scenario_id']) if scn_state else None
         
-        sys_txt = self.builder.build(char, user_p, rules, scn_data or {}, sess.get("summary") or "", "")
-        
-        msgs: List[BaseMessage] = [SystemMessage(content=sys_txt)]
-        # История до последнего хода
-        short_hist = hist[-6:-1] 
-        for m in short_hist:
-             cls = HumanMessage if m["role"] == "user" else AIMessage
-             msgs.append(cls(content=m["content"]))
+        with span("orchestrator.prompt_build"):
+            # История до последнего хода; реплика пользователя, которая его вызвала, идет последней
+            ctx = self.assembler.assemble(
+                lambda summary: self.builder.build(char, user_p, rules, scn_data or {}, summary, ""),
+                sess.get("summary") or "", [], context_hist, last_user_txt
+            )
+            sys_txt, msgs = ctx["system"], ctx["messages"]
+        annotate(system_chars=len(sys_txt), prompt_chars=sum(len(str(m.content)) for m in msgs),
+                 messages=len(msgs), context_tokens=ctx["tokens"], **ctx["included"])
         
         # Вызов
-        resp = await main_llm.ainvoke(msgs)
+        try:
+            with span("orchestrator.llm_main"):
+                resp = await self.llm.invoke("gemini-2.5-pro", 1.15, msgs, key_to_use, priority=PRIORITY_MAIN)
+            annotate(**(getattr(resp, "usage_metadata", None) or {}))
+        except Exception as e:
+            print(f"❌ Regenerate Error: {e}")
+            return None
         new_text = str(resp.content)
         
         # Сохранение как кандидата
         last_idx = len(hist) - 1
-        self.rag.add_candidate_response(sess_id, last_idx, new_text)
+        with span("orchestrator.store"):
+            variants = await asyncio.to_thread(self.rag.add_candidate_response, sess_id, last_idx, new_text)
         
-        return new_text
\ No newline at end of file
+        return {"response": new_text, "variants": variants or None}
\ No newline at end of file
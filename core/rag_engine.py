@@ -1,49 +1,236 @@
+import os
 import json
+import math
+import time
 import uuid
 import shutil
+import hashlib
+import threading
+import functools
 from pathlib import Path
-from typing import List, Dict, Any, Optional
+from collections import OrderedDict
+from collections.abc import Sequence
+from typing import List, Dict, Any, Optional, Callable, Iterable, Iterator, Tuple
 
 from dotenv import load_dotenv
 from langchain_huggingface import HuggingFaceEmbeddings
 from langchain_chroma import Chroma
 from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+
+from core.tracing import span, traced
+from core.tokenizer import count_tokens
+from core.archive import pack, unpack, encode_vector, decode_vector
+from core.file_lock import FileLocks, atomic_write_text
 
 load_dotenv()
 
 BASE_DIR = Path(__file__).resolve().parent.parent
 DATA_DIR = BASE_DIR / "data"
-CHROMA_DB_DIR = BASE_DIR / "chroma_db"
+# Пути хранилища можно переопределить (нагрузочные тесты пишут во временную папку)
+CHROMA_DB_DIR = Path(os.getenv("CHROMA_DB_DIR", BASE_DIR / "chroma_db"))
+SESSIONS_DIR = Path(os.getenv("SESSIONS_DIR", DATA_DIR / "sessions"))
 EMBEDDING_MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
+# Хранилище векторов истории: chroma (HNSW в памяти) или int8 (компактные memmap-шарды по сессиям)
+HISTORY_VECTOR_TIER = os.getenv("HISTORY_VECTOR_TIER", "chroma").lower()
+VECTOR_STORE_DIR = Path(os.getenv("VECTOR_STORE_DIR", BASE_DIR / "vector_store"))
+# Chroma-сервер: обязателен для tier=chroma при нескольких процессах (локальная база не терпит
+# конкурентных писателей)
+CHROMA_HOST = os.getenv("CHROMA_HOST")
+CHROMA_PORT = int(os.getenv("CHROMA_PORT", "8000"))
+
+# Сколько последних сообщений читается с диска на один ход чата
+HISTORY_WINDOW = int(os.getenv("HISTORY_WINDOW", "50"))
+HISTORY_READ_BLOCK = 64 * 1024
+# Индекс смещений строк истории (для страниц из середины): опорная точка каждые N строк,
+# в памяти процесса — для стольких недавно листавшихся сессий
+HISTORY_MARK_EVERY = 256
+HISTORY_MARK_SESSIONS = 1024
+
+# Память диалога: вклад свежести в ранжирование и период полураспада (в ходах)
+MEMORY_RECENCY_WEIGHT = float(os.getenv("MEMORY_RECENCY_WEIGHT", "0.3"))
+MEMORY_HALF_LIFE_TURNS = float(os.getenv("MEMORY_HALF_LIFE_TURNS", "50"))
+# Во сколько раз больше кандидатов достаем из Chroma перед переранжированием
+MEMORY_FETCH_FACTOR = 4
+# Лимиты на векторы одной сессии (0 — без ограничения)
+MEMORY_MAX_VECTORS = int(os.getenv("MEMORY_MAX_VECTORS", "500"))
+MEMORY_TTL_DAYS = float(os.getenv("MEMORY_TTL_DAYS", "0"))
+# Сборка осиротевших векторов: размер батча удаления и «возраст», младше которого вектор
+# не трогаем (он мог быть записан ходом, который еще не сохранил историю)
+VECTOR_GC_BATCH = int(os.getenv("VECTOR_GC_BATCH", "500"))
+VECTOR_GC_GRACE_S = float(os.getenv("VECTOR_GC_GRACE_S", "600"))
+# Варианты ответа (свайпы): сколько хранить на сообщение, лишние невыбранные вытесняются по LRU
+CANDIDATE_MAX_VARIANTS = int(os.getenv("CANDIDATE_MAX_VARIANTS", "10"))
+# Экспорт сессий: сообщений/векторов в одной записи потока
+EXPORT_PAGE_SIZE = int(os.getenv("EXPORT_PAGE_SIZE", "256"))
+
+class TracedEmbeddings(Embeddings):
+    """Обертка над моделью эмбеддингов, чтобы время векторизации было видно отдельной стадией."""
+
+    def __init__(self, inner: Embeddings):
+        self.inner = inner
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        with span("embedding.documents", n=len(texts)):
+            return self.inner.embed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        with span("embedding.query"):
+            return self.inner.embed_query(text)
+
+
+ARCHIVE_INDEX_LOCK = "_archive_index"
+# Недописанная при импорте история: переименовывается в .history.jsonl в конце сессии
+IMPORT_SUFFIX = ".history.jsonl.importing"
+# Журнал замены хвоста истории: пока он есть, замена не доведена до конца
+TAIL_JOURNAL_SUFFIX = ".history.jsonl.tail"
+
+CATALOG_FILES = {
+    "characters": "characters.json",
+    "rules": "rules.json",
+    "scenarios": "scenarios.json",
+    "rule_profiles": "rule_profiles.json",
+}
+
+# Модель эмбеддингов и каталоги, загруженные до fork (gunicorn --preload):
+# воркеры получают их страницы памяти общими, а не грузят каждый свою копию
+_SHARED: Dict[str, Any] = {}
+
+
+def preload_shared():
+    if "embeddings" not in _SHARED:
+        _SHARED["embeddings"] = HuggingFaceEmbeddings(model_name=EMBEDDING_MODEL_NAME)
+        _SHARED["catalog"] = {key: RAGEngine._load_json(name) for key, name in CATALOG_FILES.items()}
+
+
+def locked(fn):
+    """Метод выполняется под межпроцессной блокировкой сессии (первый аргумент — ее id)."""
+    @functools.wraps(fn)
+    def wrapper(self, session_id, *args, **kwargs):
+        with self.locks.hold(session_id):
+            self._recover_history_tail(session_id)
+            return fn(self, session_id, *args, **kwargs)
+    return wrapper
+
+
+def interaction_text(user_text: str, ai_text: str) -> str:
+    """Документ вектора одного хода; единый формат для store_interaction и перевекторизации."""
+    return f"User: {user_text}\nAI: {ai_text}"
+
+
+def assign_turns(history: List[Dict], first: int = 0) -> int:
+    """Проставляет сообщениям номера ходов по ролям. Возвращает номер следующего хода.
+
+    Реплика пользователя открывает ход, ответ ИИ попадает в ход предыдущей реплики. После
+    удаления одиночного ответа реплика без ответа остается отдельным ходом, поэтому номер хода
+    нельзя выводить из четности индекса сообщения.
+    """
+    turn, prev = first - 1, None
+    for m in history:
+        if m["role"] == "user" or prev != "user": turn += 1
+        m["turn"] = turn
+        prev = m["role"]
+    return turn + 1
+
+
+def interaction_pairs(history: List[Dict]) -> Iterator[Tuple[Dict, Dict]]:
+    """Пары (реплика пользователя, ответ ИИ на нее) — то, что векторизуется как один ход."""
+    for prev, msg in zip(history, history[1:]):
+        if msg["role"] == "ai" and prev["role"] == "user": yield prev, msg
+
+
+def next_turn(history: List[Dict]) -> int:
+    """Номер хода, который получит следующая пара сообщений."""
+    return history[-1]["turn"] + 1 if history else 0
+
+
+def turns_revision(msgs: List[Dict]) -> str:
+    """Отпечаток сообщений диапазона ходов: меняется от правки, свайпа и отката с дозаписью."""
+    key = [(m["index"], m["role"], m["content"], m.get("vector_id")) for m in msgs]
+    return hashlib.sha256(json.dumps(key, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+def consolidated_until(episodes: List[Dict]) -> int:
+    """Первый ход, еще не свернутый в эпизод памяти."""
+    return max((e["end"] + 1 for e in episodes), default=0)
+
+
+class HistoryView(Sequence):
+    """История сессии, из которой загружен только хвост.
+
+    Обращение к сообщениям вне хвоста один раз подгружает полную историю через loader.
+    """
+
+    def __init__(self, loader: Optional[Callable[[], List[Dict]]], tail: List[Dict], total: int):
+        self.loader = loader
+        self.tail = tail
+        self.total = total
+        self._all: Optional[List[Dict]] = None
+
+    def __len__(self) -> int:
+        return self.total
+
+    def _full(self) -> List[Dict]:
+        if self._all is None:
+            if self.loader is None: raise IndexError("history index outside of loaded window")
+            self._all = self.loader()
+        return self._all
+
+    def __getitem__(self, i):
+        offset = self.total - len(self.tail)
+        if isinstance(i, slice):
+            start, stop, step = i.indices(self.total)
+            if step == 1 and start >= offset:
+                return self.tail[start - offset:max(start, stop) - offset]
+            return self._full()[i]
+        if i < 0: i += self.total
+        if not 0 <= i < self.total: raise IndexError("history index out of range")
+        return self.tail[i - offset] if i >= offset else self._full()[i]
+
 
 class RAGEngine:
     def __init__(self):
         print("⚙️ RAG Engine Init...")
-        self.embeddings = HuggingFaceEmbeddings(model_name=EMBEDDING_MODEL_NAME)
+        self.embeddings = TracedEmbeddings(_SHARED.get("embeddings") or HuggingFaceEmbeddings(model_name=EMBEDDING_MODEL_NAME))
         
         # Коллекция векторов истории (Память диалога)
-        self.history_collection = Chroma(
-            persist_directory=str(CHROMA_DB_DIR),
-            embedding_function=self.embeddings,
-            collection_name="history_collection"
-        )
+        if HISTORY_VECTOR_TIER == "int8":
+            from core.vector_tier import CompactVectorStore
+            self.history_collection = CompactVectorStore(VECTOR_STORE_DIR, self.embeddings)
+        elif CHROMA_HOST:
+            import chromadb
+            self.history_collection = Chroma(
+                client=chromadb.HttpClient(host=CHROMA_HOST, port=CHROMA_PORT),
+                embedding_function=self.embeddings,
+                collection_name="history_collection"
+            )
+        else:
+            self.history_collection = Chroma(
+                persist_directory=str(CHROMA_DB_DIR),
+                embedding_function=self.embeddings,
+                collection_name="history_collection"
+            )
         
         # Кэш статических данных
-        self.cache = {
-            "characters": self._load_json("characters.json"),
-            "rules": self._load_json("rules.json"),
-            "scenarios": self._load_json("scenarios.json"),
-            "rule_profiles": self._load_json("rule_profiles.json")
-        }
+        self.cache = _SHARED.get("catalog") or {key: self._load_json(name) for key, name in CATALOG_FILES.items()}
         
         # Маппинг профилей правил
         self.profile_map = {p["profile_id"]: p["rule_ids"] for p in self.cache["rule_profiles"]}
 
         # Папка сессий
-        self.sessions_dir = DATA_DIR / "sessions"
+        self.sessions_dir = SESSIONS_DIR
         self.sessions_dir.mkdir(parents=True, exist_ok=True)
+        # Холодный уровень: сжатые архивы давно неактивных сессий
+        self.archive_dir = self.sessions_dir / "archive"
+        self.archive_dir.mkdir(exist_ok=True)
+        # Блокировки сессий и индекса архива — общие для всех процессов на этой папке
+        self.locks = FileLocks(self.sessions_dir / ".locks")
+        # Сессия → байтовые смещения строк 0, N, 2N... истории (см. _line_offset)
+        self._history_marks: "OrderedDict[str, List[int]]" = OrderedDict()
+        self._marks_lock = threading.Lock()
 
-    def _load_json(self, filename: str) -> List[Dict]:
+    @staticmethod
+    def _load_json(filename: str) -> List[Dict]:
         path = DATA_DIR / filename
         if not path.exists(): return []
         try:
@@ -75,21 +262,29 @@ class RAGEngine:
         # Возвращаем полные объекты правил (с категорией и текстом)
         return [r for r in self.cache["rules"] if r["rule_id"] in ids]
 
+    def get_rule_profile_raw(self, profile_id: str) -> Dict:
+        return next((p for p in self.cache["rule_profiles"] if p["profile_id"] == profile_id), {})
+
     def get_scenario_data_raw(self, scenario_id: str) -> Dict:
         return next((s for s in self.cache["scenarios"] if s["id"] == scenario_id), {})
 
     # ============================
     # 2. VECTOR MEMORY (CHROMA)
     # ============================
-    def store_interaction(self, session_id: str, user_text: str, ai_text: str) -> Optional[str]:
+    def _now(self) -> float:
+        """Монотонная метка времени: строго возрастает даже при одинаковом time.time()."""
+        self._last_ts = max(time.time(), getattr(self, "_last_ts", 0.0) + 1e-6)
+        return self._last_ts
+
+    @traced("rag.store_interaction")
+    def store_interaction(self, session_id: str, user_text: str, ai_text: str, turn: Optional[int] = None) -> Optional[str]:
         if not session_id: return None
         doc_id = str(uuid.uuid4())
-        content = f"User: {user_text}\nAI: {ai_text}"
+        content = interaction_text(user_text, ai_text)
         
-        doc = Document(
-            page_content=content,
-            metadata={"session_id": session_id, "type": "interaction", "timestamp": str(uuid.uuid4())}
-        )
+        meta = {"session_id": session_id, "type": "interaction", "timestamp": self._now()}
+        if turn is not None: meta["turn"] = turn
+        doc = Document(page_content=content, metadata=meta)
         try:
             self.history_collection.add_documents([doc], ids=[doc_id])
             return doc_id
@@ -97,13 +292,33 @@ class RAGEngine:
             print(f"❌ Vector Store Error: {e}")
             return None
 
-    def get_relevant_history(self, session_id: str, query: str, k: int = 3) -> str:
-        if not session_id: return ""
+    @traced("rag.get_relevant_memories")
+    def get_relevant_memories(self, session_id: str, query: str, k: int = 3, current_turn: Optional[int] = None) -> List[str]:
+        """Похожие фрагменты памяти, переранжированные с учетом свежести (затухание по ходам)."""
+        if not session_id: return []
         try:
-            results = self.history_collection.similarity_search(query, k=k, filter={"session_id": session_id})
-            return "\n".join([f"Memory {i+1}: {d.page_content.replace(chr(10), ' ')}" for i, d in enumerate(results)])
-        except: return ""
+            results = self.history_collection.similarity_search_with_relevance_scores(
+                query, k=k * MEMORY_FETCH_FACTOR, filter={"session_id": session_id})
+        except: return []
+        if not results: return []
+
+        turns = [d.metadata.get("turn") for d, _ in results]
+        now = current_turn if current_turn is not None else max((t for t in turns if t is not None), default=0)
+        decay = math.log(2) / max(MEMORY_HALF_LIFE_TURNS, 1e-6)
+
+        def score(i: int) -> float:
+            # Векторы без номера хода (до миграции) считаем самыми старыми
+            age = max(0, now - (turns[i] if turns[i] is not None else 0))
+            return (1 - MEMORY_RECENCY_WEIGHT) * results[i][1] + MEMORY_RECENCY_WEIGHT * math.exp(-decay * age)
+
+        ranked = sorted(range(len(results)), key=score, reverse=True)[:k]
+        return [results[i][0].page_content for i in ranked]
+
+    def get_relevant_history(self, session_id: str, query: str, k: int = 3) -> str:
+        mems = self.get_relevant_memories(session_id, query, k)
+        return "\n".join([f"Memory {i+1}: {m.replace(chr(10), ' ')}" for i, m in enumerate(mems)])
 
+    @traced("rag.delete_vectors")
     def delete_vectors(self, vector_ids: List[str]):
         valid_ids = [v for v in vector_ids if v]
         if valid_ids:
@@ -113,57 +328,445 @@ class RAGEngine:
             except Exception as e:
                 print(f"Vector delete error: {e}")
 
+    @traced("rag.prune_session_vectors")
+    def prune_session_vectors(self, session_id: str, max_vectors: Optional[int] = None, ttl_days: Optional[float] = None) -> int:
+        """Удаляет векторы сессии старше TTL и самые старые малоценные сверх лимита.
+
+        Малоценные — самые короткие обмены среди самых старых кандидатов.
+        """
+        max_vectors = MEMORY_MAX_VECTORS if max_vectors is None else max_vectors
+        ttl_days = MEMORY_TTL_DAYS if ttl_days is None else ttl_days
+        try:
+            got = self.history_collection.get(where={"session_id": session_id}, include=["metadatas", "documents"])
+        except Exception as e:
+            print(f"Vector prune error: {e}")
+            return 0
+
+        # Эпизоды (свернутая память) не вытесняем
+        items = sorted(
+            [x for x in zip(got["ids"], got["metadatas"], got["documents"]) if x[1].get("type") != "episode"],
+            key=lambda x: (x[1].get("turn", -1), x[1].get("timestamp") if isinstance(x[1].get("timestamp"), float) else 0.0)
+        )
+        evict: List[str] = []
+        if ttl_days > 0:
+            cutoff = time.time() - ttl_days * 86400
+            expired = {i[0] for i in items if isinstance(i[1].get("timestamp"), float) and i[1]["timestamp"] < cutoff}
+            evict += list(expired)
+            items = [i for i in items if i[0] not in expired]
+
+        excess = len(items) - max_vectors if max_vectors > 0 else 0
+        if excess > 0:
+            oldest = items[:excess * 2]
+            evict += [i[0] for i in sorted(oldest, key=lambda x: len(x[2] or ""))[:excess]]
+
+        if evict: self.delete_vectors(evict)
+        return len(evict)
+
+    @traced("rag.backfill_vector_metadata")
+    def backfill_vector_metadata(self, session_id: str) -> int:
+        """Миграция: проставляет turn и возрастающие timestamp векторам по порядку full_history."""
+        hist = self.get_session_state(session_id)["full_history"]
+        by_vid = {m["vector_id"]: m["turn"] for m in hist if m.get("vector_id")}
+        if not by_vid: return 0
+        got = self.history_collection.get(ids=list(by_vid), include=["metadatas"])
+        if not got["ids"]: return 0
+
+        # Порядок ходов сохраняем, а «возраст» отсчитываем назад от последнего изменения сессии
+        head_path = self._head_path(session_id)
+        end = head_path.stat().st_mtime if head_path.exists() else time.time()
+        last_turn = max(by_vid.values())
+        metas = []
+        for vid, meta in zip(got["ids"], got["metadatas"]):
+            turn = by_vid[vid]
+            metas.append({**meta, "turn": turn, "timestamp": end - (last_turn - turn)})
+        self.history_collection._collection.update(ids=got["ids"], metadatas=metas)
+        return len(metas)
+
+    @traced("rag.repair_interaction_documents")
+    @locked
+    def repair_interaction_documents(self, session_id: str) -> int:
+        """Миграция: документы ходов, перевекторизованные с буквальным "\\n" вместо перевода строки.
+
+        Такой документ переписывается текстом хода из истории и векторизуется заново.
+        """
+        hist = self.get_session_state(session_id)["full_history"]
+        texts = {ai["vector_id"]: interaction_text(user["content"], ai["content"])
+                 for user, ai in interaction_pairs(hist) if ai.get("vector_id")}
+        if not texts: return 0
+        got = self.history_collection.get(ids=list(texts), include=["documents", "metadatas"])
+        broken = [(vid, meta) for vid, doc, meta in zip(got["ids"], got["documents"], got["metadatas"])
+                  if doc != texts[vid] and (doc or "").replace("\\nAI: ", "\nAI: ") == texts[vid]]
+        if not broken: return 0
+        ids, docs = [vid for vid, _ in broken], [texts[vid] for vid, _ in broken]
+        self.history_collection._collection.upsert(
+            ids=ids, embeddings=self.embeddings.embed_documents(docs), documents=docs,
+            metadatas=[meta for _, meta in broken],
+        )
+        return len(ids)
+
     # ============================
     # 3. SESSION MANAGEMENT (JSON)
     # ============================
+    def _head_path(self, session_id: str) -> Path:
+        return self.sessions_dir / f"{session_id}.json"
+
+    def _history_path(self, session_id: str) -> Path:
+        return self.sessions_dir / f"{session_id}.history.jsonl"
+
+    def _write_head(self, session_id: str, head: Dict):
+        atomic_write_text(self._head_path(session_id), json.dumps(head, ensure_ascii=False, indent=2))
+
+    def _write_history(self, session_id: str, messages: List[Dict], mode: str = 'w'):
+        lines = "".join(json.dumps(m, ensure_ascii=False) + "\n" for m in messages)
+        if mode == 'w':
+            atomic_write_text(self._history_path(session_id), lines)
+            return
+        with open(self._history_path(session_id), mode, encoding='utf-8') as f:
+            f.write(lines)
+
+    def _tail_offset(self, session_id: str, n: int) -> int:
+        """Байтовое смещение, с которого начинаются последние n строк истории."""
+        path = self._history_path(session_id)
+        if not path.exists(): return 0
+        with open(path, 'rb') as f:
+            f.seek(0, 2)
+            pos = f.tell()
+            # Последний символ файла — перевод строки, его не считаем
+            seen = -1
+            while pos > 0:
+                step = min(HISTORY_READ_BLOCK, pos)
+                pos -= step
+                f.seek(pos)
+                block = f.read(step)
+                for i in range(len(block) - 1, -1, -1):
+                    if block[i] == 0x0A:
+                        seen += 1
+                        if seen == n: return pos + i + 1
+        return 0
+
+    def _read_history(self, session_id: str, last: Optional[int] = None) -> List[Dict]:
+        path = self._history_path(session_id)
+        if not path.exists(): return []
+        offset = self._tail_offset(session_id, last) if last is not None else 0
+        with open(path, 'r', encoding='utf-8') as f:
+            f.seek(offset)
+            return [json.loads(line) for line in f if line.strip()]
+
+    def _line_offset(self, session_id: str, line: int) -> int:
+        """Байтовое смещение строки line истории: от ближайшей опорной точки, а не с конца файла.
+
+        Опорные точки копятся в памяти по мере чтения. Перед использованием точка проверяется
+        по полю index сообщения в ней: история могла быть переписана (в том числе другим
+        процессом), и тогда индекс строится заново.
+        """
+        with self._marks_lock:
+            marks = self._history_marks.pop(session_id, None) or [0]
+        k = min(line // HISTORY_MARK_EVERY, len(marks) - 1)
+        with open(self._history_path(session_id), 'rb') as f:
+            if k:
+                f.seek(marks[k])
+                try: msg = json.loads(f.readline())
+                except ValueError: msg = None
+                if not isinstance(msg, dict) or msg.get("index") != k * HISTORY_MARK_EVERY:
+                    marks, k = [0], 0
+            pos, cur = marks[k], k * HISTORY_MARK_EVERY
+            f.seek(pos)
+            while cur < line:
+                raw = f.readline()
+                if not raw: break
+                pos, cur = pos + len(raw), cur + 1
+                if cur == len(marks) * HISTORY_MARK_EVERY: marks.append(pos)
+        with self._marks_lock:
+            self._history_marks[session_id] = marks
+            while len(self._history_marks) > HISTORY_MARK_SESSIONS:
+                self._history_marks.popitem(last=False)
+        return pos
+
+    def _read_history_range(self, session_id: str, start: int, stop: int) -> List[Dict]:
+        """Сообщения [start, stop): разбираются только они, хвост после stop не читается."""
+        path = self._history_path(session_id)
+        if not path.exists() or start >= stop: return []
+        msgs: List[Dict] = []
+        with open(path, 'r', encoding='utf-8') as f:
+            f.seek(self._line_offset(session_id, start))
+            for line in f:
+                if not line.strip(): continue
+                msgs.append(json.loads(line))
+                if len(msgs) == stop - start: break
+        return msgs
+
+    def _read_history_locked(self, session_id: str) -> List[Dict]:
+        with self.locks.hold(session_id):
+            self._recover_history_tail(session_id)
+            return self._read_history(session_id)
+
+    def _load_head(self, session_id: str) -> Optional[Dict]:
+        path = self._head_path(session_id)
+        # Архивная сессия прозрачно распаковывается при первом обращении
+        if not path.exists() and not self._rehydrate(session_id): return None
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                head = json.load(f)
+        except: return None
+
+        # Старый формат: вся история внутри json — переносим в .history.jsonl
+        if "full_history" in head:
+            hist = head.pop("full_history")
+            head["history_len"] = len(hist)
+            self._write_history(session_id, hist)
+            self._write_head(session_id, head)
+        # История без номеров ходов: проставляем их один раз по ролям сообщений
+        if "turns" not in head:
+            hist = self._read_history(session_id) if head.get("history_len") else []
+            head["turns"] = assign_turns(hist)
+            if hist: self._write_history(session_id, hist)
+            self._write_head(session_id, head)
+        return head
+
+    @traced("rag.get_session_head")
+    @locked
+    def get_session_head(self, session_id: str) -> Dict:
+        """Стейт сессии без истории (мета, саммари, буфер, счетчики)."""
+        head = self._load_head(session_id)
+        if head is None:
+            return {"summary": "", "buffer": [], "msg_count": 0, "history_len": 0, "turns": 0}
+        head.setdefault("history_len", 0)
+        return head
+
+    @traced("rag.get_session_window")
+    @locked
+    def get_session_window(self, session_id: str, tail: Optional[int] = None) -> Dict:
+        """Мета + последние `tail` сообщений; остальная история догружается лениво."""
+        head = self.get_session_head(session_id)
+        total = head["history_len"]
+        msgs = self._read_history(session_id, min(total, tail or HISTORY_WINDOW)) if total else []
+        # Хвост не совпал с заголовком (например, запись прервалась) — читаем всё
+        if msgs and msgs[-1].get("index") != total - 1:
+            msgs = self._read_history(session_id)
+            total = head["history_len"] = len(msgs)
+        head["history"] = HistoryView(lambda: self._read_history_locked(session_id), msgs, total)
+        return head
+
+    @traced("rag.get_session_page")
+    @locked
+    def get_session_page(self, session_id: str, before: Optional[int] = None,
+                         limit: Optional[int] = None, since: Optional[int] = None) -> Dict:
+        """Мета + сообщения с индексами [since, before), не больше limit последних из них."""
+        # Только метаданные архивной сессии — отдаем из индекса, не распаковывая архив
+        if limit == 0 and not self._head_path(session_id).exists():
+            if archived := self.get_archived_heads().get(session_id):
+                total = archived.get("history_len", 0)
+                return {**archived, "archived": True, "history": [], "history_start": total}
+
+        head = self.get_session_head(session_id)
+        total = head["history_len"]
+        stop = total if before is None else max(0, min(before, total))
+        start = 0 if since is None else max(0, min(since, stop))
+        if limit is not None:
+            start = max(start, stop - max(0, limit))
+
+        msgs: List[Dict] = []
+        if start < stop == total:
+            msgs = self._read_history(session_id, total - start)
+        elif start < stop:
+            # Страница из середины: конец файла до нее не читаем и не разбираем
+            msgs = self._read_history_range(session_id, start, stop)
+        head["history"] = msgs
+        head["history_start"] = start
+        return head
+
+    @traced("rag.get_session_state")
+    @locked
     def get_session_state(self, session_id: str) -> Dict:
-        path = self.sessions_dir / f"{session_id}.json"
-        if path.exists():
-            try:
-                with open(path, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                    if "full_history" not in data: data["full_history"] = []
-                    return data
-            except: pass
-        return {"summary": "", "buffer": [], "full_history": [], "msg_count": 0}
+        state = self.get_session_head(session_id)
+        state["full_history"] = self._read_history(session_id) if state["history_len"] else []
+        state["history_len"] = len(state["full_history"])
+        return state
 
+    @traced("rag.save_session_state")
+    @locked
     def save_session_state(self, session_id: str, state: Dict):
-        path = self.sessions_dir / f"{session_id}.json"
-        with open(path, 'w', encoding='utf-8') as f:
-            json.dump(state, f, ensure_ascii=False, indent=2)
+        head = {k: v for k, v in state.items() if k != "full_history"}
+        if "full_history" in state:
+            self._write_history(session_id, state["full_history"])
+            head["history_len"] = len(state["full_history"])
+            head["turns"] = next_turn(state["full_history"])
+        self._write_head(session_id, head)
 
-    def append_to_buffer(self, session_id: str, user_text: str, ai_text: str, vector_id: Optional[str] = None):
-        state = self.get_session_state(session_id)
+    @traced("rag.update_session_head")
+    @locked
+    def update_session_head(self, session_id: str, **fields):
+        head = self.get_session_head(session_id)
+        head.update(fields)
+        self._write_head(session_id, head)
+        return head
+
+    @traced("rag.append_to_buffer")
+    @locked
+    def append_to_buffer(self, session_id: str, user_text: str, ai_text: str, vector_id: Optional[str] = None,
+                         scenario_state: Optional[Dict] = None):
+        """Дописывает ход в конец истории (append в .history.jsonl) и обновляет заголовок."""
+        state = self.get_session_head(session_id)
         current_sum = state.get("summary", "")
         
         state["buffer"].extend([f"User: {user_text}", f"AI: {ai_text}"])
         state["msg_count"] += 1
+        if scenario_state is not None and "meta" in state:
+            state["meta"]["scenario_state"] = scenario_state
         
-        idx = len(state["full_history"])
+        idx, turn = state["history_len"], state["turns"]
         
-        state["full_history"].append({
+        # tokens — кэш счетчика токенов для сборки контекста
+        new_msgs = [{
             "index": idx, "role": "user", "content": user_text, 
-            "summary_snapshot": current_sum, "vector_id": None
-        })
-        
-        state["full_history"].append({
+            "summary_snapshot": current_sum, "vector_id": None,
+            "tokens": count_tokens(user_text), "turn": turn
+        }, {
             "index": idx + 1, "role": "ai", "content": ai_text, 
             "summary_snapshot": current_sum, "vector_id": vector_id,
-            "candidates": [ai_text]
-        })
+            "tokens": count_tokens(ai_text), "turn": turn
+        }]
         
-        self.save_session_state(session_id, state)
+        self._write_history(session_id, new_msgs, mode='a')
+        state["history_len"], state["turns"] = idx + 2, turn + 1
+        self._write_head(session_id, state)
         return state
 
+    def _tail_journal_path(self, session_id: str) -> Path:
+        return self.sessions_dir / f"{session_id}{TAIL_JOURNAL_SUFFIX}"
+
+    def _replace_history_tail(self, session_id: str, count: int, messages: List[Dict]):
+        """Заменяет последние count сообщений (обрезка файла + дозапись), не трогая начало истории.
+
+        Новый хвост вместе со смещением обрезки сначала атомарно пишется в журнал; если обрезка
+        или дозапись оборвется (сбой процесса, нет места), замену доведет _recover_history_tail.
+        """
+        offset = self._tail_offset(session_id, count)
+        lines = "".join(json.dumps(m, ensure_ascii=False) + "\n" for m in messages)
+        atomic_write_text(self._tail_journal_path(session_id), f"{offset}\n{lines}")
+        self._recover_history_tail(session_id)
+
+    def _recover_history_tail(self, session_id: str):
+        """Применяет журнал замены хвоста, если он остался. Идемпотентно; вызывается под блокировкой сессии."""
+        journal = self._tail_journal_path(session_id)
+        try:
+            offset, _, lines = journal.read_text(encoding="utf-8").partition("\n")
+        except FileNotFoundError:
+            return
+        with open(self._history_path(session_id), 'r+b') as f:
+            f.truncate(int(offset))
+            f.seek(int(offset))
+            f.write(lines.encode("utf-8"))
+        journal.unlink()
+
+    @traced("rag.update_session_summary")
     def update_session_summary(self, session_id: str, new_summary: str):
-        state = self.get_session_state(session_id)
-        state["summary"] = new_summary
-        state["buffer"] = []
-        self.save_session_state(session_id, state)
+        self.update_session_head(session_id, summary=new_summary, buffer=[])
 
     # ============================
     # 4. ADVANCED EDITING & SWIPING
     # ============================
+    # Варианты ответа хранятся вне истории: таблица <id>.candidates (JSON {хэш текста: {text, refs}}),
+    # а сообщение держит только ссылки candidates = [{"id", "used"}] и индекс selected.
+    # Сообщение без свайпов вариантов не имеет (его единственный вариант — content).
+    # Таблица пишется раньше истории; если сбой случится между записями, ссылка может указать
+    # на вытесненный блоб — такие варианты читатели пропускают.
+    def _candidates_path(self, session_id: str) -> Path:
+        # Не .json: иначе файл попадет в глоб заголовков сессий
+        return self.sessions_dir / f"{session_id}.candidates"
+
+    def _load_candidates(self, session_id: str) -> Dict[str, Dict]:
+        path = self._candidates_path(session_id)
+        if not path.exists(): return {}
+        try:
+            with open(path, 'r', encoding='utf-8') as f: return json.load(f)
+        except: return {}
+
+    def _save_candidates(self, session_id: str, table: Dict[str, Dict]):
+        if table:
+            atomic_write_text(self._candidates_path(session_id), json.dumps(table, ensure_ascii=False))
+        else:
+            self._candidates_path(session_id).unlink(missing_ok=True)
+
+    @staticmethod
+    def _blob_put(table: Dict[str, Dict], text: str) -> str:
+        blob_id = hashlib.sha256(text.encode("utf-8")).hexdigest()[:20]
+        table.setdefault(blob_id, {"text": text, "refs": 0})["refs"] += 1
+        return blob_id
+
+    @staticmethod
+    def _blob_release(table: Dict[str, Dict], blob_id: str):
+        entry = table.get(blob_id)
+        if entry is None: return
+        entry["refs"] -= 1
+        if entry["refs"] <= 0: del table[blob_id]
+
+    def _candidate_refs(self, msg: Dict, table: Dict[str, Dict]) -> List[Dict]:
+        """Ссылки на варианты сообщения; старый формат (список текстов) переносится в таблицу."""
+        refs = msg.get("candidates") or []
+        if refs and isinstance(refs[0], str):
+            if len(refs) < 2:
+                refs = []
+            else:
+                refs = [{"id": self._blob_put(table, t), "used": 0.0} for t in refs]
+                msg.setdefault("selected", len(refs) - 1)
+        return refs
+
+    def _add_variant(self, msg: Dict, text: str, table: Dict[str, Dict]):
+        """Делает text выбранным вариантом сообщения (новым или уже существующим)."""
+        now = self._now()
+        refs = self._candidate_refs(msg, table)
+        if not refs:
+            refs = [{"id": self._blob_put(table, msg["content"]), "used": now}]
+        blob_id = hashlib.sha256(text.encode("utf-8")).hexdigest()[:20]
+        sel = next((k for k, r in enumerate(refs) if r["id"] == blob_id), None)
+        if sel is None:
+            self._blob_put(table, text)
+            refs.append({"id": blob_id, "used": now})
+            sel = len(refs) - 1
+        refs[sel]["used"] = now
+        # Сверх лимита вытесняем давно не выбиравшиеся варианты (кроме выбранного)
+        while len(refs) > max(CANDIDATE_MAX_VARIANTS, 2):
+            victim = min((k for k in range(len(refs)) if k != sel), key=lambda k: refs[k]["used"])
+            self._blob_release(table, refs.pop(victim)["id"])
+            if victim < sel: sel -= 1
+        msg["candidates"], msg["selected"] = refs, sel
+        msg["content"] = text
+        msg["tokens"] = count_tokens(text)
+
+    def _select_variant(self, msg: Dict, index: int, table: Dict[str, Dict]) -> bool:
+        refs = self._candidate_refs(msg, table)
+        if not 0 <= index < len(refs) or refs[index]["id"] not in table: return False
+        refs[index]["used"] = self._now()
+        msg["candidates"], msg["selected"] = refs, index
+        msg["content"] = table[refs[index]["id"]]["text"]
+        msg["tokens"] = count_tokens(msg["content"])
+        return True
+
+    def _release_candidates(self, msgs: List[Dict], table: Dict[str, Dict]):
+        for m in msgs:
+            for ref in m.get("candidates") or []:
+                if isinstance(ref, dict): self._blob_release(table, ref["id"])
+
+    @traced("rag.get_variants")
+    @locked
+    def get_variants(self, session_id: str, index: int) -> Optional[Dict[str, Any]]:
+        """Тексты вариантов одного сообщения (для ленивой подгрузки в UI)."""
+        total = self.get_session_head(session_id)["history_len"]
+        if not 0 <= index < total: return None
+        msg = self._read_history(session_id, total - index)[0]
+        refs = msg.get("candidates") or []
+        if refs and isinstance(refs[0], str):
+            return {"index": index, "variants": refs, "selected": msg.get("selected", len(refs) - 1)}
+        if not refs:
+            return {"index": index, "variants": [msg["content"]], "selected": 0}
+        table = self._load_candidates(session_id)
+        # Блоб мог потеряться при сбое — отдаем то, что есть
+        return {"index": index, "variants": [table[r["id"]]["text"] if r["id"] in table else None for r in refs],
+                "selected": msg.get("selected", len(refs) - 1)}
+
+    @traced("rag.delete_message_tail")
+    @locked
     def delete_message_tail(self, session_id: str, start_index: int):
         state = self.get_session_state(session_id)
         history = state["full_history"]
@@ -171,11 +774,38 @@ class RAGEngine:
         
         removed_items = history[start_index:]
         vec_ids = [m["vector_id"] for m in removed_items if m.get("vector_id")]
-        self.delete_vectors(vec_ids)
         
         new_hist = history[:start_index]
         state["full_history"] = new_hist
+        table = self._load_candidates(session_id)
+        self._release_candidates(removed_items, table)
+
+        # Эпизоды, задетые откатом, удаляем, а уцелевшие ходы из них возвращаем в сырую память
+        episode_ids, restore = self._drop_episodes_from(state, history[start_index]["turn"])
+        self.delete_vectors(vec_ids + episode_ids)
+        if restore:
+            self._store_interactions(session_id, new_hist, restore)
         
+        self._restore_summary(state, new_hist)
+        self.save_session_state(session_id, state)
+        self._save_candidates(session_id, table)
+        return True
+
+    @staticmethod
+    def _drop_episodes_from(state: Dict, cut_turn: int) -> Tuple[List[str], range]:
+        """Убирает из state эпизоды, задевающие ходы с cut_turn.
+
+        Возвращает id их векторов (удалить) и ходы, которые нужно векторизовать заново.
+        """
+        episodes = state.get("episodes", [])
+        dropped = [e for e in episodes if e["end"] >= cut_turn]
+        if not dropped: return [], range(0)
+        state["episodes"] = [e for e in episodes if e["end"] < cut_turn]
+        return [e["id"] for e in dropped], range(min(e["start"] for e in dropped), cut_turn)
+
+    @staticmethod
+    def _restore_summary(state: Dict, new_hist: List[Dict]):
+        """Саммари и буфер — как на момент последнего оставшегося сообщения."""
         if new_hist:
             last = new_hist[-1]
             state["summary"] = last.get("summary_snapshot", "")
@@ -190,57 +820,165 @@ class RAGEngine:
         else:
             state["summary"] = ""
             state["buffer"] = []
-            
-        self.save_session_state(session_id, state)
-        return True
 
+    @traced("rag.edit_message")
+    @locked
     def edit_message(self, session_id: str, index: int, new_text: str):
-        state = self.get_session_state(session_id)
-        hist = state["full_history"]
-        if index < 0 or index >= len(hist): return False
+        head = self.get_session_head(session_id)
+        total = head["history_len"]
+        if index < 0 or index >= total: return False
         
+        # Читаем только хвост истории, начиная с предыдущего сообщения
+        start = max(0, index - 1)
+        hist = HistoryView(None, self._read_history(session_id, total - start), total)
         msg = hist[index]
-        msg["content"] = new_text
-        if "candidates" in msg: msg["candidates"].append(new_text)
+        if msg["role"] == "ai":
+            # Правка ответа ИИ сохраняется как новый вариант
+            table = self._load_candidates(session_id)
+            self._add_variant(msg, new_text, table)
+            self._save_candidates(session_id, table)
+        else:
+            msg["content"] = new_text
+            msg["tokens"] = count_tokens(new_text)
         
         old_vid = msg.get("vector_id")
         if old_vid: self.delete_vectors([old_vid])
         
-        if msg["role"] == "ai" and index > 0:
-            prev_user = hist[index-1]["content"]
-            new_vid = self.store_interaction(session_id, prev_user, new_text)
+        # Ход, уже свернутый в эпизод, отдельным вектором не дублируем — его покрывает эпизод
+        prev = hist[index - 1] if index > 0 else None
+        if (msg["role"] == "ai" and prev is not None and prev["role"] == "user"
+                and msg["turn"] >= consolidated_until(head.get("episodes", []))):
+            new_vid = self.store_interaction(session_id, prev["content"], new_text, turn=msg["turn"])
             msg["vector_id"] = new_vid
             
-        self.save_session_state(session_id, state)
+        self._replace_history_tail(session_id, total - start, hist.tail)
         return True
 
+    @traced("rag.add_candidate_response")
+    @locked
     def add_candidate_response(self, session_id: str, index: int, new_text: str):
-        state = self.get_session_state(session_id)
-        hist = state["full_history"]
+        head = self.get_session_head(session_id)
+        total = head["history_len"]
+        if index < 1 or index >= total: return False
+        hist = HistoryView(None, self._read_history(session_id, total - index + 1), total)
         msg = hist[index]
         if msg["role"] != "ai": return False
         
-        if "candidates" not in msg: msg["candidates"] = [msg["content"]]
-        msg["candidates"].append(new_text)
-        msg["content"] = new_text
+        table = self._load_candidates(session_id)
+        self._add_variant(msg, new_text, table)
+        self._save_candidates(session_id, table)
         
         if old_vid := msg.get("vector_id"): self.delete_vectors([old_vid])
         
-        prev_user = hist[index-1]["content"]
-        new_vid = self.store_interaction(session_id, prev_user, new_text)
-        msg["vector_id"] = new_vid
+        prev = hist[index - 1]
+        if prev["role"] == "user" and msg["turn"] >= consolidated_until(head.get("episodes", [])):
+            new_vid = self.store_interaction(session_id, prev["content"], new_text, turn=msg["turn"])
+            msg["vector_id"] = new_vid
         
-        self.save_session_state(session_id, state)
-        return True
+        self._replace_history_tail(session_id, total - index + 1, hist.tail)
+        # Сервер мог склеить одинаковые варианты и вытеснить старые — клиенту отдаем итог
+        return {"index": index, "count": len(msg["candidates"]), "selected": msg["selected"]}
+
+    @traced("rag.apply_history_batch")
+    @locked
+    def apply_history_batch(self, session_id: str, ops: List[Dict]) -> Dict[str, Any]:
+        """Применяет по порядку правки, выбор кандидатов и откат как одну транзакцию.
+
+        ops: {"op": "edit", "index", "text"} | {"op": "select", "index", "candidate"} |
+        {"op": "rewind", "index"} (сообщение index остается последним).
+        Одна загрузка и одна запись сессии, одно удаление векторов и один батч эмбеддингов.
+        Невалидная операция — ValueError, сессия при этом не меняется.
+        """
+        head = self.get_session_head(session_id)
+        total = head["history_len"]
+        rewinds = [op["index"] + 1 for op in ops if op["op"] == "rewind"]
+        if rewinds:
+            # Откат пересчитывает саммари/буфер и может вернуть ходы из эпизодов — нужна вся история
+            lo, msgs = 0, self._read_history(session_id) if total else []
+        else:
+            lo = max(0, min((op["index"] for op in ops), default=total) - 1)
+            msgs = self._read_history(session_id, total - lo) if lo < total else []
 
+        end = total  # текущая длина истории с учетом уже примененных откатов
+        dirty = set()  # ходы, которые нужно векторизовать заново
+        table = self._load_candidates(session_id)
+        for n, op in enumerate(ops):
+            i = op["index"]
+            if op["op"] == "rewind":
+                if not 0 <= i + 1 < end: raise ValueError(f"op {n}: nothing to rewind after index {i}")
+                end = i + 1
+                continue
+            if not lo <= i < end: raise ValueError(f"op {n}: message index {i} out of range")
+            msg = msgs[i - lo]
+            if op["op"] == "edit":
+                text = op.get("text")
+                if text is None: raise ValueError(f"op {n}: edit requires text")
+                if msg["role"] == "ai":
+                    self._add_variant(msg, text, table)
+                else:
+                    msg["content"] = text
+                    msg["tokens"] = count_tokens(text)
+            elif op["op"] == "select":
+                c = op.get("candidate")
+                if msg["role"] != "ai" or c is None or not self._select_variant(msg, c, table):
+                    raise ValueError(f"op {n}: no candidate {c} at index {i}")
+            else:
+                raise ValueError(f"op {n}: unknown op {op['op']!r}")
+            dirty.add(msg["turn"])
+
+        drop_ids = [m["vector_id"] for m in msgs[end - lo:] if m.get("vector_id")]
+        self._release_candidates(msgs[end - lo:], table)
+        # Откат эпизодов — с хода первого удаленного сообщения (его реплика могла остаться)
+        cut_turn = msgs[end - lo]["turn"] if end < total else None
+        msgs = msgs[:end - lo]
+        if rewinds:
+            state = {**head, "full_history": msgs}
+            episode_ids, restore = self._drop_episodes_from(state, cut_turn)
+            drop_ids += episode_ids
+            dirty.update(restore)
+            self._restore_summary(state, msgs)
+        # Ход векторизуется парой «реплика — ответ»; ходы без пары (в том числе разорванные
+        # откатом) и свернутые в эпизоды заново не векторизуем
+        covered = consolidated_until((state if rewinds else head).get("episodes", []))
+        replies = {ai["turn"]: ai for _, ai in interaction_pairs(msgs)}
+        dirty = {t for t in dirty if t >= covered and t in replies}
+        stale_ids = [replies[t].get("vector_id") for t in dirty]
+
+        # Старые векторы правленых ходов удаляем только после записи новых: если эмбеддинг
+        # не удался, история продолжает ссылаться на существующие векторы
+        embedded = self._store_interactions(session_id, msgs, dirty)
+        if embedded: drop_ids += stale_ids
+        self.delete_vectors(drop_ids)
+        self._save_candidates(session_id, table)
+        if rewinds:
+            self.save_session_state(session_id, state)
+        else:
+            self._replace_history_tail(session_id, total - lo, msgs)
+        return {"history_len": end, "applied": len(ops),
+                "vectors_deleted": len([v for v in drop_ids if v]), "vectors_embedded": embedded}
+
+    @traced("rag.fork_session")
+    @locked
     def fork_session(self, src_id: str, new_id: str, up_to_index: int) -> bool:
+        # Ветка пишет векторы раньше своего заголовка — держим и ее блокировку, чтобы
+        # collect_orphan_vectors не счел их осиротевшими
+        with self.locks.hold(new_id):
+            return self._fork_session(src_id, new_id, up_to_index)
+
+    def _fork_session(self, src_id: str, new_id: str, up_to_index: int) -> bool:
         src_state = self.get_session_state(src_id)
         hist = src_state.get("full_history", [])
         if not hist: return False
         
         new_hist = hist[:up_to_index + 1]
         
-        old_vec_ids = [m["vector_id"] for m in new_hist if m.get("vector_id")]
+        # Эпизоды памяти, целиком попавшие в ветку, копируются; остальные ходы — заново сырыми.
+        # Ход, от которого в ветку попала только реплика пользователя, в ветке не завершен
+        keep_turns = next((m["turn"] + 1 for m in reversed(new_hist) if m["role"] == "ai"), 0)
+        src_eps = src_state.get("episodes", [])
+        copy_eps = [e for e in src_eps if e["end"] < keep_turns]
+        
+        old_vec_ids = [m["vector_id"] for m in new_hist if m.get("vector_id")] + [e["id"] for e in copy_eps]
         id_map = {}
         
         if old_vec_ids:
@@ -272,9 +1010,21 @@ class RAGEngine:
         for item in new_hist:
             itm = item.copy()
             if ov := itm.get("vector_id"):
-                if ov in id_map: itm["vector_id"] = id_map[ov]
+                # Вектор мог быть удален (вытеснение по лимиту) — не ссылаемся на чужую сессию
+                itm["vector_id"] = id_map.get(ov)
             final_hist.append(itm)
         new_state["full_history"] = final_hist
+        src_table, new_table = self._load_candidates(src_id), {}
+        for m in final_hist:
+            for ref in m.get("candidates") or []:
+                if isinstance(ref, dict) and ref["id"] in src_table:
+                    self._blob_put(new_table, src_table[ref["id"]]["text"])
+        self._save_candidates(new_id, new_table)
+        
+        new_state["episodes"] = [{**e, "id": id_map[e["id"]]} for e in copy_eps if e["id"] in id_map]
+        for e in src_eps:
+            if e["start"] < keep_turns and e["id"] not in id_map:
+                self._store_interactions(new_id, final_hist, range(e["start"], min(e["end"] + 1, keep_turns)))
         
         r_buf = []
         snap = new_hist[-1].get("summary_snapshot", "")
@@ -284,6 +1034,517 @@ class RAGEngine:
                 r_buf.insert(0, f"{role}: {m['content']}")
             else: break
         new_state["buffer"] = r_buf
+        new_state["msg_count"] = sum(1 for _ in interaction_pairs(final_hist))
         
         self.save_session_state(new_id, new_state)
-        return True
\ No newline at end of file
+        return True
+
+    # ============================
+    # 6. EPISODE MEMORY (CONSOLIDATION)
+    # ============================
+    # Старые ходы сворачиваются в эпизоды: один вектор на группу ходов.
+    # head["episodes"] = [{"id", "start", "end", "level"}] — диапазоны ходов (включительно),
+    # непересекающиеся и идущие подряд с 0-го хода. Исходные векторы ходов удаляются.
+    def _store_interactions(self, session_id: str, hist: List[Dict], turns: Iterable[int]) -> int:
+        """Заново векторизует сырые ходы (одним батчем) и проставляет vector_id в hist.
+
+        hist может быть хвостом истории; ходы без пары «реплика — ответ» в нем пропускаются.
+        """
+        turns = set(turns)
+        docs, ids, targets = [], [], []
+        for user, ai in interaction_pairs(hist):
+            if ai["turn"] not in turns: continue
+            vid = str(uuid.uuid4())
+            docs.append(Document(
+                page_content=interaction_text(user["content"], ai["content"]),
+                metadata={"session_id": session_id, "type": "interaction", "timestamp": self._now(), "turn": ai["turn"]}
+            ))
+            ids.append(vid)
+            targets.append(ai)
+        if not docs: return 0
+        try:
+            self.history_collection.add_documents(docs, ids=ids)
+        except Exception as e:
+            print(f"❌ Vector Store Error: {e}")
+            return 0
+        for ai, vid in zip(targets, ids): ai["vector_id"] = vid
+        return len(ids)
+
+    def get_vector_documents(self, ids: List[str]) -> Dict[str, str]:
+        if not ids: return {}
+        got = self.history_collection.get(ids=ids, include=["documents"])
+        return dict(zip(got["ids"], got["documents"]))
+
+    @traced("rag.get_turns")
+    @locked
+    def get_turns(self, session_id: str, start: int, end: int) -> List[Dict]:
+        """Сообщения ходов start..end включительно.
+
+        Номера ходов идут подряд, и в каждом ходе одно-два сообщения, поэтому такие сообщения
+        лежат в индексах [start, 2 * end + 2) — читается только этот отрезок истории.
+        """
+        page = self.get_session_page(session_id, since=start, before=2 * end + 2)
+        return [m for m in page["history"] if start <= m["turn"] <= end]
+
+    @traced("rag.store_episode")
+    def store_episode(self, session_id: str, text: str, start: int, end: int, level: int) -> Optional[str]:
+        doc_id = str(uuid.uuid4())
+        doc = Document(
+            page_content=f"Episode (turns {start}-{end}): {text}",
+            metadata={"session_id": session_id, "type": "episode", "level": level,
+                      "turn": end, "turn_start": start, "timestamp": self._now()}
+        )
+        try:
+            self.history_collection.add_documents([doc], ids=[doc_id])
+            return doc_id
+        except Exception as e:
+            print(f"❌ Vector Store Error: {e}")
+            return None
+
+    @traced("rag.commit_episode")
+    @locked
+    def commit_episode(self, session_id: str, episode: Dict, child_ids: List[str], raw_vector_ids: List[str],
+                       revision: Optional[str] = None) -> bool:
+        """Регистрирует эпизод в заголовке сессии и удаляет замененные им векторы.
+
+        revision — turns_revision сырых ходов, по которым писалось саммари. Если пока шла
+        суммаризация их правили или откатили (даже с дозаписью до прежней длины) или эпизоды
+        изменились — эпизод отбрасывается.
+        """
+        head = self.get_session_head(session_id)
+        episodes = head.get("episodes", [])
+        known = {e["id"] for e in episodes}
+        stale = head["turns"] <= episode["end"] or not set(child_ids) <= known
+        if not child_ids and episode["start"] != consolidated_until(episodes):
+            stale = True
+        if not stale and revision is not None:
+            stale = turns_revision(self.get_turns(session_id, episode["start"], episode["end"])) != revision
+        if stale:
+            self.delete_vectors([episode["id"]])
+            return False
+
+        head["episodes"] = sorted([e for e in episodes if e["id"] not in child_ids] + [episode], key=lambda e: e["start"])
+        if raw_vector_ids:
+            # Ссылки свернутых ходов на удаляемые векторы убираем из истории. Ход start
+            # начинается не раньше сообщения с тем же индексом; переписываем хвост с его начала
+            raw = set(raw_vector_ids)
+            msgs = self._read_history(session_id, head["history_len"] - episode["start"])
+            msgs = msgs[next((k for k, m in enumerate(msgs) if m["turn"] >= episode["start"]), len(msgs)):]
+            for m in msgs:
+                if m["turn"] <= episode["end"] and m.get("vector_id") in raw: m["vector_id"] = None
+            self._replace_history_tail(session_id, len(msgs), msgs)
+        self._write_head(session_id, head)
+        self.delete_vectors(child_ids + raw_vector_ids)
+        return True
+
+    # ============================
+    # 5. TIERED STORAGE (ARCHIVE)
+    # ============================
+    def _archive_path(self, session_id: str) -> Path:
+        return self.archive_dir / f"{session_id}.arc"
+
+    def _load_archive_index(self) -> Dict[str, Dict]:
+        path = self.archive_dir / "index.json"
+        if not path.exists(): return {}
+        try:
+            with open(path, 'r', encoding='utf-8') as f: return json.load(f)
+        except: return {}
+
+    def _save_archive_index(self, index: Dict[str, Dict]):
+        atomic_write_text(self.archive_dir / "index.json", json.dumps(index, ensure_ascii=False))
+
+    @staticmethod
+    def _encode_vectors(got: Dict) -> List[Dict]:
+        """Ответ get(..., include=[documents, metadatas, embeddings]) → переносимые записи."""
+        embeddings = got.get("embeddings")
+        return [{
+            "id": vid, "document": got["documents"][i], "metadata": got["metadatas"][i],
+            "embedding": encode_vector(embeddings[i])
+        } for i, vid in enumerate(got["ids"])]
+
+    def upsert_vectors(self, vectors: List[Dict]):
+        """Записывает готовые векторы (из архива или экспорта) без перевекторизации.
+
+        upsert: повторная запись после сбоя не создаст дублей.
+        """
+        if not vectors: return
+        self.history_collection._collection.upsert(
+            ids=[v["id"] for v in vectors],
+            embeddings=[decode_vector(v["embedding"]) for v in vectors],
+            documents=[v["document"] for v in vectors],
+            metadatas=[v["metadata"] for v in vectors],
+        )
+
+    def get_archived_heads(self) -> Dict[str, Dict]:
+        """Заголовки архивных сессий (для списка сессий без распаковки архивов)."""
+        return {sid: e["head"] for sid, e in self._load_archive_index().items()}
+
+    def _last_active(self, session_id: str) -> float:
+        """Время последней записи в сессию: правки и свайпы меняют только историю и кандидатов, не заголовок."""
+        mtimes = [p.stat().st_mtime for p in (self._head_path(session_id), self._history_path(session_id),
+                                              self._candidates_path(session_id)) if p.exists()]
+        return max(mtimes, default=0.0)
+
+    @traced("rag.archive_session")
+    @locked
+    def archive_session(self, session_id: str, idle_before: Optional[float] = None) -> bool:
+        """Переносит сессию в сжатый архив и выгружает ее векторы из горячей коллекции.
+
+        С idle_before сессия архивируется, только если не менялась после этого момента
+        (проверка под блокировкой, чтобы не увезти сессию, которую как раз правят).
+        """
+        # Уже в архиве (например, заархивирована другим воркером) — не распаковываем обратно
+        if not self._head_path(session_id).exists(): return False
+        if idle_before is not None and self._last_active(session_id) >= idle_before: return False
+        head = self._load_head(session_id)
+        if head is None: return False
+        history = self._read_history(session_id)
+        try:
+            vec = self.history_collection.get(where={"session_id": session_id},
+                                              include=["documents", "metadatas", "embeddings"])
+        except Exception as e:
+            print(f"❌ Archive Error ({session_id}): {e}")
+            return False
+
+        vectors = self._encode_vectors(vec)
+
+        path = self._archive_path(session_id)
+        tmp = path.with_suffix(f".{os.getpid()}.tmp")
+        tmp.write_bytes(pack({"head": head, "history": history, "vectors": vectors,
+                              "candidates": self._load_candidates(session_id)}))
+        os.replace(tmp, path)
+
+        with self.locks.hold(ARCHIVE_INDEX_LOCK):
+            index = self._load_archive_index()
+            index[session_id] = {"head": head, "archived_at": time.time(), "bytes": path.stat().st_size}
+            self._save_archive_index(index)
+
+        if vectors:
+            self.history_collection.delete(ids=[v["id"] for v in vectors])
+        self._head_path(session_id).unlink(missing_ok=True)
+        self._history_path(session_id).unlink(missing_ok=True)
+        self._candidates_path(session_id).unlink(missing_ok=True)
+        return True
+
+    @traced("rag.rehydrate_session")
+    def _rehydrate(self, session_id: str) -> bool:
+        """Возвращает архивную сессию в горячее хранилище (файлы + векторы без перевекторизации)."""
+        path = self._archive_path(session_id)
+        if not path.exists(): return False
+        try:
+            data = unpack(path.read_bytes())
+            self.upsert_vectors(data.get("vectors") or [])
+            self._save_candidates(session_id, data.get("candidates") or {})
+            self._write_history(session_id, data["history"])
+            self._write_head(session_id, data["head"])
+        except Exception as e:
+            print(f"❌ Rehydrate Error ({session_id}): {e}")
+            return False
+
+        path.unlink(missing_ok=True)
+        with self.locks.hold(ARCHIVE_INDEX_LOCK):
+            index = self._load_archive_index()
+            if index.pop(session_id, None) is not None:
+                self._save_archive_index(index)
+        print(f"♻️ Session {session_id} rehydrated from archive.")
+        return True
+
+    def archive_idle_sessions(self, idle_seconds: float) -> int:
+        """Архивирует сессии, которые не менялись дольше idle_seconds. Возвращает их число."""
+        cutoff = time.time() - idle_seconds
+        archived = 0
+        for path in list(self.sessions_dir.glob("*.json")):
+            try:
+                if self._last_active(path.stem) < cutoff and self.archive_session(path.stem, idle_before=cutoff):
+                    archived += 1
+            except FileNotFoundError:
+                continue
+        if archived: print(f"🗄️ Archived {archived} idle sessions.")
+        return archived
+
+    def storage_stats(self) -> Dict[str, Any]:
+        hot = [p for p in self.sessions_dir.iterdir() if p.is_file()]
+        arc = list(self.archive_dir.glob("*.arc"))
+        try: vectors = self.history_collection._collection.count()
+        except Exception: vectors = None
+        return {
+            "hot": {"sessions": sum(1 for p in hot if p.suffix == ".json"), "bytes": sum(p.stat().st_size for p in hot)},
+            "archive": {"sessions": len(arc), "bytes": sum(p.stat().st_size for p in arc)},
+            "hot_vectors": vectors,
+            "vector_tier": HISTORY_VECTOR_TIER,
+        }
+
+    # ============================
+    # 7. DELETION & GARBAGE COLLECTION
+    # ============================
+    @staticmethod
+    def _live_vector_ids(head: Dict, history: List[Dict]) -> List[str]:
+        ids = [m["vector_id"] for m in history if m.get("vector_id")]
+        return ids + [e["id"] for e in head.get("episodes", []) if e.get("id")]
+
+    @traced("rag.delete_session")
+    @locked
+    def delete_session(self, session_id: str) -> Optional[Dict[str, Any]]:
+        """Удаляет сессию целиком: файлы, архив, запись в индексе архива и все ее векторы.
+
+        Возвращает None, если сессии нет ни в горячем хранилище, ни в архиве.
+        """
+        head_path, hist_path, arc_path = self._head_path(session_id), self._history_path(session_id), self._archive_path(session_id)
+        if not head_path.exists() and not arc_path.exists():
+            return None
+
+        # Векторы ищем и по метке session_id, и по ссылкам из истории (на случай старых записей без метки)
+        vec_ids = set()
+        if head_path.exists():
+            try:
+                with open(head_path, 'r', encoding='utf-8') as f: head = json.load(f)
+            except: head = {}
+            vec_ids.update(self._live_vector_ids(head, head.get("full_history") or self._read_history(session_id)))
+        try:
+            vec_ids.update(self.history_collection.get(where={"session_id": session_id}, include=[])["ids"])
+        except Exception as e:
+            print(f"Vector lookup error ({session_id}): {e}")
+        if vec_ids:
+            self.history_collection.delete(ids=list(vec_ids))
+
+        freed = 0
+        for path in (head_path, hist_path, arc_path, self._candidates_path(session_id)):
+            if path.exists():
+                freed += path.stat().st_size
+                path.unlink(missing_ok=True)
+        with self.locks.hold(ARCHIVE_INDEX_LOCK):
+            index = self._load_archive_index()
+            if index.pop(session_id, None) is not None:
+                self._save_archive_index(index)
+        # Файл-замок сессии иначе остался бы навсегда; удаляется при снятии блокировки
+        self.locks.discard(session_id)
+
+        print(f"🗑️ Session {session_id} deleted ({len(vec_ids)} vectors).")
+        return {"session_id": session_id, "vectors_deleted": len(vec_ids), "bytes_freed": freed}
+
+    @traced("rag.collect_orphan_vectors")
+    def collect_orphan_vectors(self, batch_size: Optional[int] = None, grace_seconds: Optional[float] = None,
+                               dry_run: bool = False) -> Dict[str, Any]:
+        """Mark-and-sweep по коллекции истории.
+
+        Mark: id векторов, на которые ссылаются горячие сессии (vector_id сообщений и эпизоды).
+        Sweep: остальные векторы старше grace_seconds удаляются батчами. Архивные сессии
+        хранят векторы внутри архива, поэтому их копии в горячей коллекции тоже мусор.
+        Перед удалением кандидаты каждой сессии перепроверяются под ее блокировкой: за время
+        сканирования сессию могли разархивировать, форкнуть или начать импортировать, а такие
+        векторы пишутся со старыми метками времени.
+        """
+        batch_size = batch_size or VECTOR_GC_BATCH
+        grace_seconds = VECTOR_GC_GRACE_S if grace_seconds is None else grace_seconds
+        started = time.time()
+
+        live, sessions, importing = set(), set(), set()
+        for path in list(self.sessions_dir.glob("*.json")):
+            sid = path.stem
+            # Под блокировкой сессии: ее не заархивируют и не перепишут посреди чтения
+            with self.locks.hold(sid):
+                if not path.exists(): continue
+                head = self._load_head(sid)
+                if head is None: continue
+                live.update(self._live_vector_ids(head, self._read_history(sid)))
+                sessions.add(sid)
+
+        cutoff = started - grace_seconds
+        # Векторы сессий, которые сейчас импортируются, пишутся раньше их истории. Импорт,
+        # не менявшийся дольше grace_seconds, брошен (процесс упал): его файл убираем, а
+        # векторы собираются как векторы удаленной сессии
+        abandoned: set = set()
+        for path in list(self.sessions_dir.glob("*" + IMPORT_SUFFIX)):
+            sid = path.name.removesuffix(IMPORT_SUFFIX)
+            with self.locks.hold(sid):
+                try:
+                    if path.stat().st_mtime >= cutoff:
+                        importing.add(sid)
+                        continue
+                except FileNotFoundError:
+                    continue
+                if not dry_run:
+                    path.unlink(missing_ok=True)
+                    if not self._head_path(sid).exists():
+                        self._candidates_path(sid).unlink(missing_ok=True)
+                abandoned.add(sid)
+
+        orphans: Dict[Optional[str], List[str]] = {}
+        reasons = {"deleted_session": 0, "archived_session": 0, "unreferenced": 0}
+        archived = set(self._load_archive_index())
+        scanned, offset = 0, 0
+        while True:
+            page = self.history_collection.get(include=["metadatas"], limit=batch_size, offset=offset)
+            if not page["ids"]: break
+            offset += len(page["ids"])
+            scanned += len(page["ids"])
+            for vid, meta in zip(page["ids"], page["metadatas"]):
+                meta = meta or {}
+                if vid in live: continue
+                ts = meta.get("timestamp")
+                if isinstance(ts, float) and ts > cutoff: continue
+                sid = meta.get("session_id")
+                if sid in importing: continue
+                reason = "unreferenced" if sid in sessions else "archived_session" if sid in archived else "deleted_session"
+                reasons[reason] += 1
+                orphans.setdefault(sid, []).append(vid)
+
+        deleted, reclaimed, failed, revived = 0, 0, 0, 0
+        for sid, ids in orphans.items():
+            with self.locks.hold(sid or "_no_session"):
+                if sid and sid not in abandoned and self._import_path(sid).exists():
+                    revived += len(ids)
+                    continue
+                head = self._load_head(sid) if sid and self._head_path(sid).exists() else None
+                if head is not None:
+                    now_live = set(self._live_vector_ids(head, self._read_history(sid)))
+                    revived += sum(1 for v in ids if v in now_live)
+                    ids = [v for v in ids if v not in now_live]
+                for i in range(0, len(ids), batch_size):
+                    batch = ids[i:i + batch_size]
+                    try:
+                        got = self.history_collection.get(ids=batch, include=["documents", "embeddings"])
+                        embeddings = got.get("embeddings")
+                        reclaimed += sum(len((d or "").encode("utf-8")) for d in got["documents"])
+                        reclaimed += sum(len(e) * 4 for e in embeddings) if embeddings is not None else 0
+                        if not dry_run:
+                            self.history_collection.delete(ids=batch)
+                            deleted += len(batch)
+                    except Exception as e:
+                        print(f"Vector GC error: {e}")
+                        failed += len(batch)
+
+        report = {
+            "dry_run": dry_run,
+            "sessions": len(sessions),
+            "scanned": scanned,
+            "live": len(live),
+            "orphans": sum(len(ids) for ids in orphans.values()),
+            "by_reason": reasons,
+            # Кандидаты, оказавшиеся живыми при перепроверке под блокировкой
+            "revived": revived,
+            "abandoned_imports": len(abandoned),
+            "deleted": deleted,
+            "failed": failed,
+            # Оценка: текст документа + float32-эмбеддинг (без накладных расходов индекса)
+            "bytes_reclaimed": reclaimed,
+            "elapsed_s": round(time.time() - started, 2),
+        }
+        if orphans: print(f"🧹 Vector GC: {report['orphans']} orphans, ~{reclaimed / 1024:.0f} KiB{' (dry run)' if dry_run else ''}.")
+        return report
+
+    # ============================
+    # 8. EXPORT / IMPORT (STREAMING)
+    # ============================
+    def list_session_ids(self) -> List[str]:
+        """Все сессии: горячие и архивные."""
+        hot = {p.stem for p in self.sessions_dir.glob("*.json")}
+        return sorted(hot | set(self._load_archive_index()))
+
+    def _iter_history(self, session_id: str, page_size: int) -> Iterator[List[Dict]]:
+        path = self._history_path(session_id)
+        if not path.exists(): return
+        page: List[Dict] = []
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                if not line.strip(): continue
+                page.append(json.loads(line))
+                if len(page) == page_size:
+                    yield page
+                    page = []
+        if page: yield page
+
+    def export_session(self, session_id: str, page_size: Optional[int] = None) -> Iterator[Dict]:
+        """Генератор записей экспорта одной сессии: session, history*, vectors*, candidates*, end.
+
+        История и векторы идут страницами по page_size, так что память не зависит от размера
+        сессии. Архивная сессия читается из архива без распаковки в горячее хранилище.
+        Блокировка сессии держится, пока генератор не исчерпан.
+        """
+        page_size = page_size or EXPORT_PAGE_SIZE
+        with self.locks.hold(session_id):
+            if self._head_path(session_id).exists():
+                head = self._load_head(session_id)
+                if head is None: return
+                yield {"type": "session", "id": session_id, "head": head}
+                messages = 0
+                for page in self._iter_history(session_id, page_size):
+                    messages += len(page)
+                    yield {"type": "history", "id": session_id, "messages": page}
+                vectors, offset = 0, 0
+                while True:
+                    got = self.history_collection.get(where={"session_id": session_id},
+                                                      include=["documents", "metadatas", "embeddings"],
+                                                      limit=page_size, offset=offset)
+                    if not got["ids"]: break
+                    offset += len(got["ids"])
+                    vectors += len(got["ids"])
+                    yield {"type": "vectors", "id": session_id, "vectors": self._encode_vectors(got)}
+                yield from self._export_candidates(session_id, self._load_candidates(session_id), page_size)
+            elif self._archive_path(session_id).exists():
+                data = unpack(self._archive_path(session_id).read_bytes())
+                yield {"type": "session", "id": session_id, "head": data["head"]}
+                history, vecs = data["history"], data.get("vectors") or []
+                for i in range(0, len(history), page_size):
+                    yield {"type": "history", "id": session_id, "messages": history[i:i + page_size]}
+                for i in range(0, len(vecs), page_size):
+                    yield {"type": "vectors", "id": session_id, "vectors": vecs[i:i + page_size]}
+                yield from self._export_candidates(session_id, data.get("candidates") or {}, page_size)
+                messages, vectors = len(history), len(vecs)
+            else:
+                return
+            yield {"type": "end", "id": session_id, "messages": messages, "vectors": vectors}
+
+    @staticmethod
+    def _export_candidates(session_id: str, table: Dict[str, Dict], page_size: int) -> Iterator[Dict]:
+        items = list(table.items())
+        for i in range(0, len(items), page_size):
+            yield {"type": "candidates", "id": session_id, "blobs": dict(items[i:i + page_size])}
+
+    def _import_path(self, session_id: str) -> Path:
+        return self.sessions_dir / f"{session_id}{IMPORT_SUFFIX}"
+
+    @traced("rag.begin_import")
+    @locked
+    def begin_import(self, session_id: str, overwrite: bool = False) -> bool:
+        """Готовит импорт сессии. False — сессия уже есть и overwrite не задан."""
+        if self._head_path(session_id).exists() or self._archive_path(session_id).exists():
+            if not overwrite: return False
+            self.delete_session(session_id)
+        # Начинаем с пустого файла: прерванный импорт этой сессии просто повторяется
+        self._import_path(session_id).write_text("", encoding="utf-8")
+        self._candidates_path(session_id).unlink(missing_ok=True)
+        return True
+
+    @locked
+    def import_history_page(self, session_id: str, messages: List[Dict]):
+        with open(self._import_path(session_id), 'a', encoding='utf-8') as f:
+            f.write("".join(json.dumps(m, ensure_ascii=False) + "\n" for m in messages))
+
+    @locked
+    def import_vectors_page(self, session_id: str, vectors: List[Dict]):
+        """Векторы импортируемой сессии. Трогает файл импорта: GC считает брошенным только давно не менявшийся."""
+        self.upsert_vectors(vectors)
+        os.utime(self._import_path(session_id))
+
+    @locked
+    def import_candidates_page(self, session_id: str, blobs: Dict[str, Dict]):
+        table = self._load_candidates(session_id)
+        table.update(blobs)
+        self._save_candidates(session_id, table)
+
+    @traced("rag.abort_import")
+    @locked
+    def abort_import(self, session_id: str, vector_ids: List[str]):
+        """Откатывает недоимпортированную сессию: записанные векторы, история и кандидаты удаляются."""
+        self.delete_vectors(vector_ids)
+        self._import_path(session_id).unlink(missing_ok=True)
+        if not self._head_path(session_id).exists():
+            self._candidates_path(session_id).unlink(missing_ok=True)
+
+    @traced("rag.finish_import")
+    @locked
+    def finish_import(self, session_id: str, head: Dict, history_len: int):
+        """Публикует импортированную сессию: история становится видимой вместе с заголовком."""
+        os.replace(self._import_path(session_id), self._history_path(session_id))
+        self._write_head(session_id, {**head, "history_len": history_len})
@@ -0,0 +1,110 @@
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+from pathlib import Path
+from collections import OrderedDict
+from typing import Dict, Any, Optional, Tuple
+
+from core.tracing import REGISTRY, gauge_lines
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+RESULT_CACHE_PATH = Path(os.getenv("RESULT_CACHE_PATH", BASE_DIR / "data" / "cache" / "llm_results.sqlite"))
+RESULT_CACHE_SIZE = int(os.getenv("RESULT_CACHE_SIZE", "2048"))
+RESULT_CACHE_DISK_ROWS = int(os.getenv("RESULT_CACHE_DISK_ROWS", "100000"))
+
+CACHE_EVENTS = REGISTRY.counter("llm_result_cache_total", "Cached auxiliary LLM results by namespace and outcome")
+
+
+class ResultCache:
+    """Кэш результатов детерминированных вспомогательных вызовов LLM (директор, саммари).
+
+    Ключ — хэш содержимого промпта вместе с моделью и версией шаблона: смена модели
+    или текста шаблона делает старые записи недостижимыми. Два уровня: LRU в памяти
+    и SQLite на диске (переживает рестарт и общий для воркеров).
+    """
+
+    def __init__(self, path: Optional[Path] = None, size: Optional[int] = None, disk_rows: Optional[int] = None):
+        self.path = Path(path or RESULT_CACHE_PATH)
+        self.size = size or RESULT_CACHE_SIZE
+        self.disk_rows = disk_rows or RESULT_CACHE_DISK_ROWS
+        self._mem: "OrderedDict[Tuple[str, str], str]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._puts = 0
+        self.counters: Dict[str, Dict[str, int]] = {}
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(str(self.path), check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            "ns TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, created REAL NOT NULL, "
+            "PRIMARY KEY (ns, key))"
+        )
+        self._db.commit()
+
+    @staticmethod
+    def make_key(model: str, version: str, *parts: str) -> str:
+        h = hashlib.sha256(f"{model}\x00{version}".encode())
+        for p in parts:
+            h.update(b"\x00" + p.encode())
+        return h.hexdigest()
+
+    def _count(self, ns: str, outcome: str):
+        CACHE_EVENTS.inc(ns=ns, result=outcome)
+        c = self.counters.setdefault(ns, {"hit_memory": 0, "hit_disk": 0, "miss": 0})
+        c[outcome] += 1
+
+    def get(self, ns: str, key: str) -> Optional[str]:
+        with self._lock:
+            value = self._mem.get((ns, key))
+            if value is not None:
+                self._mem.move_to_end((ns, key))
+                self._count(ns, "hit_memory")
+                return value
+            row = self._db.execute("SELECT value FROM results WHERE ns = ? AND key = ?", (ns, key)).fetchone()
+            if row is None:
+                self._count(ns, "miss")
+                return None
+            self._remember(ns, key, row[0])
+            self._count(ns, "hit_disk")
+            return row[0]
+
+    def put(self, ns: str, key: str, value: str):
+        with self._lock:
+            self._remember(ns, key, value)
+            self._db.execute("INSERT OR REPLACE INTO results (ns, key, value, created) VALUES (?, ?, ?, ?)",
+                             (ns, key, value, time.time()))
+            self._puts += 1
+            # Дисковый уровень подрезаем изредка, удаляя самые старые записи
+            if self._puts % 1000 == 0:
+                self._db.execute(
+                    "DELETE FROM results WHERE rowid IN (SELECT rowid FROM results ORDER BY created DESC LIMIT -1 OFFSET ?)",
+                    (self.disk_rows,))
+            self._db.commit()
+
+    def _remember(self, ns: str, key: str, value: str):
+        self._mem[(ns, key)] = value
+        self._mem.move_to_end((ns, key))
+        while len(self._mem) > self.size:
+            self._mem.popitem(last=False)
+
+    def stats(self) -> Dict[str, Any]:
+        out = {}
+        for ns, c in self.counters.items():
+            total = sum(c.values())
+            out[ns] = {**c, "hit_rate": round((c["hit_memory"] + c["hit_disk"]) / total, 4) if total else 0.0}
+        return {"memory_items": len(self._mem), "namespaces": out}
+
+    def prometheus_lines(self):
+        st = self.stats()
+        lines = gauge_lines("llm_result_cache_hit_rate", "Share of auxiliary LLM calls answered from cache",
+                            {(("ns", ns),): v["hit_rate"] for ns, v in st["namespaces"].items()})
+        lines += gauge_lines("llm_result_cache_memory_items", "Entries in the in-memory result cache",
+                             {(): st["memory_items"]})
+        return lines
+
+    def close(self):
+        with self._lock:
+            self._db.close()
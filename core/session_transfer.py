@@ -0,0 +1,178 @@
+import os
+import json
+import time
+from pathlib import Path
+from typing import Dict, Any, Iterator, List, Optional
+
+from core.archive import compressed_frame, default_stream_compression, open_text_stream
+from core.rag_engine import RAGEngine, EMBEDDING_MODEL_NAME
+
+# Поток экспорта — NDJSON: запись header, затем по каждой сессии session, history*, vectors*, candidates*, end.
+# Каждая сессия сжимается отдельным кадром, поэтому файл можно обрезать по границе сессии
+# и дописывать дальше.
+EXPORT_FORMAT = "rag-sessions"
+EXPORT_VERSION = 1
+
+
+class Checkpoint:
+    """Журнал завершенных сессий: строки «id<TAB>смещение в файле экспорта».
+
+    Дописывается после каждой сессии, поэтому переживает обрыв в любой момент.
+    """
+
+    def __init__(self, path: Optional[Path]):
+        self.path = Path(path) if path else None
+        self.done = set()
+        self.offset = 0
+        if self.path and self.path.exists():
+            with open(self.path, encoding="utf-8") as f:
+                for line in f:
+                    sid, _, offset = line.rstrip("\n").partition("\t")
+                    if not sid: continue
+                    self.done.add(sid)
+                    self.offset = int(offset or 0)
+
+    def mark(self, session_id: str, offset: int = 0):
+        self.done.add(session_id)
+        self.offset = offset
+        if self.path:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(f"{session_id}\t{offset}\n")
+                f.flush()
+                os.fsync(f.fileno())
+
+
+def _dumps(record: Dict) -> bytes:
+    return (json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n").encode("utf-8")
+
+
+def export_sessions(rag: RAGEngine, session_ids: List[str], path: Path,
+                    checkpoint_path: Optional[Path] = None, page_size: Optional[int] = None) -> Dict[str, Any]:
+    """Пишет сессии в поток экспорта.
+
+    С checkpoint_path экспорт возобновляем: уже выгруженные сессии пропускаются, а файл
+    обрезается до конца последней завершенной сессии (недописанный кадр отбрасывается).
+    """
+    path = Path(path)
+    compression = default_stream_compression(path)
+    ckpt = Checkpoint(checkpoint_path)
+    resume = bool(ckpt.done) and path.exists()
+    started = time.time()
+    report = {"sessions": 0, "skipped": 0, "messages": 0, "vectors": 0, "resumed": resume}
+
+    with open(path, "r+b" if resume else "wb") as f:
+        if resume:
+            f.truncate(ckpt.offset)
+            f.seek(ckpt.offset)
+        else:
+            with compressed_frame(f, compression) as out:
+                out.write(_dumps({"type": "header", "format": EXPORT_FORMAT, "version": EXPORT_VERSION,
+                                  "embedding_model": EMBEDDING_MODEL_NAME, "created_at": time.time()}))
+
+        for sid in session_ids:
+            if sid in ckpt.done:
+                report["skipped"] += 1
+                continue
+            exported = False
+            with compressed_frame(f, compression) as out:
+                for record in rag.export_session(sid, page_size):
+                    out.write(_dumps(record))
+                    if record["type"] == "end":
+                        exported = True
+                        report["messages"] += record["messages"]
+                        report["vectors"] += record["vectors"]
+            if exported:
+                report["sessions"] += 1
+                ckpt.mark(sid, f.tell())
+
+    report["bytes"] = path.stat().st_size
+    report["elapsed_s"] = round(time.time() - started, 2)
+    return report
+
+
+def iter_records(path: Path) -> Iterator[Dict]:
+    with open_text_stream(path) as f:
+        for line in f:
+            if line.strip(): yield json.loads(line)
+
+
+def import_sessions(rag: RAGEngine, path: Path, checkpoint_path: Optional[Path] = None,
+                    overwrite: bool = False, force: bool = False) -> Dict[str, Any]:
+    """Читает поток экспорта и записывает сессии через RAGEngine, векторы — без перевекторизации.
+
+    Память постоянна: в каждый момент держится одна страница истории или векторов.
+    Сессия публикуется (появляется заголовок) только после записи всех ее частей; завершенные
+    при повторном запуске пропускаются по checkpoint. Сессия, на которой импорт споткнулся
+    (ошибка записи, несовпадение счетчиков, нет записи end), откатывается и попадает в
+    report["failed"], импорт идет дальше. Если испорчен или оборван сам поток, текущая
+    сессия откатывается, а ошибка пробрасывается.
+    """
+    ckpt = Checkpoint(checkpoint_path)
+    started = time.time()
+    report = {"sessions": 0, "skipped": 0, "existing": 0, "failed": [], "messages": 0, "vectors": 0}
+    current: Optional[str] = None
+    head: Dict = {}
+    messages = vectors = 0
+    written: List[str] = []  # id векторов текущей сессии — для отката
+
+    def rollback(error: Any):
+        nonlocal current
+        rag.abort_import(current, written)
+        report["failed"].append({"id": current, "error": str(error)})
+        current = None
+
+    try:
+        for record in iter_records(path):
+            kind = record["type"]
+            if kind == "header":
+                if record.get("format") != EXPORT_FORMAT or record.get("version") != EXPORT_VERSION:
+                    raise ValueError(f"Unsupported export format: {record.get('format')} v{record.get('version')}")
+                # Векторы переносятся как есть — запросы должны векторизоваться той же моделью
+                if record.get("embedding_model") != EMBEDDING_MODEL_NAME and not force:
+                    raise ValueError(f"Export was embedded with {record.get('embedding_model')}, "
+                                     f"this deployment uses {EMBEDDING_MODEL_NAME}")
+                continue
+
+            sid = record["id"]
+            if kind == "session":
+                if current: rollback("no end record")
+                if sid in ckpt.done:
+                    report["skipped"] += 1
+                elif not rag.begin_import(sid, overwrite=overwrite):
+                    report["existing"] += 1
+                else:
+                    current, head, messages, vectors, written = sid, record["head"], 0, 0, []
+                continue
+            if sid != current:
+                continue
+            try:
+                if kind == "history":
+                    rag.import_history_page(sid, record["messages"])
+                    messages += len(record["messages"])
+                elif kind == "vectors":
+                    written += [v["id"] for v in record["vectors"]]
+                    rag.import_vectors_page(sid, record["vectors"])
+                    vectors += len(record["vectors"])
+                elif kind == "candidates":
+                    rag.import_candidates_page(sid, record["blobs"])
+                elif kind == "end":
+                    if (messages, vectors) != (record["messages"], record["vectors"]):
+                        raise ValueError(f"Session {sid} is truncated: got {messages} messages / {vectors} vectors, "
+                                         f"expected {record['messages']} / {record['vectors']}")
+                    rag.finish_import(sid, head, messages)
+                    ckpt.mark(sid)
+                    report["sessions"] += 1
+                    report["messages"] += messages
+                    report["vectors"] += vectors
+                    current = None
+            except Exception as e:
+                print(f"⚠️ Import of {sid} failed, rolled back: {e}")
+                rollback(e)
+        if current: rollback("stream ended before the end record")
+    except BaseException as e:
+        # Поток обрезан, испорчен или импорт прерван — дальше читать нельзя
+        if current: rollback(e)
+        raise
+
+    report["elapsed_s"] = round(time.time() - started, 2)
+    return report
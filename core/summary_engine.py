@@ -1,14 +1,26 @@
 from typing import Optional
-from langchain_google_genai import ChatGoogleGenerativeAI
 from langchain_core.messages import HumanMessage
 
+from core.llm_scheduler import LLMScheduler, PRIORITY_BACKGROUND
+from core.result_cache import ResultCache
+
+SUMMARY_MODEL = "gemini-2.5-flash"
+# Меняется при любой правке шаблона промпта — старые саммари в кэше перестают совпадать
+SUMMARY_PROMPT_VERSION = "summary-v1"
+
 class SummaryEngine:
-    def __init__(self, default_api_key: str):
+    def __init__(self, default_api_key: str, scheduler: Optional[LLMScheduler] = None, cache: Optional[ResultCache] = None):
         self.default_api_key = default_api_key
+        self.llm = scheduler or LLMScheduler()
+        self.cache = cache
 
     async def update(self, old_sum: str, new_lines: list, api_key: Optional[str] = None) -> str:
+        # После отката тот же буфер приходит повторно — результат берем из кэша
+        cache_key = ResultCache.make_key(SUMMARY_MODEL, SUMMARY_PROMPT_VERSION, old_sum or "", *new_lines)
+        if self.cache and (hit := self.cache.get("summary", cache_key)) is not None:
+            return hit
+
         key_to_use = api_key if api_key else self.default_api_key
-        llm = ChatGoogleGenerativeAI(model="gemini-2.5-flash", temperature=0.3, google_api_key=key_to_use)
         
         prompt = (
             "Update the story summary.\n"
@@ -17,6 +29,8 @@ class SummaryEngine:
             "Output concise narrative summary (max 300 words)."
         )
         try:
-            res = await llm.ainvoke([HumanMessage(content=prompt)])
-            return str(res.content).strip()
-        except: return old_sum
\ No newline at end of file
+            res = await self.llm.invoke(SUMMARY_MODEL, 0.3, [HumanMessage(content=prompt)], key_to_use, priority=PRIORITY_BACKGROUND)
+        except: return old_sum
+        new_sum = str(res.content).strip()
+        if self.cache and new_sum: self.cache.put("summary", cache_key, new_sum)
+        return new_sum
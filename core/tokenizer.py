@@ -0,0 +1,38 @@
+import re
+from functools import lru_cache
+from typing import Dict
+
+# Если установлен tiktoken — считаем им (cl100k близок к Gemini по порядку величины),
+# иначе используем быструю оценку по словам. Точность ±15% для бюджета достаточна.
+try:
+    import tiktoken
+    _ENCODING = tiktoken.get_encoding("cl100k_base")
+except Exception:
+    _ENCODING = None
+
+_PIECES = re.compile(r"\w+|[^\w\s]", re.UNICODE)
+
+# Служебные токены на одно сообщение (роль, разделители)
+MESSAGE_OVERHEAD = 4
+
+
+@lru_cache(maxsize=8192)
+def count_tokens(text: str) -> int:
+    if not text: return 0
+    if _ENCODING is not None:
+        return len(_ENCODING.encode(text, disallowed_special=()))
+
+    n = 0
+    for piece in _PIECES.findall(text):
+        # Латиница ~4 символа на токен, кириллица и прочее — ~3
+        per_tok = 4 if piece.isascii() else 3
+        n += 1 + (len(piece) - 1) // per_tok
+    return n
+
+
+def message_tokens(msg: Dict) -> int:
+    """Токены сообщения истории; берет закэшированное значение из стейта, если оно есть."""
+    n = msg.get("tokens")
+    if n is None:
+        n = count_tokens(msg.get("content") or "")
+    return n + MESSAGE_OVERHEAD
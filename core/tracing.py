@@ -0,0 +1,226 @@
+import os
+import json
+import time
+import random
+import bisect
+import inspect
+import logging
+import threading
+import functools
+import contextvars
+from contextlib import contextmanager
+from typing import List, Dict, Any, Optional, Tuple, Callable
+
+logger = logging.getLogger("rag.trace")
+
+# Доля запросов, для которых дерево спанов пишется в лог (гистограммы копятся всегда)
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0.01"))
+# Медленные запросы логируются всегда
+TRACE_SLOW_MS = float(os.getenv("TRACE_SLOW_MS", "15000"))
+
+TIME_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+SIZE_BUCKETS = (64, 256, 1024, 2048, 4096, 8192, 16384, 32768, 65536, 131072)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def _fmt_labels(labels: Labels, extra: str = "") -> str:
+    parts = [f'{k}="{v}"' for k, v in labels]
+    if extra: parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, buckets: Tuple[float, ...]):
+        self.name, self.help, self.buckets = name, help_text, buckets
+        self._series: Dict[Labels, List[float]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels: str):
+        key = tuple(sorted(labels.items()))
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            s = self._series.get(key)
+            if s is None:
+                # [счетчики по корзинам..., +Inf, сумма]
+                s = self._series[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            s[i] += 1
+            s[-1] += value
+
+    def render(self) -> List[str]:
+        out = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = {k: list(v) for k, v in self._series.items()}
+        for labels, s in sorted(series.items()):
+            acc = 0
+            for le, n in zip(self.buckets + (float("inf"),), s[:-1]):
+                acc += n
+                le_txt = "+Inf" if le == float("inf") else repr(le)
+                le_label = 'le="' + le_txt + '"'
+                out.append(f"{self.name}_bucket{_fmt_labels(labels, le_label)} {acc}")
+            out.append(f"{self.name}_sum{_fmt_labels(labels)} {s[-1]}")
+            out.append(f"{self.name}_count{_fmt_labels(labels)} {acc}")
+        return out
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str):
+        self.name, self.help = name, help_text
+        self._series: Dict[Labels, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, value: float = 1, **labels: str):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._series[key] = self._series.get(key, 0) + value
+
+    def snapshot(self) -> Dict[Labels, float]:
+        with self._lock:
+            return dict(self._series)
+
+    def render(self) -> List[str]:
+        out = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            series = dict(self._series)
+        out += [f"{self.name}{_fmt_labels(k)} {v}" for k, v in sorted(series.items())]
+        return out
+
+
+def gauge_lines(name: str, help_text: str, samples: Dict[Labels, float]) -> List[str]:
+    out = [f"# HELP {name} {help_text}", f"# TYPE {name} gauge"]
+    out += [f"{name}{_fmt_labels(k)} {v}" for k, v in sorted(samples.items())]
+    return out
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: List[Any] = []
+        self.collectors: Dict[str, Callable[[], List[str]]] = {}
+
+    def histogram(self, name: str, help_text: str, buckets: Tuple[float, ...] = TIME_BUCKETS) -> Histogram:
+        m = Histogram(name, help_text, buckets)
+        self.metrics.append(m)
+        return m
+
+    def counter(self, name: str, help_text: str) -> Counter:
+        m = Counter(name, help_text)
+        self.metrics.append(m)
+        return m
+
+    def add_collector(self, fn: Callable[[], List[str]], name: Optional[str] = None):
+        """Функция, отдающая строки метрик в момент запроса (например, gauge очередей).
+
+        Коллектор с тем же именем (по умолчанию — qualname функции) заменяется, поэтому
+        повторный lifespan с новым оркестратором не дублирует строки метрик.
+        """
+        self.collectors[name or fn.__qualname__] = fn
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for m in self.metrics:
+            lines += m.render()
+        for fn in list(self.collectors.values()):
+            try: lines += fn()
+            except Exception as e: logger.warning(f"metrics collector failed: {e}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+STAGE_SECONDS = REGISTRY.histogram("rag_stage_seconds", "Duration of chat pipeline stages")
+REQUEST_SECONDS = REGISTRY.histogram("rag_request_seconds", "End-to-end duration of orchestrator operations")
+PROMPT_TOKENS = REGISTRY.histogram("llm_prompt_tokens", "Input tokens per LLM call", SIZE_BUCKETS)
+PROMPT_CHARS = REGISTRY.histogram("llm_prompt_chars", "Prompt size in characters per LLM call", SIZE_BUCKETS)
+LLM_TOKENS = REGISTRY.counter("llm_tokens_total", "LLM tokens by model and kind (input/output)")
+
+
+# ============================
+# TRACES & SPANS
+# ============================
+class _Trace:
+    __slots__ = ("name", "attrs", "spans", "start", "sampled")
+
+    def __init__(self, name: str, attrs: Dict[str, Any]):
+        self.name, self.attrs = name, attrs
+        self.spans: List[Tuple[str, float, float, Dict[str, Any]]] = []
+        self.start = time.perf_counter()
+        self.sampled = random.random() < TRACE_SAMPLE_RATE
+
+
+_current: contextvars.ContextVar[Optional[_Trace]] = contextvars.ContextVar("rag_trace", default=None)
+_captured: contextvars.ContextVar[Optional[List[Dict[str, Any]]]] = contextvars.ContextVar("rag_trace_sink", default=None)
+
+
+@contextmanager
+def capture_traces():
+    """Собирает все завершенные в этом контексте трейсы (для офлайн-профилирования), без сэмплирования."""
+    records: List[Dict[str, Any]] = []
+    token = _captured.set(records)
+    try:
+        yield records
+    finally:
+        _captured.reset(token)
+
+
+@contextmanager
+def trace(name: str, **attrs: Any):
+    """Корневой спан запроса. Пишет дерево спанов в лог для сэмплированных/медленных запросов."""
+    tr = _Trace(name, attrs)
+    token = _current.set(tr)
+    try:
+        yield tr
+    finally:
+        _current.reset(token)
+        total = time.perf_counter() - tr.start
+        REQUEST_SECONDS.observe(total, op=name)
+        sink = _captured.get()
+        if tr.sampled or total * 1000 >= TRACE_SLOW_MS or sink is not None:
+            record = {
+                "trace": name, "ms": round(total * 1000, 1), **tr.attrs,
+                "spans": [{"stage": s, "at_ms": round(a * 1000, 1), "ms": round(d * 1000, 1), **x}
+                          for s, a, d, x in tr.spans],
+            }
+            if sink is not None:
+                sink.append(record)
+            if tr.sampled or total * 1000 >= TRACE_SLOW_MS:
+                logger.info(json.dumps(record, ensure_ascii=False, default=str))
+
+
+@contextmanager
+def span(stage: str, **attrs: Any):
+    """Спан стадии: всегда пишет гистограмму, в дерево трейса — только внутри trace()."""
+    t = time.perf_counter()
+    try:
+        yield attrs
+    finally:
+        d = time.perf_counter() - t
+        STAGE_SECONDS.observe(d, stage=stage)
+        tr = _current.get()
+        if tr is not None:
+            tr.spans.append((stage, t - tr.start, d, attrs))
+
+
+def annotate(**attrs: Any):
+    """Добавляет атрибуты (токены, размеры) к текущему трейсу."""
+    tr = _current.get()
+    if tr is not None:
+        tr.attrs.update(attrs)
+
+
+def traced(stage: str, root: bool = False):
+    """Декоратор: оборачивает sync/async функцию в span(stage) (или в trace(stage) при root=True)."""
+    ctx = trace if root else span
+
+    def deco(fn):
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def awrapper(*a, **kw):
+                with ctx(stage):
+                    return await fn(*a, **kw)
+            return awrapper
+
+        @functools.wraps(fn)
+        def wrapper(*a, **kw):
+            with ctx(stage):
+                return fn(*a, **kw)
+        return wrapper
+    return deco
@@ -0,0 +1,408 @@
+import os
+import json
+import shutil
+from pathlib import Path
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import List, Dict, Any, Optional, Tuple
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+
+from core.file_lock import FileLocks
+
+# Компактный слой векторной памяти: вместо HNSW-индекса Chroma в RAM — файлы на сессию:
+#   codes.i8  — int8-коды (n × dim), их сканирует поиск
+#   scale.f32 — масштаб кода каждой строки
+#   vec.f32   — исходные float32, читаются только для переранжирования лучших кандидатов
+#   rows.jsonl — журнал строк (id, документ, метаданные, удаления)
+# Все массивы открываются через memmap, поэтому в памяти процесса живут только
+# метаданные недавно использованных сессий. Несколько процессов работают с одной папкой
+# под общей блокировкой и перечитывают шарды, измененные другими.
+
+# Сколько кандидатов на один результат переранжировать по точным float-векторам
+COMPACT_RERANK_FACTOR = int(os.getenv("COMPACT_RERANK_FACTOR", "4"))
+# Сколько сессий держать открытыми (метаданные в памяти)
+COMPACT_OPEN_SHARDS = int(os.getenv("COMPACT_OPEN_SHARDS", "256"))
+SCAN_BLOCK = 4096
+
+
+def normalize(vecs: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vecs, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return (vecs / norms).astype(np.float32)
+
+
+def quantize(vecs: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Симметричное int8-квантование с масштабом на строку."""
+    scale = np.abs(vecs).max(axis=1) / 127.0
+    scale[scale == 0] = 1.0
+    codes = np.clip(np.rint(vecs / scale[:, None]), -127, 127).astype(np.int8)
+    return codes, scale.astype(np.float32)
+
+
+def approx_scores(codes: np.ndarray, scale: np.ndarray, query: np.ndarray) -> np.ndarray:
+    """Скалярные произведения по int8-кодам, блоками (без распаковки всего шарда во float)."""
+    out = np.empty(len(codes), dtype=np.float32)
+    for s in range(0, len(codes), SCAN_BLOCK):
+        out[s:s + SCAN_BLOCK] = (codes[s:s + SCAN_BLOCK].astype(np.float32) @ query) * scale[s:s + SCAN_BLOCK]
+    return out
+
+
+class _Shard:
+    """Векторы одной сессии."""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._reload()
+
+    def _reload(self):
+        self.dim = 0
+        self.ids: List[Optional[str]] = []   # строка → id (None — удалена)
+        self.docs: List[Optional[str]] = []
+        self.metas: List[Optional[Dict]] = []
+        self.rows: Dict[str, int] = {}
+        self._live: Optional[List[int]] = None
+        self._arrays: Optional[Tuple[np.ndarray, np.ndarray, np.ndarray]] = None
+        log = self.path / "rows.jsonl"
+        if log.exists():
+            with open(log, encoding="utf-8") as f:
+                for line in f:
+                    if line.strip(): self._apply(json.loads(line))
+        self._stamp = self._stat()
+
+    def _stat(self) -> Optional[Tuple[int, int]]:
+        try:
+            st = (self.path / "rows.jsonl").stat()
+            return st.st_ino, st.st_size
+        except FileNotFoundError:
+            return None
+
+    def refresh(self):
+        """Перечитывает шард, если его журнал изменил другой процесс."""
+        if self._stamp != self._stat():
+            self._reload()
+
+    def live(self) -> List[int]:
+        """Номера живых строк по порядку (кэшируются до следующего изменения журнала)."""
+        if self._live is None:
+            self._live = [r for r, i in enumerate(self.ids) if i is not None]
+        return self._live
+
+    def _apply(self, op: Dict):
+        self._live = None
+        kind = op["op"]
+        if kind == "dim":
+            self.dim = op["dim"]
+        elif kind == "add":
+            self.rows[op["id"]] = len(self.ids)
+            self.ids.append(op["id"])
+            self.docs.append(op["doc"])
+            self.metas.append(op["meta"])
+        elif kind == "del":
+            row = self.rows.pop(op["id"], None)
+            if row is not None:
+                self.ids[row] = self.docs[row] = self.metas[row] = None
+        elif kind == "meta":
+            row = self.rows.get(op["id"])
+            if row is not None: self.metas[row] = op["meta"]
+
+    def _log(self, ops: List[Dict]):
+        self.path.mkdir(parents=True, exist_ok=True)
+        with open(self.path / "rows.jsonl", "a", encoding="utf-8") as f:
+            f.write("".join(json.dumps(op, ensure_ascii=False) + "\n" for op in ops))
+        for op in ops: self._apply(op)
+        self._stamp = self._stat()
+
+    def arrays(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        if self._arrays is None:
+            n = len(self.ids)
+            if n == 0:
+                empty = np.zeros((0, self.dim), dtype=np.float32)
+                self._arrays = (empty.astype(np.int8), np.zeros(0, dtype=np.float32), empty)
+            else:
+                self._arrays = (
+                    np.memmap(self.path / "codes.i8", dtype=np.int8, mode="r", shape=(n, self.dim)),
+                    np.memmap(self.path / "scale.f32", dtype=np.float32, mode="r", shape=(n,)),
+                    np.memmap(self.path / "vec.f32", dtype=np.float32, mode="r", shape=(n, self.dim)),
+                )
+        return self._arrays
+
+    def add(self, ids: List[str], vecs: np.ndarray, docs: List[str], metas: List[Dict]):
+        ops: List[Dict] = []
+        if not self.dim:
+            ops.append({"op": "dim", "dim": int(vecs.shape[1])})
+        ops += [{"op": "del", "id": i} for i in ids if i in self.rows]
+        codes, scale = quantize(vecs)
+        self.path.mkdir(parents=True, exist_ok=True)
+        n, dim = len(self.ids), vecs.shape[1]
+        for name, arr, row_bytes in (("codes.i8", codes, dim), ("scale.f32", scale, 4), ("vec.f32", vecs, dim * 4)):
+            with open(self.path / name, "ab") as f:
+                # Строки, дописанные в массив без записи в журнал (сбой между записями), отбрасываем:
+                # иначе новые строки легли бы со сдвигом относительно своих номеров в журнале
+                f.truncate(n * row_bytes)
+                f.write(arr.tobytes())
+        self._arrays = None
+        self._log(ops + [{"op": "add", "id": i, "doc": d, "meta": m} for i, d, m in zip(ids, docs, metas)])
+
+    def delete(self, ids: List[str]):
+        ops = [{"op": "del", "id": i} for i in ids if i in self.rows]
+        if ops: self._log(ops)
+        if not self.rows and self.ids:
+            # Пустой шард (сессию удалили или архивировали) убираем целиком
+            shutil.rmtree(self.path, ignore_errors=True)
+            self._reload()
+        elif len(self.ids) > 64 and len(self.rows) < len(self.ids) // 2:
+            self.compact()
+
+    def update(self, ids: List[str], metas: List[Dict]):
+        ops = [{"op": "meta", "id": i, "meta": m} for i, m in zip(ids, metas) if i in self.rows]
+        if ops: self._log(ops)
+
+    def compact(self):
+        """Переписывает шард без удаленных строк."""
+        live = [r for r, i in enumerate(self.ids) if i is not None]
+        codes, scale, vecs = (np.asarray(a[live]) for a in self.arrays())
+        tmp = self.path.with_name(self.path.name + ".tmp")
+        shutil.rmtree(tmp, ignore_errors=True)
+        tmp.mkdir(parents=True)
+        for name, arr in (("codes.i8", codes), ("scale.f32", scale), ("vec.f32", vecs)):
+            (tmp / name).write_bytes(arr.tobytes())
+        ops = [{"op": "dim", "dim": self.dim}]
+        ops += [{"op": "add", "id": self.ids[r], "doc": self.docs[r], "meta": self.metas[r]} for r in live]
+        (tmp / "rows.jsonl").write_text("".join(json.dumps(op, ensure_ascii=False) + "\n" for op in ops), encoding="utf-8")
+        self._arrays = None
+        shutil.rmtree(self.path)
+        os.replace(tmp, self.path)
+        self._reload()
+
+    def search(self, query: np.ndarray, k: int, where: Dict) -> List[Tuple[int, float]]:
+        mask = np.array([i is not None and _match(self.metas[r], where) for r, i in enumerate(self.ids)], dtype=bool)
+        if not mask.any(): return []
+        codes, scale, vecs = self.arrays()
+        approx = approx_scores(codes, scale, query)
+        approx[~mask] = -np.inf
+        m = min(int(mask.sum()), max(k, k * COMPACT_RERANK_FACTOR))
+        rows = np.sort(np.argpartition(-approx, m - 1)[:m])
+        # Точное переранжирование по float32: читаются только строки кандидатов
+        exact = np.asarray(vecs[rows]) @ query
+        order = np.argsort(-exact)[:k]
+        return [(int(rows[i]), float(exact[i])) for i in order]
+
+
+def _match(meta: Optional[Dict], where: Optional[Dict]) -> bool:
+    if meta is None: return False
+    return not where or all(meta.get(k) == v for k, v in where.items())
+
+
+class CompactVectorStore:
+    """Векторное хранилище истории с int8-кодами в memmap-файлах (шард на сессию).
+
+    Повторяет ту часть API Chroma, которой пользуется RAGEngine, поэтому подключается
+    вместо history_collection. Близость — косинусная (векторы нормализуются при записи).
+    """
+
+    def __init__(self, root: Path, embedding_function: Embeddings, open_shards: Optional[int] = None):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.embeddings = embedding_function
+        self.open_shards = open_shards or COMPACT_OPEN_SHARDS
+        self._shards: "OrderedDict[str, _Shard]" = OrderedDict()
+        self._locks = FileLocks(self.root / ".locks")
+        self._owner: Dict[str, str] = {}  # id вектора → сессия
+        self._counts: Dict[str, int] = {}  # сессия → число ее векторов (для постраничного обхода)
+        self._owner_log_lines = 0
+        self._owner_pos: Tuple[int, int] = (0, 0)  # (inode, прочитано байт) журнала ids.log
+        with self._sync(): pass
+
+    @contextmanager
+    def _sync(self):
+        """Блокировка хранилища (межпроцессная) + подхват чужих изменений индекса."""
+        with self._locks.hold("store"):
+            self._load_owner_index()
+            yield
+
+    # Совместимость с Chroma: RAGEngine обращается к нижележащей коллекции через _collection
+    @property
+    def _collection(self) -> "CompactVectorStore":
+        return self
+
+    # ============================
+    # INDEX
+    # ============================
+    def _load_owner_index(self):
+        """Дочитывает ids.log с прошлой позиции; после перезаписи журнала — целиком."""
+        path = self.root / "ids.log"
+        try: st = path.stat()
+        except FileNotFoundError: return
+        ino, pos = self._owner_pos
+        if st.st_ino != ino or st.st_size < pos:
+            self._owner, self._counts, self._owner_log_lines, pos = {}, {}, 0, 0
+        if st.st_size == pos: return
+        with open(path, encoding="utf-8") as f:
+            f.seek(pos)
+            for line in f:
+                self._owner_log_lines += 1
+                vid, _, sid = line.rstrip("\n").partition("\t")
+                self._set_owner(vid, sid)
+            self._owner_pos = (st.st_ino, f.tell())
+
+    def _set_owner(self, vid: str, sid: str):
+        """Пустой sid — вектор удален."""
+        old = self._owner.pop(vid, None)
+        if old is not None:
+            self._counts[old] -= 1
+            if not self._counts[old]: del self._counts[old]
+        if sid:
+            self._owner[vid] = sid
+            self._counts[sid] = self._counts.get(sid, 0) + 1
+
+    def _log_owner(self, pairs: List[Tuple[str, str]]):
+        with open(self.root / "ids.log", "a", encoding="utf-8") as f:
+            f.write("".join(f"{vid}\t{sid}\n" for vid, sid in pairs))
+            self._owner_pos = (os.fstat(f.fileno()).st_ino, f.tell())
+        for vid, sid in pairs:
+            self._set_owner(vid, sid)
+        self._owner_log_lines += len(pairs)
+        # Журнал без удаленных записей переписываем, когда он вдвое длиннее живого индекса
+        if self._owner_log_lines > 2 * len(self._owner) + 1024:
+            tmp = self.root / "ids.log.tmp"
+            tmp.write_text("".join(f"{vid}\t{sid}\n" for vid, sid in self._owner.items()), encoding="utf-8")
+            os.replace(tmp, self.root / "ids.log")
+            st = (self.root / "ids.log").stat()
+            self._owner_pos = (st.st_ino, st.st_size)
+            self._owner_log_lines = len(self._owner)
+
+    def _shard(self, session_id: str, cache: bool = True) -> _Shard:
+        """Шард сессии; cache=False — для обхода всех сессий, не вытесняет горячие шарды из LRU."""
+        shard = self._shards.get(session_id)
+        if shard is None:
+            shard = _Shard(self.root / _safe_name(session_id))
+            if not cache: return shard
+            self._shards[session_id] = shard
+            while len(self._shards) > self.open_shards:
+                self._shards.popitem(last=False)
+        else:
+            self._shards.move_to_end(session_id)
+            shard.refresh()
+        return shard
+
+    def _group(self, ids: List[str]) -> Dict[str, List[str]]:
+        groups: Dict[str, List[str]] = {}
+        for vid in ids:
+            if (sid := self._owner.get(vid)) is not None:
+                groups.setdefault(sid, []).append(vid)
+        return groups
+
+    # ============================
+    # CHROMA-COMPATIBLE API
+    # ============================
+    def add_documents(self, documents: List[Document], ids: List[str]):
+        vecs = self.embeddings.embed_documents([d.page_content for d in documents])
+        self.upsert(ids=ids, embeddings=vecs, documents=[d.page_content for d in documents],
+                    metadatas=[d.metadata for d in documents])
+        return ids
+
+    def upsert(self, ids: List[str], embeddings: List[List[float]], documents: List[str], metadatas: List[Dict]):
+        vecs = normalize(np.asarray(embeddings, dtype=np.float32))
+        owners = [m.get("session_id") or "_" for m in metadatas]
+        by_session: Dict[str, List[int]] = {}
+        for i, sid in enumerate(owners):
+            by_session.setdefault(sid, []).append(i)
+        with self._sync():
+            # Вектор, переехавший в другую сессию, удаляем из старой
+            for vid, sid in zip(ids, owners):
+                if self._owner.get(vid, sid) != sid: self._shard(self._owner[vid]).delete([vid])
+            for sid, idx in by_session.items():
+                self._shard(sid).add([ids[i] for i in idx], vecs[idx], [documents[i] for i in idx], [metadatas[i] for i in idx])
+            self._log_owner(list(zip(ids, owners)))
+
+    add = upsert
+
+    def update(self, ids: List[str], metadatas: List[Dict]):
+        with self._sync():
+            meta_by_id = dict(zip(ids, metadatas))
+            for sid, vids in self._group(ids).items():
+                self._shard(sid).update(vids, [meta_by_id[v] for v in vids])
+
+    def delete(self, ids: Optional[List[str]] = None, where: Optional[Dict] = None):
+        with self._sync():
+            if where and "session_id" in where and not ids:
+                shard = self._shard(where["session_id"])
+                ids = [i for r, i in enumerate(shard.ids) if i is not None and _match(shard.metas[r], where)]
+            ids = ids or []
+            for sid, vids in self._group(ids).items():
+                self._shard(sid).delete(vids)
+            gone = [(v, "") for v in ids if v in self._owner]
+            if gone: self._log_owner(gone)
+
+    def get(self, ids: Optional[List[str]] = None, where: Optional[Dict] = None,
+            include: Optional[List[str]] = None, limit: Optional[int] = None, offset: int = 0, **_) -> Dict[str, Any]:
+        include = include or ["metadatas", "documents"]
+        out: Dict[str, Any] = {"ids": [], "documents": [], "metadatas": [], "embeddings": []}
+        # Шард соответствует session_id, поэтому по нему строки не фильтруем
+        extra = {k: v for k, v in (where or {}).items() if k != "session_id"}
+        skip, need = offset, limit
+        with self._sync():
+            scan_all = ids is None and not (where and "session_id" in where)
+            if ids is not None:
+                groups = self._group(ids)
+            elif not scan_all:
+                groups = {where["session_id"]: None}
+            else:
+                # Стабильный порядок — для постраничного обхода (limit/offset)
+                groups = {sid: None for sid in sorted(self._counts)}
+            for sid, vids in groups.items():
+                if need is not None and need <= 0: break
+                # Шард, целиком попадающий в пропуск, не открываем: число строк известно из индекса
+                if scan_all and not extra and skip >= self._counts.get(sid, 0):
+                    skip -= self._counts.get(sid, 0)
+                    continue
+                shard = self._shard(sid, cache=not scan_all)
+                rows = [shard.rows[v] for v in vids if v in shard.rows] if vids is not None else shard.live()
+                if extra: rows = [r for r in rows if _match(shard.metas[r], extra)]
+                if skip >= len(rows):
+                    skip -= len(rows)
+                    continue
+                rows = rows[skip:] if need is None else rows[skip:skip + need]
+                skip = 0
+                if need is not None: need -= len(rows)
+                vecs = shard.arrays()[2] if "embeddings" in include and rows else None
+                for r in rows:
+                    out["ids"].append(shard.ids[r])
+                    out["documents"].append(shard.docs[r])
+                    out["metadatas"].append(shard.metas[r])
+                    if vecs is not None: out["embeddings"].append(np.array(vecs[r]))
+        return {k: v for k, v in out.items() if k == "ids" or k in include}
+
+    def count(self) -> int:
+        with self._sync():
+            return len(self._owner)
+
+    def similarity_search_with_relevance_scores(self, query: str, k: int = 4,
+                                                filter: Optional[Dict] = None) -> List[Tuple[Document, float]]:
+        """Поиск в пределах одной сессии (filter должен содержать session_id)."""
+        if not filter or "session_id" not in filter:
+            raise ValueError("CompactVectorStore search requires a session_id filter")
+        q = normalize(np.asarray([self.embeddings.embed_query(query)], dtype=np.float32))[0]
+        with self._sync():
+            shard = self._shard(filter["session_id"])
+            hits = shard.search(q, k, filter)
+            return [(Document(page_content=shard.docs[r], metadata=shard.metas[r]), score) for r, score in hits]
+
+    # ============================
+    # STATS
+    # ============================
+    def stats(self) -> Dict[str, Any]:
+        files = [p for p in self.root.rglob("*") if p.is_file()]
+        return {
+            "vectors": len(self._owner),
+            "open_shards": len(self._shards),
+            "code_bytes": sum(p.stat().st_size for p in files if p.suffix in (".i8", ".f32") and p.stem != "vec"),
+            "float_bytes": sum(p.stat().st_size for p in files if p.name == "vec.f32"),
+        }
+
+
+def _safe_name(session_id: str) -> str:
+    return "".join(c if c.isalnum() or c in "-_" else "_" for c in session_id) or "_"
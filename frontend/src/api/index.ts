@@ -28,7 +28,10 @@ const fetchWithKey = async (url: string, options: RequestInit = {}) => {
   return response.json();
 };
 
-export const getCharacters = () => fetchWithKey(`${API_BASE}/characters`);
+// fields — легкая проекция списка (id добавляется всегда), полная карточка — getCharacter
+export const getCharacters = (fields?: string[]) =>
+  fetchWithKey(`${API_BASE}/characters${fields ? `?fields=${fields.join(',')}` : ''}`);
+export const getCharacter = (id: string) => fetchWithKey(`${API_BASE}/characters/${encodeURIComponent(id)}`);
 export const getScenarios = () => fetchWithKey(`${API_BASE}/scenarios`);
 export const getStyles = () => fetchWithKey(`${API_BASE}/styles`);
 export const getSessions = () => fetchWithKey(`${API_BASE}/sessions`);
@@ -39,8 +42,24 @@ export const createSession = (payload: any) =>
     body: JSON.stringify(payload),
   });
 
-export const loadSession = (sessionId: string) => 
-  fetchWithKey(`${API_BASE}/sessions/${sessionId}`);
+export const deleteSession = (sessionId: string) =>
+  fetchWithKey(`${API_BASE}/sessions/${encodeURIComponent(sessionId)}`, { method: 'DELETE' });
+
+// limit — последние N сообщений, before — курсор для более старых, since_index — только новые
+export const loadSession = (
+  sessionId: string,
+  params: { limit?: number; before?: number; since_index?: number } = {}
+) => {
+  const query = new URLSearchParams(
+    Object.entries(params)
+      .filter(([, v]) => v !== undefined)
+      .map(([k, v]) => [k, String(v)])
+  ).toString();
+  return fetchWithKey(`${API_BASE}/sessions/${sessionId}${query ? `?${query}` : ''}`);
+};
+
+export const getVariants = (sessionId: string, msgIndex: number) =>
+  fetchWithKey(`${API_BASE}/sessions/${sessionId}/variants/${msgIndex}`);
 
 export const sendMessage = (sessionId: string, message: string) =>
   fetchWithKey(`${API_BASE}/chat/send`, {
@@ -66,6 +85,17 @@ export const rewindChat = (sessionId: string, targetIndex: number) =>
     body: JSON.stringify({ session_id: sessionId, target_index: targetIndex }),
   });
 
+export type HistoryOp =
+  | { op: 'edit'; msg_index: number; new_text: string }
+  | { op: 'select'; msg_index: number; candidate_index: number }
+  | { op: 'rewind'; msg_index: number };
+
+export const batchHistory = (sessionId: string, ops: HistoryOp[]) =>
+  fetchWithKey(`${API_BASE}/history/batch`, {
+    method: 'POST',
+    body: JSON.stringify({ session_id: sessionId, ops }),
+  });
+
   export const loginUser = async (username: string, password: string) => {
     const formData = new URLSearchParams();
     formData.append('username', username);
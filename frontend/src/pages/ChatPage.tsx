@@ -9,7 +9,7 @@ import { LucideIcon } from 'lucide-react';
 
 import { 
   loadSession, sendMessage, regenerateMessage, 
-  editMessage, rewindChat 
+  editMessage, rewindChat, getVariants, batchHistory 
 } from '../api';
 
 interface Message {
@@ -19,6 +19,7 @@ interface Message {
   isEditing?: boolean;
   editDraft?: string;
   variants?: string[];
+  variantCount?: number;
   currentVariant?: number;
 }
 
@@ -33,8 +34,12 @@ interface SessionData {
   full_history: Message[];
   meta: Meta;
   title?: string;
+  next_cursor?: number | null;
 }
 
+// Сколько сообщений грузим за раз: хвост при открытии и каждую старую страницу при прокрутке вверх
+const HISTORY_PAGE = 50;
+
 export default function ChatPage() {
   const { sessionId } = useParams<{ sessionId: string }>();
   
@@ -44,8 +49,12 @@ export default function ChatPage() {
   const [input, setInput] = useState('');
   const [loading, setLoading] = useState(true);
   const [generating, setGenerating] = useState(false);
+  // Индекс, до которого еще есть непрогруженная история (null — загружено всё)
+  const [historyStart, setHistoryStart] = useState<number | null>(null);
+  const [loadingOlder, setLoadingOlder] = useState(false);
   
   const messagesEndRef = useRef<HTMLDivElement>(null);
+  const scrollRef = useRef<HTMLDivElement>(null);
 
   useEffect(() => {
     loadChat();
@@ -55,9 +64,10 @@ export default function ChatPage() {
     if (!sessionId) return;
     try {
       setLoading(true);
-      const data: SessionData = await loadSession(sessionId);
+      const data: SessionData = await loadSession(sessionId, { limit: HISTORY_PAGE });
       const formatted = (data.full_history || []).map((m: Message) => ({ ...m, isEditing: false }));
       setMessages(formatted);
+      setHistoryStart(data.next_cursor ?? null);
       setMeta(data.meta || {});
       setTitle(data.title || '');
     } catch (err) {
@@ -72,6 +82,50 @@ export default function ChatPage() {
     messagesEndRef.current?.scrollIntoView({ behavior: "smooth" });
   };
 
+  // Более старая страница — при прокрутке к началу; позиция прокрутки сохраняется
+  const loadOlder = async () => {
+    if (!sessionId || historyStart === null || loadingOlder) return;
+    const el = scrollRef.current;
+    const prevHeight = el?.scrollHeight ?? 0;
+    try {
+      setLoadingOlder(true);
+      const data: SessionData = await loadSession(sessionId, { before: historyStart, limit: HISTORY_PAGE });
+      const older = (data.full_history || []).map((m: Message) => ({ ...m, isEditing: false }));
+      setMessages(prev => [...older, ...prev]);
+      setHistoryStart(data.next_cursor ?? null);
+      requestAnimationFrame(() => {
+        if (el) el.scrollTop += el.scrollHeight - prevHeight;
+      });
+    } catch (err) {
+      console.error("Failed to load older messages", err);
+    } finally {
+      setLoadingOlder(false);
+    }
+  };
+
+  // Только при прокрутке вверх: автопрокрутка вниз после загрузки стартует от верха и не должна грузить страницы
+  const lastScrollTop = useRef(0);
+  const handleScroll = () => {
+    const top = scrollRef.current?.scrollTop ?? 0;
+    if (top < lastScrollTop.current && top < 80) loadOlder();
+    lastScrollTop.current = top;
+  };
+
+  // Сверка с сервером после ошибки: заменяем сообщения начиная с fromIndex серверной версией
+  const resync = async (fromIndex: number) => {
+    if (!sessionId) return;
+    try {
+      const data: SessionData = await loadSession(sessionId, { since_index: fromIndex });
+      const fresh = (data.full_history || []).map((m: Message) => ({ ...m, isEditing: false }));
+      setMessages(prev => [...prev.filter(m => m.index < fromIndex), ...fresh]);
+      setMeta(data.meta || {});
+    } catch (err) {
+      console.error("Failed to resync session", err);
+    }
+  };
+
+  const nextIndex = () => (messages.length ? messages[messages.length - 1].index + 1 : 0);
+
   const handleSend = async () => {
     if (!input.trim() || generating || !sessionId) return;
 
@@ -79,10 +133,11 @@ export default function ChatPage() {
     setInput('');
     setGenerating(true);
 
+    const userIndex = nextIndex();
     const tempUserMsg: Message = { 
       role: 'user', 
       content: text, 
-      index: messages.length 
+      index: userIndex 
     };
     setMessages(prev => [...prev, tempUserMsg]);
 
@@ -91,7 +146,7 @@ export default function ChatPage() {
       const aiMsg: Message = {
         role: 'ai',
         content: res.response,
-        index: messages.length + 1
+        index: userIndex + 1
       };
       setMessages(prev => [...prev, aiMsg]);
       
@@ -101,6 +156,7 @@ export default function ChatPage() {
     } catch (err) {
       console.error(err);
       alert("Error sending message");
+      resync(userIndex);
     } finally {
       setGenerating(false);
     }
@@ -125,13 +181,26 @@ export default function ChatPage() {
     ));
     
     try {
-      await editMessage(sessionId, index, newText);
+      await editMessage(sessionId, messages[index].index, newText);
     } catch (err) {
       console.error("Edit failed", err);
       alert("Failed to save edit on server");
     }
   };
 
+  // Тексты вариантов приходят не с сессией, а по запросу (index — позиция в списке, запрос — по msg.index)
+  const ensureVariants = async (index: number): Promise<string[]> => {
+    const msg = messages[index];
+    if (msg.variants) return msg.variants;
+    if (!sessionId || (msg.variantCount ?? 0) < 2) return [msg.content];
+    const data = await getVariants(sessionId, msg.index);
+    const variants: string[] = data.variants.map((v: string | null) => v ?? '');
+    setMessages(prev => prev.map((m, i) => 
+      i === index ? { ...m, variants, variantCount: variants.length, currentVariant: data.selected } : m
+    ));
+    return variants;
+  };
+
   const handleRegenerate = async () => {
     if (generating || !sessionId) return;
     
@@ -141,17 +210,7 @@ export default function ChatPage() {
     setMessages(prev => {
       const newMessages = [...prev];
       const lastIndex = newMessages.length - 1;
-      const last = newMessages[lastIndex];
-      
-      const variants = last.variants || [last.content];
-      
-      newMessages[lastIndex] = {
-        ...last,
-        variants,
-        currentVariant: variants.length,
-        content: ''
-      };
-      
+      newMessages[lastIndex] = { ...newMessages[lastIndex], content: '' };
       return newMessages;
     });
     
@@ -164,50 +223,57 @@ export default function ChatPage() {
         const lastIndex = newMessages.length - 1;
         const last = newMessages[lastIndex];
         
-        const variants = [...(last.variants || [])];
-        variants.push(res.response);
-        
+        // Число вариантов и выбранный берем у сервера: он склеивает повторы и вытесняет
+        // старые сверх лимита. Тексты подгрузятся заново при переключении
         newMessages[lastIndex] = {
           ...last,
           content: res.response,
-          variants,
-          currentVariant: variants.length - 1
+          variants: undefined,
+          variantCount: res.variantCount ?? undefined,
+          currentVariant: res.currentVariant ?? undefined
         };
         
         return newMessages;
       });
     } catch (err) {
       console.error(err);
-      loadChat(); 
+      resync(lastMsg.index);
     } finally {
       setGenerating(false);
     }
   };
 
-  const switchVariant = (index: number, direction: number) => {
-    setMessages(prev => {
-      const newMessages = [...prev];
-      const msg = newMessages[index];
-      
-      if (!msg.variants || msg.variants.length === 0) return prev;
-      
-      const currentIdx = msg.currentVariant ?? 0;
-      const newIdx = (currentIdx + direction + msg.variants.length) % msg.variants.length;
-      
-      newMessages[index] = {
-        ...msg,
-        content: msg.variants[newIdx],
-        currentVariant: newIdx
-      };
-      
-      return newMessages;
-    });
+  const switchVariant = async (index: number, direction: number) => {
+    let variants: string[];
+    try {
+      variants = await ensureVariants(index);
+    } catch (err) {
+      console.error("Failed to load variants", err);
+      return;
+    }
+    const msg = messages[index];
+    if (variants.length === 0) return;
+    
+    const currentIdx = msg.currentVariant ?? 0;
+    const newIdx = (currentIdx + direction + variants.length) % variants.length;
+    
+    setMessages(prev => prev.map((m, i) => 
+      i === index ? { ...m, variants, content: variants[newIdx], currentVariant: newIdx } : m
+    ));
+
+    // Выбор варианта сохраняем на сервере, иначе после перезагрузки вернется прежний
+    if (!sessionId) return;
+    try {
+      await batchHistory(sessionId, [{ op: 'select', msg_index: msg.index, candidate_index: newIdx }]);
+    } catch (err) {
+      console.error("Failed to save variant choice", err);
+    }
   };
 
   const handleRewind = async (index: number) => {
     if (!window.confirm("Are you sure? This will delete this message and everything after it.") || !sessionId) return;
     
-    const targetIndexForBackend = index - 1; 
+    const targetIndexForBackend = messages[index].index - 1; 
 
     try {
       await rewindChat(sessionId, targetIndexForBackend);
@@ -242,10 +308,15 @@ export default function ChatPage() {
         </div>
       </header>
 
-      <div className="flex-1 overflow-y-auto p-4 space-y-6 custom-scrollbar">
+      <div ref={scrollRef} onScroll={handleScroll} className="flex-1 overflow-y-auto p-4 space-y-6 custom-scrollbar">
+        {loadingOlder && (
+          <div className="flex justify-center text-zinc-500 text-xs">
+            <Loader2 className="animate-spin mr-2" size={14} /> Loading earlier messages...
+          </div>
+        )}
         {messages.map((msg, idx) => (
           <MessageItem 
-            key={idx} 
+            key={msg.index} 
             msg={msg} 
             index={idx}
             isLast={idx === messages.length - 1}
@@ -320,7 +391,7 @@ function MessageItem({ msg, index, isLast, onEdit, onSave, onRewind, onRegenerat
           <div className="bg-zinc-800/50 p-4 rounded-2xl rounded-tl-none flex items-center gap-2 text-zinc-400 text-sm mb-2">
             <Loader2 className="animate-spin" size={16} /> Writing...
           </div>
-          {msg.variants && msg.variants.length > 0 && (
+          {(msg.variantCount ?? 0) > 1 && (
             <div className="flex items-center gap-1 text-xs text-zinc-500">
               <button
                 onClick={() => onSwitchVariant(index, -1)}
@@ -329,7 +400,7 @@ function MessageItem({ msg, index, isLast, onEdit, onSave, onRewind, onRegenerat
               >
                 <ChevronLeft size={14} />
               </button>
-              <span className="px-1">... / {msg.variants.length + 1}</span>
+              <span className="px-1">... / {msg.variantCount}</span>
               <button
                 onClick={() => onSwitchVariant(index, 1)}
                 className="hover:text-zinc-300 transition p-0.5"
@@ -401,7 +472,7 @@ function MessageItem({ msg, index, isLast, onEdit, onSave, onRewind, onRegenerat
           </ReactMarkdown>
         </div>
 
-        {msg.variants && msg.variants.length > 1 && !isUser && (
+        {(msg.variantCount ?? 0) > 1 && !isUser && (
           <div className="flex items-center gap-1 mt-2 text-xs text-zinc-500">
             <button
               onClick={() => onSwitchVariant(index, -1)}
@@ -410,7 +481,7 @@ function MessageItem({ msg, index, isLast, onEdit, onSave, onRewind, onRegenerat
             >
               <ChevronLeft size={14} />
             </button>
-            <span className="min-w-8 text-center px-1">{(msg.currentVariant ?? 0) + 1} / {msg.variants.length}</span>
+            <span className="min-w-8 text-center px-1">{(msg.currentVariant ?? 0) + 1} / {msg.variantCount}</span>
             <button
               onClick={() => onSwitchVariant(index, 1)}
               className="hover:text-zinc-300 transition p-0.5"
@@ -21,10 +21,11 @@ export default function HomePage() {
   useEffect(() => {
     const loadSessions = async () => {
       const localSessionIds = JSON.parse(localStorage.getItem('session_ids') || '[]');
-      const characters = await getCharacters();
+      const characters = await getCharacters(['name']);
       
       const sessionPromises = localSessionIds.map((id: string) => 
-        loadSession(id).then(data => {
+        // Для списка нужны только метаданные — историю не грузим
+        loadSession(id, { limit: 0 }).then(data => {
           const char = characters.find((c: any) => c.id === data.meta?.character_id);
           return {
             id,
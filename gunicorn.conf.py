@@ -0,0 +1,36 @@
+"""Запуск API в несколько процессов: gunicorn -c gunicorn.conf.py main:app
+
+Модель эмбеддингов и каталоги грузятся один раз в мастере до fork и делятся
+воркерами (copy-on-write). Сессии защищены межпроцессными блокировками в
+RAGEngine. Векторы истории: HISTORY_VECTOR_TIER=int8 (общая папка под
+блокировкой) или Chroma-сервер через CHROMA_HOST — локальная база Chroma
+конкурентных процессов не выдерживает.
+
+Token bucket планировщика LLM живет в каждом воркере отдельно: при WEB_CONCURRENCY=N
+один API-ключ получает до N * LLM_RATE_PER_MIN (и N * LLM_MAX_CONCURRENCY) — задавайте
+лимиты как квоту ключа, деленную на число воркеров.
+"""
+import gc
+import os
+import multiprocessing
+
+# Токенизаторы HF создают потоки; после fork они должны быть выключены
+os.environ.setdefault("TOKENIZERS_PARALLELISM", "false")
+
+bind = os.getenv("BIND", "127.0.0.1:8000")
+workers = int(os.getenv("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+worker_class = "uvicorn.workers.UvicornWorker"
+preload_app = True
+# Ответ LLM может идти десятки секунд
+timeout = int(os.getenv("WORKER_TIMEOUT", "180"))
+graceful_timeout = 30
+
+
+def on_starting(server):
+    from core.rag_engine import preload_shared, HISTORY_VECTOR_TIER, CHROMA_HOST
+
+    if workers > 1 and HISTORY_VECTOR_TIER != "int8" and not CHROMA_HOST:
+        server.log.warning("Several workers share a local Chroma DB: set CHROMA_HOST or HISTORY_VECTOR_TIER=int8")
+    preload_shared()
+    # Объекты, загруженные до fork, не трогаем сборщиком — страницы остаются общими
+    gc.freeze()
@@ -0,0 +1,133 @@
+"""Бенчмарк авторизации: пропускная способность логина и проверки JWT.
+
+Логин: auth_service в процессе (httpx ASGI) на временной SQLite, параллельные
+запросы /token; кроме задержек меряется подвисание event loop — при bcrypt в
+пуле потоков оно должно оставаться в пределах миллисекунд.
+Проверка: verify_token из main.py с кэшем токенов и без него.
+
+    python scripts/bench_auth.py --users 20 --logins 200 --concurrency 20
+    python scripts/bench_auth.py --hash-workers 1
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import tempfile
+from pathlib import Path
+from typing import Dict, Any, List
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+RESULTS_DIR = BASE_DIR / "bench_results"
+sys.path.insert(0, str(BASE_DIR))
+
+from scripts.load_test import summarize, git_commit
+
+
+async def loop_lag(stop: asyncio.Event, samples: List[float], interval: float = 0.01):
+    """Насколько позже запланированного просыпается таймер — мера блокировки event loop."""
+    while not stop.is_set():
+        t = time.perf_counter()
+        await asyncio.sleep(interval)
+        samples.append(max(0.0, time.perf_counter() - t - interval))
+
+
+async def bench_login(args) -> Dict[str, Any]:
+    import httpx
+    from auth_service import main as auth
+
+    async with auth.lifespan(auth.app):
+        transport = httpx.ASGITransport(app=auth.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://auth") as client:
+            for n in range(args.users):
+                await client.post("/register", json={"username": f"bench{n}", "password": f"pw{n}"})
+
+            latencies: List[float] = []
+            lag: List[float] = []
+            errors = 0
+            sem = asyncio.Semaphore(args.concurrency)
+
+            async def login(i: int):
+                nonlocal errors
+                n = i % args.users
+                async with sem:
+                    t = time.perf_counter()
+                    r = await client.post("/token", data={"username": f"bench{n}", "password": f"pw{n}"})
+                    latencies.append(time.perf_counter() - t)
+                    if r.status_code != 200: errors += 1
+
+            stop = asyncio.Event()
+            ticker = asyncio.create_task(loop_lag(stop, lag))
+            started = time.perf_counter()
+            await asyncio.gather(*(login(i) for i in range(args.logins)))
+            elapsed = time.perf_counter() - started
+            stop.set()
+            await ticker
+
+    return {
+        "hash_workers": auth.AUTH_HASH_WORKERS,
+        "elapsed_s": round(elapsed, 2),
+        "logins_per_s": round(args.logins / elapsed, 1) if elapsed else 0.0,
+        "latency": summarize(latencies),
+        "loop_lag": summarize(lag),
+        "errors": errors,
+    }
+
+
+def bench_verify(args) -> Dict[str, Any]:
+    import main as api
+    from auth_service.main import create_access_token
+
+    tokens = [create_access_token({"sub": f"bench{n}"}) for n in range(args.users)]
+    out = {}
+    for mode in ("uncached", "cached"):
+        api.token_cache.clear()
+        started = time.perf_counter()
+        for i in range(args.verifies):
+            if mode == "uncached": api.token_cache.clear()
+            api.verify_token(tokens[i % len(tokens)])
+        elapsed = time.perf_counter() - started
+        out[mode] = {"verifies_per_s": round(args.verifies / elapsed), "us_per_verify": round(elapsed / args.verifies * 1e6, 2)}
+    return out
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--users", type=int, default=20)
+    ap.add_argument("--logins", type=int, default=200)
+    ap.add_argument("--concurrency", type=int, default=20)
+    ap.add_argument("--verifies", type=int, default=20000)
+    ap.add_argument("--hash-workers", type=int, help="размер пула bcrypt (по умолчанию AUTH_HASH_WORKERS)")
+    ap.add_argument("--no-save", action="store_true")
+    args = ap.parse_args()
+
+    workdir = Path(tempfile.mkdtemp(prefix="auth_bench_"))
+    os.environ["AUTH_DATABASE_URL"] = f"sqlite+aiosqlite:///{workdir / 'users.db'}"
+    if args.hash_workers:
+        os.environ["AUTH_HASH_WORKERS"] = str(args.hash_workers)
+
+    res = {
+        "commit": git_commit(),
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "params": vars(args),
+        "login": asyncio.run(bench_login(args)),
+        "verify": bench_verify(args),
+    }
+
+    lg = res["login"]
+    print(f"\n🔐 login: {lg['logins_per_s']} req/s  p50 {lg['latency']['p50_ms']} ms  p95 {lg['latency']['p95_ms']} ms"
+          f"  (bcrypt workers: {lg['hash_workers']}, errors: {lg['errors']})")
+    print(f"   event loop lag: p50 {lg['loop_lag']['p50_ms']} ms  max {lg['loop_lag']['max_ms']} ms")
+    for mode, v in res["verify"].items():
+        print(f"🎫 verify {mode:<9} {v['verifies_per_s']:>9} /s  {v['us_per_verify']} µs")
+
+    if not args.no_save:
+        RESULTS_DIR.mkdir(exist_ok=True)
+        out = RESULTS_DIR / f"{time.strftime('%Y%m%d-%H%M%S')}_{res['commit']}_auth.json"
+        out.write_text(json.dumps(res, ensure_ascii=False, indent=2), encoding="utf-8")
+        print(f"💾 {out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+"""Бенчмарк компактного слоя векторов: recall против памяти.
+
+Сравнивает точный поиск по float32 (эталон) с поиском по int8-кодам без
+переранжирования и с переранжированием top-(k × factor) по float32.
+Векторы — синтетические кластеры размерности модели или реальные эмбеддинги
+текстов сессий (--texts, нужна модель из rag_engine).
+
+    python scripts/bench_vector_tier.py --vectors 500 --queries 200
+    python scripts/bench_vector_tier.py --texts data/sessions
+"""
+import sys
+import json
+import time
+import argparse
+from pathlib import Path
+from typing import List, Dict, Any
+
+import numpy as np
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+RESULTS_DIR = BASE_DIR / "bench_results"
+sys.path.insert(0, str(BASE_DIR))
+
+from core.vector_tier import normalize, quantize, approx_scores
+from scripts.load_test import git_commit, percentile
+
+# Оценка памяти HNSW в Chroma: M=16 связей на двух направлениях слоя 0, int32 id
+HNSW_LINK_BYTES = 16 * 2 * 4
+
+
+def synthetic(n: int, dim: int, clusters: int, rng: np.random.Generator) -> np.ndarray:
+    """Кластеры вокруг случайных центров — похоже на эмбеддинги реплик одной сессии."""
+    centers = rng.standard_normal((clusters, dim))
+    labels = rng.integers(0, clusters, n)
+    return normalize(centers[labels] + 0.6 * rng.standard_normal((n, dim)))
+
+
+def session_texts(path: Path) -> List[str]:
+    texts = []
+    for f in sorted(path.glob("*.history.jsonl")):
+        lines = [json.loads(line) for line in f.read_text(encoding="utf-8").splitlines() if line.strip()]
+        texts += [f"User: {u['content']}\nAI: {a['content']}" for u, a in zip(lines[::2], lines[1::2])]
+    return texts
+
+
+def recall(found: np.ndarray, truth: np.ndarray) -> float:
+    return float(np.mean([len(set(f) & set(t)) / len(t) for f, t in zip(found, truth)]))
+
+
+def run(args) -> Dict[str, Any]:
+    rng = np.random.default_rng(args.seed)
+    if args.texts:
+        from langchain_huggingface import HuggingFaceEmbeddings
+        from core.rag_engine import EMBEDDING_MODEL_NAME
+        texts = session_texts(args.texts)[:args.vectors]
+        emb = HuggingFaceEmbeddings(model_name=EMBEDDING_MODEL_NAME)
+        base = normalize(np.asarray(emb.embed_documents(texts), dtype=np.float32))
+        picked = rng.choice(len(base), min(args.queries, len(base)), replace=False)
+        queries = normalize(base[picked] + 0.3 * rng.standard_normal(base[picked].shape).astype(np.float32))
+    else:
+        base = synthetic(args.vectors, args.dim, args.clusters, rng)
+        queries = synthetic(args.queries, args.dim, args.clusters, rng)
+    n, dim = base.shape
+    k = min(args.k, n)
+
+    truth = np.argsort(-(queries @ base.T), axis=1)[:, :k]
+    codes, scale = quantize(base)
+
+    results = []
+    for factor in [0] + args.rerank:
+        found, lat = [], []
+        for q in queries:
+            t = time.perf_counter()
+            approx = approx_scores(codes, scale, q)
+            if factor:
+                m = min(n, k * factor)
+                cand = np.argpartition(-approx, m - 1)[:m]
+                top = cand[np.argsort(-(base[cand] @ q))[:k]]
+            else:
+                top = np.argsort(-approx)[:k]
+            lat.append(time.perf_counter() - t)
+            found.append(top)
+        results.append({
+            "mode": f"int8+rerank×{factor}" if factor else "int8",
+            f"recall@{k}": round(recall(np.array(found), truth), 4),
+            "p50_us": round(percentile(lat, 50) * 1e6, 1),
+        })
+
+    lat = []
+    for q in queries:
+        t = time.perf_counter()
+        np.argsort(-(base @ q))[:k]
+        lat.append(time.perf_counter() - t)
+    results.insert(0, {"mode": "float32", f"recall@{k}": 1.0, "p50_us": round(percentile(lat, 50) * 1e6, 1)})
+
+    return {
+        "commit": git_commit(),
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "params": {k_: (str(v) if isinstance(v, Path) else v) for k_, v in vars(args).items()},
+        "vectors": n, "dim": dim,
+        # Резидентная память на вектор: что сканируется при каждом поиске
+        "bytes_per_vector": {
+            "chroma_hnsw": dim * 4 + HNSW_LINK_BYTES,
+            "float32": dim * 4,
+            "int8": dim + 4,
+        },
+        "results": results,
+    }
+
+
+def print_report(res: Dict[str, Any]):
+    print(f"\n📐 {res['vectors']} vectors × {res['dim']} dims  (commit {res['commit']})")
+    print("\nBYTES/VECTOR (scanned in RAM)")
+    for name, b in res["bytes_per_vector"].items():
+        print(f"  {name:<14}{b:>8}")
+    key = next(k for k in res["results"][0] if k.startswith("recall"))
+    print(f"\n{'MODE':<20}{key:>12}{'p50 µs':>10}")
+    for r in res["results"]:
+        print(f"{r['mode']:<20}{r[key]:>12}{r['p50_us']:>10}")
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--vectors", type=int, default=500, help="векторов в шарде (≈ MEMORY_MAX_VECTORS)")
+    ap.add_argument("--queries", type=int, default=200)
+    ap.add_argument("--dim", type=int, default=384)
+    ap.add_argument("--clusters", type=int, default=20)
+    ap.add_argument("-k", type=int, default=4)
+    ap.add_argument("--rerank", type=int, nargs="+", default=[1, 2, 4, 8], help="множители переранжирования")
+    ap.add_argument("--texts", type=Path, help="папка сессий: эмбеддинги реальных реплик вместо синтетики")
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--no-save", action="store_true")
+    args = ap.parse_args()
+
+    res = run(args)
+    print_report(res)
+    if not args.no_save:
+        RESULTS_DIR.mkdir(exist_ok=True)
+        out = RESULTS_DIR / f"{time.strftime('%Y%m%d-%H%M%S')}_{res['commit']}_vectors.json"
+        out.write_text(json.dumps(res, ensure_ascii=False, indent=2), encoding="utf-8")
+        print(f"💾 {out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,38 @@
+"""Сборка осиротевших векторов истории (mark-and-sweep).
+
+Векторы, на которые не ссылается ни одна горячая сессия (удаленные вручную сессии,
+сбои между записью вектора и сохранением истории, недоделанные форки), удаляются
+батчами. Векторы моложе --grace секунд не трогаются: их ход мог еще не сохраниться.
+Безопасно запускать по cron при работающем сервере.
+
+    python scripts/gc_vectors.py --dry-run
+    python scripts/gc_vectors.py --batch 1000 --grace 3600
+"""
+import sys
+import json
+import argparse
+from pathlib import Path
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(BASE_DIR))
+
+from core.rag_engine import RAGEngine
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--dry-run", action="store_true", help="только отчет, без удаления")
+    ap.add_argument("--batch", type=int, help="размер батча (по умолчанию VECTOR_GC_BATCH)")
+    ap.add_argument("--grace", type=float, help="не трогать векторы моложе N секунд (VECTOR_GC_GRACE_S)")
+    args = ap.parse_args()
+
+    rag = RAGEngine()
+    report = rag.collect_orphan_vectors(batch_size=args.batch, grace_seconds=args.grace, dry_run=args.dry_run)
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    verb = "Would reclaim" if args.dry_run else "Reclaimed"
+    print(f"{verb} {report['orphans']} vectors, ~{report['bytes_reclaimed'] / 1024:.1f} KiB "
+          f"({report['scanned']} scanned, {report['live']} live).")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,241 @@
+"""Офлайн нагрузочный тест API на фейковой LLM.
+
+Гоняет эндпоинты main.py (create, send, regenerate, edit, rewind, fork, list)
+через N параллельных сессий и пишет отчет в bench_results/.
+
+    python scripts/load_test.py --sessions 20 --turns 10
+    python scripts/load_test.py --compare bench_results/<старый>.json
+    python scripts/load_test.py --director-mode inline --compare bench_results/<separate>.json
+"""
+import os
+import sys
+import json
+import math
+import time
+import shutil
+import asyncio
+import argparse
+import resource
+import tempfile
+import subprocess
+from pathlib import Path
+from collections import defaultdict
+from typing import List, Dict, Any, Optional
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+RESULTS_DIR = BASE_DIR / "bench_results"
+sys.path.insert(0, str(BASE_DIR))
+
+
+def percentile(values: List[float], p: float) -> float:
+    if not values: return 0.0
+    s = sorted(values)
+    return s[max(0, math.ceil(p / 100 * len(s)) - 1)]
+
+
+def summarize(values: List[float]) -> Dict[str, float]:
+    return {
+        "count": len(values),
+        "p50_ms": round(percentile(values, 50) * 1000, 2),
+        "p95_ms": round(percentile(values, 95) * 1000, 2),
+        "p99_ms": round(percentile(values, 99) * 1000, 2),
+        "max_ms": round(max(values) * 1000, 2) if values else 0.0,
+    }
+
+
+def dir_size(path: Path) -> int:
+    if not path.exists(): return 0
+    return sum(f.stat().st_size for f in path.rglob("*") if f.is_file())
+
+
+def rss_mb() -> float:
+    # Текущий RSS из /proc (Linux), иначе пиковый из getrusage
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=BASE_DIR, text=True).strip()
+    except Exception:
+        return "unknown"
+
+
+class StageTimer:
+    """Оборачивает методы объектов и копит длительности по стадиям."""
+
+    def __init__(self):
+        self.samples: Dict[str, List[float]] = defaultdict(list)
+
+    def wrap(self, obj: Any, names: List[str], prefix: str):
+        for name in names:
+            orig = getattr(obj, name)
+            stage = f"{prefix}.{name}"
+            if asyncio.iscoroutinefunction(orig):
+                async def timed(*a, _f=orig, _s=stage, **kw):
+                    t = time.perf_counter()
+                    try: return await _f(*a, **kw)
+                    finally: self.samples[_s].append(time.perf_counter() - t)
+            else:
+                def timed(*a, _f=orig, _s=stage, **kw):
+                    t = time.perf_counter()
+                    try: return _f(*a, **kw)
+                    finally: self.samples[_s].append(time.perf_counter() - t)
+            setattr(obj, name, timed)
+
+
+async def run_session(client, n: int, turns: int, catalog: Dict, latencies: Dict[str, List[float]], errors: Dict[str, int]):
+    async def call(endpoint: str, method: str, url: str, **kw):
+        t = time.perf_counter()
+        r = await client.request(method, url, **kw)
+        latencies[endpoint].append(time.perf_counter() - t)
+        if r.status_code >= 400:
+            errors[endpoint] += 1
+        return r
+
+    char = catalog["characters"][n % len(catalog["characters"])]
+    prof = catalog["styles"][n % len(catalog["styles"])]
+    scn = next((s for s in catalog["scenarios"] if char["id"] in s.get("compatible_character_ids", [])), None)
+
+    r = await call("create", "POST", "/api/sessions", json={
+        "character_id": char["id"], "profile_id": prof["profile_id"],
+        "user_persona": {"name": f"bench{n}", "description": "A traveller.", "relationship": "Strangers."},
+        "scenario_id": scn["id"] if scn and n % 2 == 0 else None,
+    })
+    sid = r.json()["session_id"]
+
+    for t in range(turns):
+        await call("send", "POST", "/api/chat/send", json={"session_id": sid, "text": f"Turn {t}: I look around and ask about the road."})
+        if t == turns // 2:
+            await call("regenerate", "POST", "/api/chat/regenerate", json={"session_id": sid})
+            await call("edit", "POST", "/api/history/edit", json={"session_id": sid, "msg_index": 2 * t + 1, "new_text": "Edited reply."})
+
+    await call("fork", "POST", "/api/sessions/fork", json={"session_id": sid, "msg_index": turns})
+    await call("rewind", "POST", "/api/history/rewind", json={"session_id": sid, "target_index": max(0, turns - 1)})
+    await call("list", "GET", "/api/sessions")
+
+
+async def run(args) -> Dict[str, Any]:
+    import httpx
+    import main as api
+
+    timer = StageTimer()
+    latencies: Dict[str, List[float]] = defaultdict(list)
+    errors: Dict[str, int] = defaultdict(int)
+    storage = [Path(os.environ[k]) for k in ("SESSIONS_DIR", "CHROMA_DB_DIR", "VECTOR_STORE_DIR")]
+
+    async with api.lifespan(api.app):
+        orch = api.orchestrator
+        timer.wrap(orch.llm, ["invoke"], "llm")
+        timer.wrap(orch.director, ["check_progress"], "director")
+        timer.wrap(orch.summarizer, ["update"], "summary")
+        timer.wrap(orch.rag, ["get_session_state", "save_session_state", "store_interaction",
+                              "get_relevant_memories", "delete_vectors", "fork_session"], "rag")
+        timer.wrap(orch.builder, ["build"], "prompt")
+
+        transport = httpx.ASGITransport(app=api.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None,
+                                     headers={"X-Gemini-Api-Key": "bench-key"}) as client:
+            catalog = {k: (await client.get(f"/api/{k}")).json() for k in ("characters", "scenarios", "styles")}
+
+            rss0, disk0 = rss_mb(), sum(dir_size(p) for p in storage)
+            started = time.perf_counter()
+            sem = asyncio.Semaphore(args.concurrency)
+
+            async def worker(n):
+                async with sem:
+                    await run_session(client, n, args.turns, catalog, latencies, errors)
+
+            await asyncio.gather(*(worker(n) for n in range(args.sessions)))
+            elapsed = time.perf_counter() - started
+            llm_stats = {**orch.llm.stats(), "result_cache": orch.result_cache.stats()}
+
+    from core.tracing import LLM_TOKENS
+    tokens = {":".join(v for _, v in labels): n for labels, n in sorted(LLM_TOKENS.snapshot().items())}
+
+    total = sum(len(v) for v in latencies.values())
+    return {
+        "commit": git_commit(),
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "params": {k: (str(v) if isinstance(v, Path) else v) for k, v in vars(args).items()},
+        "elapsed_s": round(elapsed, 2),
+        "throughput_rps": round(total / elapsed, 2) if elapsed else 0.0,
+        "endpoints": {k: {**summarize(v), "errors": errors[k]} for k, v in sorted(latencies.items())},
+        "stages": {k: summarize(v) for k, v in sorted(timer.samples.items())},
+        "llm_scheduler": llm_stats,
+        # Стоимость: токены по моделям (model:kind) — для сравнения режимов директора
+        "llm_tokens": tokens,
+        "rss_mb": {"start": round(rss0, 1), "end": round(rss_mb(), 1)},
+        "disk_bytes": {"start": disk0, "end": sum(dir_size(p) for p in storage)},
+    }
+
+
+def print_report(res: Dict[str, Any], base: Optional[Dict[str, Any]] = None):
+    print(f"\n📊 commit {res['commit']}  {res['elapsed_s']}s  {res['throughput_rps']} req/s")
+    for section in ("endpoints", "stages"):
+        print(f"\n{section.upper():<28}{'n':>6}{'p50':>10}{'p95':>10}{'p99':>10}" + ("   Δp95" if base else ""))
+        for name, s in res[section].items():
+            line = f"{name:<28}{s['count']:>6}{s['p50_ms']:>10}{s['p95_ms']:>10}{s['p99_ms']:>10}"
+            old = (base or {}).get(section, {}).get(name)
+            if old and old["p95_ms"]:
+                line += f"   {(s['p95_ms'] - old['p95_ms']) / old['p95_ms'] * 100:+.1f}%"
+            print(line)
+    print(f"\nLLM calls: {res['llm_scheduler']['requests']}" + (f"  (was {base['llm_scheduler']['requests']})" if base else ""))
+    for name, n in res.get("llm_tokens", {}).items():
+        old = (base or {}).get("llm_tokens", {}).get(name)
+        print(f"  {name:<40}{n:>10}" + (f"   {(n - old) / old * 100:+.1f}%" if old else ""))
+    rss, disk = res["rss_mb"], res["disk_bytes"]
+    print(f"\nRSS: {rss['start']} → {rss['end']} MB   Disk: +{(disk['end'] - disk['start']) / 1024:.1f} KB")
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--sessions", type=int, default=20)
+    ap.add_argument("--turns", type=int, default=10)
+    ap.add_argument("--concurrency", type=int, default=10)
+    ap.add_argument("--latency-ms", type=float, default=200)
+    ap.add_argument("--tokens-per-sec", type=float, default=80)
+    ap.add_argument("--reply-tokens", type=int, default=120)
+    ap.add_argument("--director-mode", choices=["separate", "inline"], help="режим директора (по умолчанию DIRECTOR_MODE)")
+    ap.add_argument("--compare", type=Path, help="JSON прошлого прогона для сравнения")
+    ap.add_argument("--no-save", action="store_true")
+    ap.add_argument("--keep", action="store_true", help="не удалять временную папку с данными")
+    args = ap.parse_args()
+
+    # Изоляция: фейковая LLM, отдельные сессии и Chroma во временной папке
+    workdir = Path(tempfile.mkdtemp(prefix="rag_bench_"))
+    os.environ.update({
+        "LLM_PROVIDER": "fake",
+        "FAKE_LLM_LATENCY_MS": str(args.latency_ms),
+        "FAKE_LLM_TOKENS_PER_SEC": str(args.tokens_per_sec),
+        "FAKE_LLM_REPLY_TOKENS": str(args.reply_tokens),
+        "SESSIONS_DIR": str(workdir / "sessions"),
+        "CHROMA_DB_DIR": str(workdir / "chroma_db"),
+        "VECTOR_STORE_DIR": str(workdir / "vector_store"),
+        "RESULT_CACHE_PATH": str(workdir / "llm_results.sqlite"),
+        "LLM_RATE_PER_MIN": os.getenv("LLM_RATE_PER_MIN", "100000"),
+        "LLM_BURST": os.getenv("LLM_BURST", "1000"),
+        "LLM_MAX_CONCURRENCY": os.getenv("LLM_MAX_CONCURRENCY", "64"),
+    })
+    if args.director_mode:
+        os.environ["DIRECTOR_MODE"] = args.director_mode
+
+    try:
+        res = asyncio.run(run(args))
+    finally:
+        if not args.keep: shutil.rmtree(workdir, ignore_errors=True)
+    base = json.loads(args.compare.read_text(encoding="utf-8")) if args.compare else None
+    print_report(res, base)
+
+    if not args.no_save:
+        RESULTS_DIR.mkdir(exist_ok=True)
+        out = RESULTS_DIR / f"{time.strftime('%Y%m%d-%H%M%S')}_{res['commit']}.json"
+        out.write_text(json.dumps(res, ensure_ascii=False, indent=2), encoding="utf-8")
+        print(f"💾 {out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,35 @@
+"""Разовая миграция документов памяти: буквальный "\\n" между репликами хода.
+
+Перевекторизованные ходы (правки, откаты, форки) какое-то время записывались как
+"User: ...\\nAI: ..." с обратной косой чертой вместо перевода строки. Скрипт проходит
+по горячим сессиям, переписывает такие документы текстом хода из истории и
+векторизует их заново. Архивные сессии мигрируются после распаковки (запустите скрипт повторно).
+
+    python scripts/migrate_interaction_newlines.py
+"""
+import sys
+from pathlib import Path
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(BASE_DIR))
+
+from core.rag_engine import RAGEngine
+
+
+def main():
+    rag = RAGEngine()
+    sessions = sorted(p.stem for p in rag.sessions_dir.glob("*.json"))
+    total = 0
+    for sid in sessions:
+        try:
+            n = rag.repair_interaction_documents(sid)
+        except Exception as e:
+            print(f"❌ {sid}: {e}")
+            continue
+        total += n
+        if n: print(f"✅ {sid}: {n} documents")
+    print(f"Done. Repaired {total} documents in {len(sessions)} sessions.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,34 @@
+"""Разовая миграция векторов истории: номер хода (turn) и настоящий timestamp.
+
+Раньше в metadata.timestamp писался случайный uuid. Скрипт проходит по горячим
+сессиям, берет порядок из full_history и проставляет turn/timestamp батчем на сессию.
+Архивные сессии мигрируются после распаковки (запустите скрипт повторно).
+
+    python scripts/migrate_vector_timestamps.py
+"""
+import sys
+from pathlib import Path
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(BASE_DIR))
+
+from core.rag_engine import RAGEngine
+
+
+def main():
+    rag = RAGEngine()
+    sessions = sorted(p.stem for p in rag.sessions_dir.glob("*.json"))
+    total = 0
+    for sid in sessions:
+        try:
+            n = rag.backfill_vector_metadata(sid)
+        except Exception as e:
+            print(f"❌ {sid}: {e}")
+            continue
+        total += n
+        if n: print(f"✅ {sid}: {n} vectors")
+    print(f"Done. Updated {total} vectors in {len(sessions)} sessions.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+"""Потоковый экспорт/импорт сессий вместе с векторами памяти (NDJSON, сжатие zstd/gzip).
+
+Работает при запущенном сервере: каждая сессия выгружается под своей блокировкой.
+Импорт пишет векторы напрямую, без перевекторизации; сессия, которую не удалось
+импортировать, откатывается и попадает в failed отчета. С --checkpoint оба направления
+можно прервать и продолжить тем же запуском.
+
+    python scripts/transfer_sessions.py export backup.ndjson.zst
+    python scripts/transfer_sessions.py export alice.ndjson.zst --match 'Alice_*' --checkpoint alice.ckpt
+    python scripts/transfer_sessions.py import backup.ndjson.zst --checkpoint import.ckpt [--overwrite]
+"""
+import sys
+import json
+import fnmatch
+import argparse
+from pathlib import Path
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(BASE_DIR))
+
+from core.rag_engine import RAGEngine
+from core.session_transfer import export_sessions, import_sessions
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("command", choices=["export", "import"])
+    ap.add_argument("path", type=Path, help="файл потока (.zst — zstd, .gz — gzip, .ndjson — без сжатия)")
+    ap.add_argument("--checkpoint", type=Path, help="журнал завершенных сессий для возобновления")
+    ap.add_argument("--match", action="append", help="экспорт: glob по id сессии (можно несколько)")
+    ap.add_argument("--session", action="append", help="экспорт: конкретный id сессии (можно несколько)")
+    ap.add_argument("--page-size", type=int, help="сообщений/векторов в одной записи (EXPORT_PAGE_SIZE)")
+    ap.add_argument("--overwrite", action="store_true", help="импорт: заменять существующие сессии")
+    ap.add_argument("--force", action="store_true", help="импорт: не проверять модель эмбеддингов")
+    args = ap.parse_args()
+
+    rag = RAGEngine()
+    if args.command == "export":
+        ids = args.session or rag.list_session_ids()
+        if args.match:
+            ids = [sid for sid in ids if any(fnmatch.fnmatchcase(sid, p) for p in args.match)]
+        print(f"📦 Exporting {len(ids)} sessions → {args.path}")
+        report = export_sessions(rag, ids, args.path, args.checkpoint, args.page_size)
+    else:
+        print(f"📥 Importing {args.path}")
+        report = import_sessions(rag, args.path, args.checkpoint, overwrite=args.overwrite, force=args.force)
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
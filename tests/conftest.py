@@ -0,0 +1,62 @@
+import threading
+from collections import OrderedDict
+
+import pytest
+
+from core.file_lock import FileLocks
+from core.rag_engine import RAGEngine
+
+
+class FakeCollection:
+    """Минимальная замена Chroma: хранит документы в словаре."""
+
+    def __init__(self):
+        self.docs = {}
+
+    def add_documents(self, docs, ids):
+        for d, i in zip(docs, ids): self.docs[i] = (d.page_content, dict(d.metadata))
+
+    def get(self, ids=None, where=None, include=None, limit=None, offset=None):
+        items = [(i, v) for i, v in self.docs.items() if (ids is None or i in ids)
+                 and all(v[1].get(k) == x for k, x in (where or {}).items())]
+        items = items[offset or 0:][:limit]
+        return {"ids": [i for i, _ in items], "documents": [v[0] for _, v in items],
+                "metadatas": [v[1] for _, v in items], "embeddings": [[0.0] for _ in items]}
+
+    def delete(self, ids=None, where=None):
+        for i in ids or []: self.docs.pop(i, None)
+
+    def upsert(self, ids, embeddings, documents, metadatas):
+        for i, d, m in zip(ids, documents, metadatas): self.docs[i] = (d, dict(m))
+
+    def update(self, ids, metadatas):
+        for i, m in zip(ids, metadatas):
+            if i in self.docs: self.docs[i] = (self.docs[i][0], dict(m))
+
+    # RAGEngine обращается к нижележащей коллекции Chroma через _collection
+    @property
+    def _collection(self):
+        return self
+
+
+@pytest.fixture
+def rag(tmp_path):
+    """RAGEngine без модели эмбеддингов и каталогов: сессии во временной папке."""
+    r = RAGEngine.__new__(RAGEngine)
+    r.sessions_dir = tmp_path
+    r.archive_dir = tmp_path / "archive"
+    r.archive_dir.mkdir()
+    r.locks = FileLocks(tmp_path / ".locks")
+    r.history_collection = FakeCollection()
+    r._history_marks, r._marks_lock = OrderedDict(), threading.Lock()
+    return r
+
+
+@pytest.fixture
+def make_session(rag):
+    """Сессия из turns ходов u{t}/a{t}, как ее пишет оркестратор."""
+    def make(sid="s", turns=4):
+        for t in range(turns):
+            vid = rag.store_interaction(sid, f"u{t}", f"a{t}", turn=t)
+            rag.append_to_buffer(sid, f"u{t}", f"a{t}", vid)
+    return make
@@ -0,0 +1,129 @@
+"""Инварианты таблицы вариантов (<id>.candidates).
+
+refs каждого блоба равен числу ссылок на него из сообщений сессии, блобов без ссылок нет,
+и каждая ссылка сообщения указывает на блоб из таблицы.
+"""
+from collections import Counter
+
+import pytest
+
+from core import rag_engine
+
+
+def assert_refcounts(rag, sid):
+    history = rag.get_session_state(sid)["full_history"]
+    used = Counter(ref["id"] for m in history for ref in m.get("candidates") or [])
+    table = rag._load_candidates(sid)
+    assert {k: v["refs"] for k, v in table.items()} == dict(used)
+    for m in history:
+        refs = m.get("candidates") or []
+        if refs:
+            assert 0 <= m["selected"] < len(refs)
+            assert table[refs[m["selected"]]["id"]]["text"] == m["content"]
+
+
+def test_add_variant_dedups_and_selects_existing(rag):
+    table, msg = {}, {"role": "ai", "content": "a"}
+    rag._add_variant(msg, "b", table)
+    rag._add_variant(msg, "a", table)
+    assert len(msg["candidates"]) == 2
+    assert msg["selected"] == 0 and msg["content"] == "a"
+    assert all(e["refs"] == 1 for e in table.values())
+
+
+def test_add_variant_caps_and_keeps_selected(rag, monkeypatch):
+    monkeypatch.setattr(rag_engine, "CANDIDATE_MAX_VARIANTS", 3)
+    clock = iter(range(100))
+    monkeypatch.setattr(rag, "_now", lambda: float(next(clock)))
+    table, msg = {}, {"role": "ai", "content": "v0"}
+    for n in range(1, 6):
+        rag._add_variant(msg, f"v{n}", table)
+    assert len(msg["candidates"]) == 3
+    assert sorted(e["text"] for e in table.values()) == ["v3", "v4", "v5"]
+    assert msg["content"] == "v5" and table[msg["candidates"][msg["selected"]]["id"]]["text"] == "v5"
+    assert all(e["refs"] == 1 for e in table.values())
+
+
+def test_release_candidates_drops_unreferenced(rag):
+    table, a, b = {}, {"role": "ai", "content": "x"}, {"role": "ai", "content": "x"}
+    rag._add_variant(a, "y", table)
+    rag._add_variant(b, "y", table)
+    rag._release_candidates([a], table)
+    assert {e["text"]: e["refs"] for e in table.values()} == {"x": 1, "y": 1}
+    rag._release_candidates([b], table)
+    assert table == {}
+
+
+def test_regenerate_reports_server_variants(rag, make_session, monkeypatch):
+    monkeypatch.setattr(rag_engine, "CANDIDATE_MAX_VARIANTS", 3)
+    make_session()
+    for text in ["r1", "r2", "r1", "r3", "r4"]:
+        res = rag.add_candidate_response("s", 7, text)
+    assert res == {"index": 7, "count": 3, "selected": 2}
+    assert rag.get_variants("s", 7)["variants"][2] == "r4"
+    assert_refcounts(rag, "s")
+
+
+def test_rewind_releases_blobs(rag, make_session):
+    make_session()
+    rag.add_candidate_response("s", 3, "alt")
+    rag.add_candidate_response("s", 7, "alt")
+    assert_refcounts(rag, "s")
+    assert rag.delete_message_tail("s", 6)
+    assert_refcounts(rag, "s")
+    assert rag.delete_message_tail("s", 2)
+    assert_refcounts(rag, "s")
+    assert not rag._candidates_path("s").exists()
+
+
+def test_batch_edit_select_rewind(rag, make_session):
+    make_session()
+    rag.add_candidate_response("s", 5, "alt5")
+    rag.apply_history_batch("s", [{"op": "edit", "index": 3, "text": "e3"},
+                                  {"op": "select", "index": 5, "candidate": 0},
+                                  {"op": "edit", "index": 7, "text": "alt5"}])
+    assert_refcounts(rag, "s")
+    rag.apply_history_batch("s", [{"op": "edit", "index": 1, "text": "e1"}, {"op": "rewind", "index": 3}])
+    assert_refcounts(rag, "s")
+    table = rag._load_candidates("s")
+    assert sorted(e["text"] for e in table.values()) == ["a0", "a1", "e1", "e3"]
+
+
+def test_invalid_batch_leaves_table_untouched(rag, make_session):
+    make_session()
+    rag.add_candidate_response("s", 3, "alt")
+    before = rag._load_candidates("s")
+    with pytest.raises(ValueError):
+        rag.apply_history_batch("s", [{"op": "edit", "index": 5, "text": "x"},
+                                      {"op": "select", "index": 5, "candidate": 9}])
+    assert rag._load_candidates("s") == before
+    assert_refcounts(rag, "s")
+
+
+def test_fork_copies_only_referenced_blobs(rag, make_session):
+    make_session()
+    rag.add_candidate_response("s", 3, "alt3")
+    rag.add_candidate_response("s", 7, "alt7")
+    assert rag.fork_session("s", "f", 5)
+    assert_refcounts(rag, "f")
+    assert sorted(e["text"] for e in rag._load_candidates("f").values()) == ["a1", "alt3"]
+    # Откат в ветке не трогает таблицу исходной сессии
+    rag.delete_message_tail("f", 2)
+    assert_refcounts(rag, "f")
+    assert_refcounts(rag, "s")
+
+
+def test_export_import_roundtrip(rag, make_session):
+    make_session()
+    rag.add_candidate_response("s", 3, "alt3")
+    rag.add_candidate_response("s", 3, "alt3b")
+    records = list(rag.export_session("s", page_size=1))
+    assert rag.begin_import("t")
+    history = [m for r in records if r["type"] == "history" for m in r["messages"]]
+    rag.import_history_page("t", history)
+    for r in records:
+        if r["type"] == "candidates": rag.import_candidates_page("t", r["blobs"])
+    head = next(r["head"] for r in records if r["type"] == "session")
+    rag.finish_import("t", head, len(history))
+    assert_refcounts(rag, "t")
+    assert rag.get_variants("t", 3) == rag.get_variants("s", 3)
@@ -0,0 +1,65 @@
+"""Свертка старой памяти в эпизоды и ее гонки с правками истории."""
+import asyncio
+
+from core.memory_consolidator import MemoryConsolidator
+from core.rag_engine import turns_revision
+
+
+class Reply:
+    content = "summary"
+
+
+class Scheduler:
+    """LLM-заглушка: во время «суммаризации» выполняет during()."""
+
+    def __init__(self, during=None):
+        self.during = during
+
+    async def invoke(self, *args, **kwargs):
+        if self.during: self.during()
+        return Reply()
+
+
+def consolidate(rag, during=None):
+    c = MemoryConsolidator(rag, "key", scheduler=Scheduler(during), fanout=4, keep_recent=2)
+    return asyncio.run(c.consolidate("s", max_steps=1))
+
+
+def test_consolidation_replaces_raw_vectors(rag, make_session):
+    make_session(turns=8)
+    assert consolidate(rag) == 1
+    state = rag.get_session_state("s")
+    (ep,) = state["episodes"]
+    assert (ep["start"], ep["end"]) == (0, 3)
+    assert [bool(m.get("vector_id")) for m in state["full_history"] if m["role"] == "ai"] == [False] * 4 + [True] * 4
+    assert len(rag.history_collection.docs) == 5
+
+
+def test_edit_during_summarization_discards_episode(rag, make_session):
+    make_session(turns=8)
+    assert consolidate(rag, lambda: rag.edit_message("s", 3, "a1-edited")) == 0
+    state = rag.get_session_state("s")
+    assert not state.get("episodes")
+    assert not [d for d, meta in rag.history_collection.docs.values() if meta["type"] == "episode"]
+    assert len(rag.history_collection.docs) == 8
+
+
+def test_rewind_and_reappend_during_summarization_discards_episode(rag, make_session):
+    make_session(turns=8)
+
+    def rewind_and_reappend():
+        rag.delete_message_tail("s", 4)
+        for t in range(2, 8):
+            rag.append_to_buffer("s", f"v{t}", f"b{t}", rag.store_interaction("s", f"v{t}", f"b{t}", turn=t))
+
+    assert consolidate(rag, rewind_and_reappend) == 0
+    assert rag.get_session_head("s")["history_len"] == 16
+    assert not rag.get_session_head("s").get("episodes")
+
+
+def test_commit_with_unchanged_revision(rag, make_session):
+    make_session(turns=8)
+    msgs = rag.get_turns("s", 0, 3)
+    ep = rag.store_episode("s", "summary", 0, 3, 1)
+    raw = [m["vector_id"] for m in msgs if m.get("vector_id")]
+    assert rag.commit_episode("s", {"id": ep, "start": 0, "end": 3, "level": 1}, [], raw, turns_revision(msgs))
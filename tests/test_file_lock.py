@@ -0,0 +1,52 @@
+"""Межпроцессные блокировки сессий (flock на файлы-замки)."""
+import threading
+import time
+
+import pytest
+
+from core import file_lock
+from core.file_lock import FileLocks
+
+pytestmark = pytest.mark.skipif(file_lock.fcntl is None, reason="flock is POSIX-only")
+
+
+def test_delete_session_removes_lock_file(rag, make_session):
+    make_session(turns=1)
+    assert (rag.sessions_dir / ".locks" / "s.lock").exists()
+    assert rag.delete_session("s")
+    assert not (rag.sessions_dir / ".locks" / "s.lock").exists()
+
+
+def test_discard_stays_exclusive_for_waiters(tmp_path):
+    locks = FileLocks(tmp_path)
+    waiting, entered, leave = threading.Event(), threading.Event(), threading.Event()
+
+    def waiter():
+        waiting.set()
+        with locks.hold("s"):
+            entered.set()
+            leave.wait(5)
+
+    with locks.hold("s"):
+        locks.discard("s")
+        t = threading.Thread(target=waiter)
+        t.start()
+        waiting.wait(5)
+        time.sleep(0.05)  # ожидающий успевает открыть старый файл и встать в flock
+    assert entered.wait(5)
+    # Ожидавший перезахватил замок на новом файле — третий участник его не получит
+    with locks.try_hold("s") as got:
+        assert not got
+    leave.set()
+    t.join(5)
+    with locks.try_hold("s") as got:
+        assert got
+
+
+def test_discard_waits_for_outermost_release(tmp_path):
+    locks = FileLocks(tmp_path)
+    with locks.hold("s"):
+        with locks.hold("s"):
+            locks.discard("s")
+        assert (tmp_path / "s.lock").exists()
+    assert not (tmp_path / "s.lock").exists()
@@ -0,0 +1,108 @@
+"""История сессии на диске: страницы, хвост и журнал замены хвоста."""
+import json
+
+import pytest
+
+from core import rag_engine
+
+
+@pytest.fixture
+def long_session(rag, monkeypatch):
+    monkeypatch.setattr(rag_engine, "HISTORY_MARK_EVERY", 16)
+    for t in range(100):
+        rag.append_to_buffer("s", f"u{t}", f"a{t}")
+    return rag
+
+
+def count_parsed(monkeypatch):
+    calls = []
+    loads = json.loads
+    monkeypatch.setattr(rag_engine.json, "loads", lambda s, *a, **k: calls.append(1) or loads(s, *a, **k))
+    return calls
+
+
+def test_deep_page_parses_only_its_messages(long_session, monkeypatch):
+    rag = long_session
+    rag.get_session_page("s", before=60, limit=20)
+    calls = count_parsed(monkeypatch)
+    page = rag.get_session_page("s", before=40, limit=20)
+    assert [m["index"] for m in page["history"]] == list(range(20, 40))
+    assert page["history_start"] == 20
+    # Заголовок, проверка опорной точки и сами 20 сообщений
+    assert len(calls) <= 22
+
+
+def test_deep_page_after_history_rewrite(long_session):
+    rag = long_session
+    rag.get_session_page("s", before=180, limit=10)
+    # Длинная правка сдвигает все строки после нее: опорные точки больше не на границах строк
+    rag.edit_message("s", 4, "x" * 1000)
+    page = rag.get_session_page("s", before=180, limit=10)
+    assert [m["content"] for m in page["history"][::2]] == [f"u{t}" for t in range(85, 90)]
+    rag.delete_message_tail("s", 50)
+    for t in range(30):
+        rag.append_to_buffer("s", f"n{t}", f"b{t}")
+    page = rag.get_session_page("s", before=70, limit=4)
+    assert [m["content"] for m in page["history"]] == ["n8", "b8", "n9", "b9"]
+
+
+def test_page_ranges_match_full_history(long_session):
+    rag = long_session
+    full = rag.get_session_state("s")["full_history"]
+    for before, limit, since in [(200, 50, None), (150, 50, None), (33, 50, None), (97, 7, 90), (1, 5, None)]:
+        page = rag.get_session_page("s", before=before, limit=limit, since=since)
+        start = page["history_start"]
+        assert page["history"] == full[start:before]
+
+
+def contents(rag, sid="s"):
+    return [m["content"] for m in rag.get_session_state(sid)["full_history"]]
+
+
+def test_interrupted_tail_rewrite_is_recovered(rag, make_session, monkeypatch):
+    make_session(turns=5)
+    rag.edit_message("s", 9, "edited")
+
+    def crash(session_id):
+        # Обрезка успела, дозапись нового хвоста — нет
+        journal = rag._tail_journal_path(session_id)
+        if not journal.exists(): return
+        offset = int(journal.read_text(encoding="utf-8").partition("\n")[0])
+        with open(rag._history_path(session_id), "r+b") as f:
+            f.truncate(offset)
+        raise SystemExit("crash")
+
+    monkeypatch.setattr(rag, "_recover_history_tail", crash)
+    with pytest.raises(SystemExit):
+        rag.edit_message("s", 7, "edit2")
+    assert rag._tail_journal_path("s").exists()
+    monkeypatch.undo()
+
+    # Журнал доводит замену при следующем обращении под блокировкой
+    assert contents(rag)[-4:] == ["u3", "edit2", "u4", "edited"]
+    assert not rag._tail_journal_path("s").exists()
+    assert [m["index"] for m in rag.get_session_state("s")["full_history"]] == list(range(10))
+
+
+def test_window_loads_only_tail_until_older_message_is_read(long_session):
+    rag = long_session
+    loads = []
+    view = rag.get_session_window("s", tail=10)["history"]
+    full = view.loader
+    view.loader = lambda: loads.append(1) or full()
+    assert len(view) == 200 and len(view.tail) == 10
+    assert view[-1]["content"] == "a99" and view[190]["content"] == "u95"
+    assert [m["index"] for m in view[195:]] == list(range(195, 200))
+    assert loads == []
+    assert view[0]["content"] == "u0" and view[10:12][1]["content"] == "a5"
+    assert loads == [1]
+
+
+def test_window_without_loader_rejects_older_messages():
+    tail = [{"index": i} for i in range(8, 10)]
+    view = rag_engine.HistoryView(None, tail, 10)
+    assert view[-2] is tail[0] and view[8:] == tail
+    with pytest.raises(IndexError):
+        view[3]
+    with pytest.raises(IndexError):
+        view[10]
@@ -0,0 +1,80 @@
+"""apply_history_batch: правки, свайпы и откат одной транзакцией."""
+import pytest
+
+
+def docs_of(rag, sid="s"):
+    hist = rag.get_session_state(sid)["full_history"]
+    return [rag.history_collection.docs.get(m["vector_id"], (None,))[0] if m.get("vector_id") else None
+            for m in hist]
+
+
+def test_edit_after_lone_user_message_reembeds_pair(rag, make_session):
+    # [0 user, 1 ai, 2 user, 3 user, 4 ai]: ответ на сообщение 2 удален через «Delete & Rewind»
+    make_session(turns=2)
+    rag.delete_message_tail("s", 3)
+    vid = rag.store_interaction("s", "u2", "a2", turn=rag.get_session_head("s")["turns"])
+    rag.append_to_buffer("s", "u2", "a2", vid)
+
+    res = rag.apply_history_batch("s", [{"op": "edit", "index": 4, "text": "a2-edited"}])
+    assert res["vectors_embedded"] == 1 and res["vectors_deleted"] == 1
+    assert docs_of(rag)[4] == "User: u2\nAI: a2-edited"
+    assert vid not in rag.history_collection.docs
+
+
+def test_editing_lone_user_message_embeds_nothing(rag, make_session):
+    make_session(turns=2)
+    rag.delete_message_tail("s", 3)
+    rag.append_to_buffer("s", "u2", "a2", rag.store_interaction("s", "u2", "a2", turn=2))
+    before = dict(rag.history_collection.docs)
+    res = rag.apply_history_batch("s", [{"op": "edit", "index": 2, "text": "u1-edited"}])
+    assert res["vectors_embedded"] == 0 and rag.history_collection.docs == before
+
+
+@pytest.fixture
+def calls(rag, monkeypatch):
+    """Порядок обращений батча к коллекции векторов."""
+    log, coll = [], rag.history_collection
+    add, delete = coll.add_documents, coll.delete
+    monkeypatch.setattr(coll, "add_documents", lambda docs, ids: log.append(("add", ids)) or add(docs, ids))
+    monkeypatch.setattr(coll, "delete", lambda ids=None, where=None: log.append(("delete", ids)) or delete(ids))
+    return log
+
+
+def test_old_vectors_deleted_after_new_ones_are_written(rag, make_session, calls):
+    make_session()
+    calls.clear()
+    old = [m["vector_id"] for m in rag.get_session_state("s")["full_history"]][3::2][:2]
+    res = rag.apply_history_batch("s", [{"op": "edit", "index": 3, "text": "e3"},
+                                        {"op": "edit", "index": 5, "text": "e5"}])
+    assert res["vectors_embedded"] == 2 and res["vectors_deleted"] == 2
+    assert [op for op, _ in calls] == ["add", "delete"]
+    assert sorted(calls[1][1]) == sorted(old)
+    assert docs_of(rag)[3::2][:2] == ["User: u1\nAI: e3", "User: u2\nAI: e5"]
+
+
+def test_failed_embedding_keeps_old_vectors(rag, make_session, monkeypatch, calls):
+    make_session()
+    before = docs_of(rag)
+    ids = [m["vector_id"] for m in rag.get_session_state("s")["full_history"]]
+
+    def fail(docs, ids):
+        raise RuntimeError("embedding backend down")
+
+    monkeypatch.setattr(rag.history_collection, "add_documents", fail)
+    res = rag.apply_history_batch("s", [{"op": "edit", "index": 3, "text": "e3"}])
+    assert res["vectors_embedded"] == 0 and res["vectors_deleted"] == 0
+    hist = rag.get_session_state("s")["full_history"]
+    # Текст правки сохранен, а сообщение ссылается на прежний (существующий) вектор
+    assert hist[3]["content"] == "e3"
+    assert [m["vector_id"] for m in hist] == ids and docs_of(rag) == before
+    assert "delete" not in [op for op, _ in calls]
+
+
+def test_rewind_deletes_cut_vectors_without_reembedding(rag, make_session, calls):
+    make_session()
+    calls.clear()
+    cut = [m["vector_id"] for m in rag.get_session_state("s")["full_history"][4:] if m.get("vector_id")]
+    res = rag.apply_history_batch("s", [{"op": "rewind", "index": 4}])
+    assert res["vectors_embedded"] == 0 and res["vectors_deleted"] == len(cut) == 2
+    assert [op for op, _ in calls] == ["delete"] and sorted(calls[0][1]) == sorted(cut)
+    assert all(v not in rag.history_collection.docs for v in cut)
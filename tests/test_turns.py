@@ -0,0 +1,127 @@
+"""Номера ходов: по ролям сообщений, а не по четности индекса."""
+import json
+
+
+def turns_of(rag, sid="s"):
+    return [m["turn"] for m in rag.get_session_state(sid)["full_history"]]
+
+
+def test_lone_user_message_keeps_its_own_turn(rag, make_session):
+    make_session(turns=2)
+    rag.delete_message_tail("s", 3)
+    assert rag.get_session_head("s")["turns"] == 2
+    rag.append_to_buffer("s", "u2", "a2")
+    assert turns_of(rag) == [0, 0, 1, 2, 2]
+    assert rag.get_session_head("s")["turns"] == 3
+
+
+def test_rewind_reuses_dropped_turns(rag, make_session):
+    make_session(turns=3)
+    rag.delete_message_tail("s", 2)
+    rag.append_to_buffer("s", "x", "y")
+    assert turns_of(rag) == [0, 0, 1, 1]
+
+
+def test_legacy_history_gets_turns_by_role(rag):
+    roles = ["user", "ai", "user", "user", "ai", "ai"]
+    msgs = [{"index": i, "role": r, "content": str(i)} for i, r in enumerate(roles)]
+    rag._history_path("old").write_text("".join(json.dumps(m) + "\n" for m in msgs), encoding="utf-8")
+    rag._head_path("old").write_text(json.dumps({"summary": "", "buffer": [], "msg_count": 3,
+                                                 "history_len": len(msgs)}), encoding="utf-8")
+    assert rag.get_session_head("old")["turns"] == 4
+    assert turns_of(rag, "old") == [0, 0, 1, 2, 2, 3]
+
+
+def test_backfill_uses_message_turns(rag, make_session):
+    make_session(turns=2)
+    rag.delete_message_tail("s", 3)
+    vid = rag.store_interaction("s", "u2", "a2")
+    rag.append_to_buffer("s", "u2", "a2", vid)
+    rag.backfill_vector_metadata("s")
+    assert rag.history_collection.docs[vid][1]["turn"] == 2
+
+
+def lone_user_session(rag, make_session):
+    """[u0 a0 u1 u2 a2 u3 a3]: ответ на u1 удален, ходы 0, 2, 3 — полные пары."""
+    make_session(turns=2)
+    rag.delete_message_tail("s", 3)
+    for t in (2, 3):
+        vid = rag.store_interaction("s", f"u{t}", f"a{t}", turn=t)
+        rag.append_to_buffer("s", f"u{t}", f"a{t}", vid)
+    return rag.get_session_state("s")["full_history"]
+
+
+def test_store_interactions_pairs_by_role(rag, make_session):
+    hist = lone_user_session(rag, make_session)
+    assert rag._store_interactions("s", hist, {1, 2}) == 1
+    doc, meta = rag.history_collection.docs[hist[4]["vector_id"]]
+    assert doc == "User: u2\nAI: a2" and meta["turn"] == 2
+
+
+def test_edit_reembeds_with_preceding_user_message(rag, make_session):
+    hist = lone_user_session(rag, make_session)
+    rag.edit_message("s", 4, "a2-edited")
+    vid = rag.get_session_state("s")["full_history"][4]["vector_id"]
+    assert vid != hist[4]["vector_id"]
+    doc, meta = rag.history_collection.docs[vid]
+    assert doc == "User: u2\nAI: a2-edited" and meta["turn"] == 2
+
+
+def test_get_turns_returns_whole_turns(rag, make_session):
+    lone_user_session(rag, make_session)
+    assert [m["content"] for m in rag.get_turns("s", 1, 2)] == ["u1", "u2", "a2"]
+    assert [m["content"] for m in rag.get_turns("s", 3, 3)] == ["u3", "a3"]
+
+
+def test_commit_episode_clears_only_covered_turns(rag, make_session):
+    hist = lone_user_session(rag, make_session)
+    raw = [m["vector_id"] for m in hist if m.get("vector_id")]
+    ep = rag.store_episode("s", "summary", 0, 2, 1)
+    assert rag.commit_episode("s", {"id": ep, "start": 0, "end": 2, "level": 1}, [], raw[:2])
+    after = rag.get_session_state("s")["full_history"]
+    assert [m["vector_id"] for m in after if m["role"] == "ai"] == [None, None, hist[6]["vector_id"]]
+
+
+def test_rewind_into_episode_restores_paired_turns(rag, make_session):
+    hist = lone_user_session(rag, make_session)
+    raw = [m["vector_id"] for m in hist if m.get("vector_id")]
+    ep = rag.store_episode("s", "summary", 0, 3, 1)
+    rag.commit_episode("s", {"id": ep, "start": 0, "end": 3, "level": 1}, [], raw)
+    rag.delete_message_tail("s", 6)
+    state = rag.get_session_state("s")
+    assert state["episodes"] == [] and ep not in rag.history_collection.docs
+    docs = sorted(rag.history_collection.docs[m["vector_id"]][0] for m in state["full_history"] if m.get("vector_id"))
+    assert docs == ["User: u0\nAI: a0", "User: u2\nAI: a2"]
+
+
+def test_fork_stops_at_last_complete_turn(rag, make_session):
+    lone_user_session(rag, make_session)
+    assert rag.fork_session("s", "f", 3)
+    head = rag.get_session_head("f")
+    assert head["turns"] == 3 and head["msg_count"] == 1
+
+
+class CountingEmbeddings:
+    def __init__(self):
+        self.texts = []
+
+    def embed_documents(self, texts):
+        self.texts += texts
+        return [[0.0] for _ in texts]
+
+
+def test_repair_interaction_documents(rag, make_session):
+    make_session(turns=3)
+    hist = rag.get_session_state("s")["full_history"]
+    broken, ok = hist[3]["vector_id"], hist[5]["vector_id"]
+    docs = rag.history_collection.docs
+    docs[broken] = ("User: u1\\nAI: a1", docs[broken][1])
+    docs[ok] = ("User: u2\\nAI: edited elsewhere", docs[ok][1])
+    rag.embeddings = CountingEmbeddings()
+
+    assert rag.repair_interaction_documents("s") == 1
+    assert docs[broken][0] == "User: u1\nAI: a1" and docs[broken][1]["turn"] == 1
+    assert rag.embeddings.texts == ["User: u1\nAI: a1"]
+    # Документ, расходящийся с историей не только разделителем, не трогаем
+    assert docs[ok][0] == "User: u2\\nAI: edited elsewhere"
+    assert rag.repair_interaction_documents("s") == 0
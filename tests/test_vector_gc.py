@@ -0,0 +1,82 @@
+"""collect_orphan_vectors: mark-and-sweep по коллекции истории."""
+import os
+import time
+
+import pytest
+
+
+@pytest.fixture
+def old_sessions(rag, make_session, monkeypatch):
+    """Сессии a и b, чьи векторы записаны час назад (старше любого grace)."""
+    monkeypatch.setattr(rag, "_now", lambda: time.time() - 3600)
+    make_session("a")
+    make_session("b")
+    return rag
+
+
+def vector_ids(rag, sid):
+    return [m["vector_id"] for m in rag.get_session_state(sid)["full_history"] if m.get("vector_id")]
+
+
+def test_sweeps_only_unreferenced_old_vectors(old_sessions, monkeypatch):
+    rag = old_sessions
+    leaked = rag.store_interaction("a", "x", "y", turn=9)
+    rag._head_path("b").unlink()
+    rag._history_path("b").unlink()
+    monkeypatch.setattr(rag, "_now", time.time)
+    fresh = rag.store_interaction("a", "fresh", "y", turn=10)
+
+    report = rag.collect_orphan_vectors(batch_size=3, grace_seconds=600)
+    assert report["by_reason"] == {"deleted_session": 4, "archived_session": 0, "unreferenced": 1}
+    assert report["deleted"] == 5 and report["revived"] == 0
+    assert set(rag.history_collection.docs) == {*vector_ids(rag, "a"), fresh}
+    assert leaked not in rag.history_collection.docs
+
+
+def test_dry_run_deletes_nothing(old_sessions):
+    rag = old_sessions
+    rag.store_interaction("a", "x", "y", turn=9)
+    before = dict(rag.history_collection.docs)
+    report = rag.collect_orphan_vectors(grace_seconds=600, dry_run=True)
+    assert report["orphans"] == 1 and report["deleted"] == 0
+    assert rag.history_collection.docs == before
+
+
+def test_fork_and_rehydrate_during_scan_revive_candidates(old_sessions, monkeypatch):
+    rag = old_sessions
+    coll = rag.history_collection
+    get = coll.get
+
+    def racing_get(*args, **kwargs):
+        # Первая страница скана уже прочитана, а разметка живых векторов — нет
+        page = get(*args, **kwargs)
+        if kwargs.get("offset") == 0:
+            monkeypatch.setattr(coll, "get", get)
+            rag.fork_session("a", "f", 8)
+            rag.archive_session("b")
+            rag.get_session_head("b")
+        return page
+
+    monkeypatch.setattr(coll, "get", racing_get)
+    report = rag.collect_orphan_vectors(batch_size=2, grace_seconds=600)
+    assert report["deleted"] == 0 and report["revived"] == report["orphans"] > 0
+    for sid in ("a", "b", "f"):
+        ids = vector_ids(rag, sid)
+        assert len(ids) == 4 and all(v in coll.docs for v in ids)
+
+
+def test_skips_running_import_and_collects_abandoned_one(old_sessions):
+    rag = old_sessions
+    assert rag.begin_import("i") and rag.begin_import("j")
+    running = rag.store_interaction("i", "u", "a", turn=0)
+    lost = rag.store_interaction("j", "u", "a", turn=0)
+    stale = time.time() - 3600
+    os.utime(rag._import_path("j"), (stale, stale))
+    for vid in (running, lost):
+        text, meta = rag.history_collection.docs[vid]
+        rag.history_collection.docs[vid] = (text, {**meta, "timestamp": stale})
+
+    report = rag.collect_orphan_vectors(grace_seconds=600)
+    assert report["abandoned_imports"] == 1 and report["deleted"] == 1
+    assert running in rag.history_collection.docs and lost not in rag.history_collection.docs
+    assert rag._import_path("i").exists() and not rag._import_path("j").exists()
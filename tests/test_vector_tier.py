@@ -0,0 +1,107 @@
+"""CompactVectorStore: шарды int8/float32 в memmap-файлах и журнал строк."""
+import hashlib
+
+import numpy as np
+import pytest
+
+from core.vector_tier import CompactVectorStore
+
+DIM = 16
+
+
+class HashEmbeddings:
+    """Детерминированные эмбеддинги: вектор выводится из хэша текста."""
+
+    def vec(self, text):
+        seed = int.from_bytes(hashlib.sha256(text.encode()).digest()[:4], "little")
+        return np.random.default_rng(seed).standard_normal(DIM).astype(np.float32).tolist()
+
+    def embed_documents(self, texts):
+        return [self.vec(t) for t in texts]
+
+    def embed_query(self, text):
+        return self.vec(text)
+
+
+@pytest.fixture
+def store(tmp_path):
+    return CompactVectorStore(tmp_path, HashEmbeddings())
+
+
+def add(store, sid, *texts):
+    emb = HashEmbeddings()
+    store.upsert(ids=list(texts), embeddings=[emb.vec(t) for t in texts], documents=list(texts),
+                 metadatas=[{"session_id": sid, "type": "interaction"} for _ in texts])
+
+
+def assert_exact(store, sid, texts):
+    """Каждый текст находится сам по себе, и его вектор совпадает с исходным."""
+    for t in texts:
+        doc, score = store.similarity_search_with_relevance_scores(t, k=1, filter={"session_id": sid})[0]
+        assert doc.page_content == t and score == pytest.approx(1.0, abs=1e-5)
+    got = store.get(ids=list(texts), include=["embeddings"])
+    for vid, vec in zip(got["ids"], got["embeddings"]):
+        expected = np.asarray(HashEmbeddings().vec(vid))
+        assert np.allclose(vec, expected / np.linalg.norm(expected), atol=1e-6)
+
+
+def test_partial_array_write_is_discarded(tmp_path, store):
+    add(store, "s", "a", "b")
+    shard = tmp_path / "s"
+    # Сбой между записью массивов и журнала: в массивах лишняя строка, журнал о ней не знает
+    for name, size in (("codes.i8", DIM), ("scale.f32", 4), ("vec.f32", DIM * 4)):
+        with open(shard / name, "ab") as f: f.write(b"\x7f" * size)
+
+    reopened = CompactVectorStore(tmp_path, HashEmbeddings())
+    add(reopened, "s", "c", "d")
+    assert_exact(reopened, "s", ["a", "b", "c", "d"])
+    assert (shard / "scale.f32").stat().st_size == 4 * 4
+
+
+def test_reopened_store_replays_log(tmp_path, store):
+    add(store, "s", "a", "b", "c")
+    store.update(ids=["b"], metadatas=[{"session_id": "s", "type": "episode"}])
+    store.delete(ids=["a"])
+    add(store, "t", "x")
+
+    reopened = CompactVectorStore(tmp_path, HashEmbeddings())
+    assert reopened.count() == 3
+    assert reopened.get(where={"session_id": "s", "type": "episode"})["ids"] == ["b"]
+    assert reopened.get(ids=["a"])["ids"] == []
+    assert_exact(reopened, "s", ["b", "c"])
+    assert_exact(reopened, "t", ["x"])
+
+
+def test_compaction_drops_deleted_rows(tmp_path, store):
+    texts = [f"t{n}" for n in range(80)]
+    add(store, "s", *texts)
+    store.delete(ids=texts[:50])
+    shard = tmp_path / "s"
+    assert (shard / "scale.f32").stat().st_size == 30 * 4
+    assert (shard / "codes.i8").stat().st_size == 30 * DIM
+    assert_exact(store, "s", texts[50:])
+    assert_exact(CompactVectorStore(tmp_path, HashEmbeddings()), "s", texts[50:])
+    add(store, "s", "after")
+    assert_exact(store, "s", texts[50:] + ["after"])
+
+
+def test_second_instance_sees_writes_and_compaction(tmp_path, store):
+    texts = [f"t{n}" for n in range(80)]
+    other = CompactVectorStore(tmp_path, HashEmbeddings())
+    add(store, "s", *texts[:10])
+    assert_exact(other, "s", texts[:10])
+    # Шард other уже открыт: дозапись и компакцию в store он подхватывает по журналу
+    add(store, "s", *texts[10:])
+    store.delete(ids=texts[:50])
+    assert other.count() == 30
+    assert_exact(other, "s", texts[50:])
+    add(other, "s", "from-other")
+    assert_exact(store, "s", texts[50:] + ["from-other"])
+
+
+def test_deleting_all_rows_removes_shard(tmp_path, store):
+    add(store, "s", "a", "b")
+    store.delete(where={"session_id": "s"})
+    assert not (tmp_path / "s").exists() and store.count() == 0
+    add(store, "s", "c")
+    assert_exact(store, "s", ["c"])